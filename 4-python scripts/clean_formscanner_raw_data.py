@@ -53,11 +53,10 @@ class_data.ingest_formscanner_data(formscanner_data_path)
 # clean up the formscanner data
 class_data.clean_formscanner_data()
 
-# match name with student ID number
-class_data.match_roster_to_responses()
-
-# match name with student ID number again to see if corrections took
-class_data.match_roster_to_responses()
+# match name with student ID number, corrections are kept in a file so
+# they don't have to be entered again on the next run
+class_data.match_roster_to_responses('data/' + file_name[:-4] +
+                                     ' id corrections.csv')
 
 # save data to CSV file
 class_data.write_to_csv(save_path)
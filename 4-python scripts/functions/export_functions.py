@@ -0,0 +1,253 @@
+""" Export engine that writes every output file in one pass over the class.
+
+ClassData.export_chunks hands out the students a chunk of rows at a time,
+already converted to text once for every output. Each sink turns a chunk
+into CSV rows for its own file, so adding an output format only means
+writing a new sink. Files are written through large buffers and a whole
+chunk of rows is written at a time. Each file is written under a temporary
+name and only moved into place once the whole pass has finished, so a
+failed export never leaves a half written file or clobbers an old one.
+
+Sinks:
+FormattedResponsesSink => formatted scan data, same as write_to_csv
+JMetrikImportSink      => formatted scan data with the keys added as
+                          students, for the jMetrik import script
+D2LGradebookSink       => percent score for the D2L gradebook
+D2LResponsesSink       => D2L feedback text of the bubbled answers
+D2LPointsSink          => D2L feedback text of the credit on each question
+ItemAnalysisSink       => item_analysis_df, written once at the end
+"""
+
+import os
+import csv
+import abc
+
+# bytes buffered by each output file between writes to disk
+WRITE_BUFFER_SIZE = 1 << 20
+
+# rows handed to the sinks at a time
+EXPORT_CHUNK_SIZE = 10000
+
+
+class ExportSink(abc.ABC):
+    """ One output file. Subclasses set name and implement heading and
+    rows.
+    """
+
+    name = 'sink'
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.fileobj = None
+        self.writer = None
+
+    @property
+    def temp_path(self):
+        return self.path + '.tmp'
+
+    def open(self, class_data):
+        """ Opens the temporary file and writes the heading row.
+        """
+
+        self.fileobj = open(self.temp_path, 'w', newline='',
+                            buffering=WRITE_BUFFER_SIZE)
+        self.writer = csv.writer(self.fileobj)
+        self.writer.writerow(self.heading(class_data))
+
+        return
+
+    @abc.abstractmethod
+    def heading(self, class_data):
+        """ List of column headings.
+        """
+
+    @abc.abstractmethod
+    def rows(self, chunk):
+        """ CSV rows for one chunk from ClassData.export_chunks.
+        """
+
+    def write_chunk(self, chunk):
+        self.writer.writerows(self.rows(chunk))
+
+        return
+
+    def finish(self, class_data):
+        """ Called once every chunk has been written, for rows or files
+        that only make sense after a complete pass.
+        """
+
+        return
+
+    def close(self, class_data, completed=True):
+        """ Flushes and closes the file. Called even if the export fails,
+        in which case the temporary file is thrown away.
+        """
+
+        if self.fileobj is not None:
+            self.fileobj.close()
+            self.fileobj = None
+
+            if completed:
+                os.replace(self.temp_path, self.path)
+            else:
+                os.remove(self.temp_path)
+
+        return
+
+
+class FormattedResponsesSink(ExportSink):
+    """ Student columns followed by the bubbled letters for each question.
+    """
+
+    name = 'formatted'
+
+    def heading(self, class_data):
+        return (['OrgDefinedId', 'random ID', 'form', 'name'] +
+                list(class_data.ques_fieldnames))
+
+    def rows(self, chunk):
+        return ([student_id, random_id, form, name] + list(letters)
+                for student_id, random_id, form, name, letters
+                in zip(chunk['OrgDefinedId'], chunk['random ID'],
+                       chunk['form'], chunk['name'], chunk['letters']))
+
+
+class JMetrikImportSink(FormattedResponsesSink):
+    """ Formatted responses with a row for each exam key, so jMetrik can
+    be checked against the keys.
+    """
+
+    name = 'jmetrik'
+
+    # ID used for the key rows
+    KEY_ID = '#9999999'
+
+    def finish(self, class_data):
+        for column in class_data.exam_keys_df.columns:
+            if column.endswith(' answer'):
+                key = column[:-len(' answer')]
+                self.writer.writerow(
+                    [self.KEY_ID, '', key[-1], key] +
+                    class_data.exam_keys_df[column].tolist())
+
+        return
+
+
+class D2LSink(ExportSink):
+    """ D2L import file with one grade item column and the required
+    end of line indicator.
+    """
+
+    # grade item heading, formatted with the exam name
+    grade_item = '{}'
+
+    def __init__(self, path, exam_name):
+        super().__init__(path)
+        self.exam_name = exam_name
+
+    def heading(self, class_data):
+        return ['OrgDefinedId', self.grade_item.format(self.exam_name),
+                'End-of-Line Indicator']
+
+    @abc.abstractmethod
+    def values(self, chunk):
+        """ Grade item value for each student in the chunk.
+        """
+
+    def rows(self, chunk):
+        return ([student_id, value, '#'] for student_id, value
+                in zip(chunk['OrgDefinedId'], self.values(chunk)))
+
+
+class D2LGradebookSink(D2LSink):
+    name = 'gradebook'
+    grade_item = '{} Points Grade'
+
+    def values(self, chunk):
+        return chunk['percent correct']
+
+
+class D2LResponsesSink(D2LSink):
+    """ Feedback text of the answers, e.g. 'A, -, B|C' ('-' is a blank).
+    """
+
+    name = 'responses'
+    grade_item = '{} responses Text Grade'
+
+    def values(self, chunk):
+        return (', '.join(letters) for letters in chunk['feedback letters'])
+
+
+class D2LPointsSink(D2LSink):
+    """ Feedback text of the credit on each question, then the number
+    correct and the percent, e.g. '1, 0, 1, 2, 67%'.
+    """
+
+    name = 'points'
+    grade_item = '{} points Text Grade'
+
+    def values(self, chunk):
+        return (', '.join(credit) + ', ' + number + ', ' + percent + '%'
+                for credit, number, percent
+                in zip(chunk['credit'], chunk['number correct'],
+                       chunk['percent correct']))
+
+
+class ItemAnalysisSink(ExportSink):
+    """ item_analysis_df with a row per statistic. Nothing is written per
+    student, the table is saved when the export finishes.
+    """
+
+    name = 'item analysis'
+
+    def open(self, class_data):
+        return
+
+    def heading(self, class_data):
+        return [''] + list(class_data.item_analysis_df.columns)
+
+    def rows(self, chunk):
+        return ()
+
+    def write_chunk(self, chunk):
+        return
+
+    def finish(self, class_data):
+        class_data.item_analysis_df.to_csv(self.temp_path)
+        os.replace(self.temp_path, self.path)
+
+        return
+
+
+def export_results(class_data, sinks, chunk_size=EXPORT_CHUNK_SIZE):
+    """ Feeds every sink from one chunked pass over the students.
+
+    :param class_data: ClassData to export, graded unless only response
+    sinks are used
+    :param sinks: list of ExportSink objects
+    :param chunk_size: number of students per chunk
+    :return: dict of sink name => path written
+    """
+
+    opened = list()
+    completed = False
+
+    try:
+        for sink in sinks:
+            sink.open(class_data)
+            opened.append(sink)
+
+        for chunk in class_data.export_chunks(chunk_size):
+            for sink in sinks:
+                sink.write_chunk(chunk)
+
+        for sink in sinks:
+            sink.finish(class_data)
+
+        completed = True
+
+    finally:
+        for sink in opened:
+            sink.close(class_data, completed)
+
+    return {sink.name: sink.path for sink in sinks}
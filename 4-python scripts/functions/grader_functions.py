@@ -11,16 +11,25 @@ form         => group name for form letter
 
 import csv
 import re
+import string
 import pandas as pd
 import numpy as np
 import shelve
-
-# imports for pdf conversion
-import io
-from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
-from pdfminer.converter import TextConverter
-from pdfminer.layout import LAParams
-from pdfminer.pdfpage import PDFPage
+import sqlite3
+import json
+import contextlib
+import warnings
+
+# worker processes for bootstrap batches and sections
+from parallel_functions import parallel_map
+# pdf answer key parsing (cached) lives in its own module
+from key_functions import convert_pdf_to_txt, read_exam_key, read_exam_keys
+# Rasch and 2PL calibration, replaces the jMetrik round trip
+from irt_functions import fit_irt_model
+# output files are written by pluggable sinks in one pass
+from export_functions import (export_results, EXPORT_CHUNK_SIZE,
+                              D2LGradebookSink, D2LResponsesSink,
+                              D2LPointsSink)
 
 # import statements for helper functions
 import pyperclip
@@ -31,6 +40,92 @@ import sys
 # Let the parser know how formscanner formats the data
 csv.register_dialect('formscanner', delimiter=";")
 
+# integer codes used by the response matrix, 0 means the bubble was left blank
+RESPONSE_CODES = {'A': 1, 'B': 2, 'C': 3, 'D': 4, 'E': 5}
+BLANK_CODE = 0
+MULTI_MARK_CODE = 6
+
+# reverse lookup, index with a code array to get the letters back
+CODE_LETTERS = np.array(['', 'A', 'B', 'C', 'D', 'E', '*'], dtype=object)
+
+# every response is also kept as a 5-bit option mask, bit 0 is A, bit 4 is E
+OPTION_MASKS = {'A': 1, 'B': 2, 'C': 4, 'D': 8, 'E': 16}
+
+# lookups indexed by option mask: bubbles filled, response code and letters
+MASK_POPCOUNT = np.array([bin(mask).count('1') for mask in range(32)],
+                         dtype=np.uint8)
+MASK_TO_CODE = np.array([BLANK_CODE if mask == 0 else
+                         MULTI_MARK_CODE if bin(mask).count('1') > 1 else
+                         mask.bit_length()
+                         for mask in range(32)], dtype=np.uint8)
+MASK_LETTERS = np.array(['|'.join(letter for letter, bit in
+                                  OPTION_MASKS.items() if mask & bit)
+                         for mask in range(32)], dtype=object)
+
+# number of the last option marked in each mask, e.g. B|D => 4
+MASK_LAST_OPTION = np.array([mask.bit_length() for mask in range(32)],
+                            dtype=np.uint8)
+
+# per item scoring rules understood by score_responses
+SCORING_RULES = ('any', 'all', 'partial')
+
+# option mask for each response code, and labels for distractor tables
+CODE_MASKS = np.array([0, 1, 2, 4, 8, 16, 0], dtype=np.uint8)
+OPTION_LABELS = ['blank', 'A', 'B', 'C', 'D', 'E', 'multi']
+
+# forms are coded separately since scrambled exams can run past form E
+FORM_LETTERS = np.array([''] + list(string.ascii_uppercase), dtype=object)
+
+# tables kept in the SQLite state database, see connect_state_db
+STATE_TABLES = ('roster', 'exam_keys', 'responses', 'scores',
+                'item_statistics')
+
+# bump if STATE_SCHEMA changes, older state databases are rebuilt
+STATE_SCHEMA_VERSION = 2
+
+# bubblesheets decoded at a time when a FormScanner export is read
+INGEST_CHUNK_SIZE = 10000
+
+# bump if the layout written by ClassData.save_snapshot changes
+SNAPSHOT_VERSION = 2
+
+# schema for the SQLite state database
+STATE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS metadata (
+        name TEXT PRIMARY KEY,
+        value TEXT);
+    CREATE TABLE IF NOT EXISTS roster (
+        OrgDefinedId TEXT PRIMARY KEY,
+        name TEXT,
+        random_id TEXT);
+    CREATE TABLE IF NOT EXISTS exam_keys (
+        key TEXT,
+        ques_number INTEGER,
+        answer TEXT,
+        PRIMARY KEY (key, ques_number));
+    CREATE TABLE IF NOT EXISTS responses (
+        sheet INTEGER PRIMARY KEY,
+        OrgDefinedId TEXT,
+        random_id TEXT,
+        form TEXT,
+        name TEXT,
+        responses BLOB);
+    CREATE TABLE IF NOT EXISTS scores (
+        sheet INTEGER PRIMARY KEY,
+        scored BLOB,
+        number_correct REAL,
+        percent_correct INTEGER);
+    CREATE TABLE IF NOT EXISTS item_statistics (
+        question TEXT,
+        statistic TEXT,
+        value REAL,
+        PRIMARY KEY (question, statistic));
+    CREATE INDEX IF NOT EXISTS responses_form ON responses (form);
+    """
+
+# column headings that precede the questions in the formatted response data
+STUDENT_HEADINGS = ['OrgDefinedId', 'random ID', 'form', 'name']
+
 
 class ClassData(object):
     """ This class is used to store the raw bubblesheet data
@@ -40,6 +135,10 @@ class ClassData(object):
     """
 
     def __init__(self, number_of_forms=2, id_length=7):
+        # analyses that are out of date since the last regrade, they are
+        # recomputed the next time they are looked at
+        self._stale_analyses = set()
+
         self.number_of_questions = 0
         self.number_of_forms = number_of_forms
         self.id_length = id_length
@@ -54,15 +153,13 @@ class ClassData(object):
         self.id_to_name = dict()
         self.id_to_randomid = dict()
 
-        # contains all of the raw student responses
-        self.raw_data = list()
-        # contains all of the reformatted student response data
-        self.class_data = list()
-
         self.all_fieldnames = list()
         self.ques_fieldnames = list()
         self.id_fieldnames = list()
         self.form_fieldname = list()
+        self.group_names = list()
+        # column positions compiled from the FormScanner header
+        self.formscanner_layout = dict()
 
         # pandas dataframes that may be useful
         self.roster_df = pd.DataFrame()
@@ -70,8 +167,88 @@ class ClassData(object):
         self.responses_df = pd.DataFrame()
         self.scored_exam_df = pd.DataFrame()
         self.item_analysis_df = pd.DataFrame()
+        self.form_inference_df = pd.DataFrame()
+        self.distractor_analysis_df = pd.DataFrame()
+        # whole test statistics such as reliability, see analyze_items
+        self.test_statistics = dict()
+        # percentile intervals, see bootstrap_item_analysis
+        self.item_confidence_df = pd.DataFrame()
+        self.test_confidence_df = pd.DataFrame()
+        # IRT results, see calibrate_irt
+        self.item_parameters_df = pd.DataFrame()
+        self.abilities_df = pd.DataFrame()
+
+        # result of the last roster join, see join_roster_to_responses
+        self.roster_match = dict()
+        # built when the roster is ingested, see StudentIdIndex
+        self.id_index = None
 
         # numpy arrays that may be useful
+        # one row per bubblesheet, one column per question, see RESPONSE_CODES
+        self.response_codes = np.zeros((0, 0), dtype=np.uint8)
+        # same responses as option masks, see OPTION_MASKS
+        self.response_masks = np.zeros((0, 0), dtype=np.uint8)
+        # student data that goes along with each row of the response matrix
+        self.student_ids = np.array([], dtype=object)
+        self.form_codes = np.array([], dtype=np.uint8)
+        self.student_names = np.array([], dtype=object)
+        self.student_random_ids = np.array([], dtype=object)
+        # credit earned on each question, rows line up with response_codes
+        self.scored_matrix = np.zeros((0, 0), dtype=np.float32)
+        # weighted points earned by each student, kept up to date by regrade
+        self.total_points = np.array([], dtype=float)
+
+        # exam keys as option masks, plus the key row used for each student
+        self.key_masks = np.zeros((0, 0), dtype=np.uint8)
+        self.key_index = np.array([], dtype=np.intp)
+
+        # question number => scoring rule or points, see score_responses
+        # questions that aren't listed use the 'any' rule and are worth 1
+        self.scoring_rules = dict()
+        self.item_weights = dict()
+        # question numbers that no longer count towards the score
+        self.dropped_items = set()
+
+    # ------------------ lazily refreshed analyses ------------------ #
+
+    @property
+    def item_analysis_df(self):
+        """Item analysis, see analyze_items. Rerun if a regrade made it
+        stale.
+        """
+        if 'items' in self._stale_analyses:
+            self.analyze_items()
+        return self._item_analysis_df
+
+    @item_analysis_df.setter
+    def item_analysis_df(self, item_analysis_df):
+        self._stale_analyses.discard('items')
+        self._item_analysis_df = item_analysis_df
+
+    @property
+    def test_statistics(self):
+        """Whole test statistics such as reliability, see analyze_items.
+        """
+        if 'items' in self._stale_analyses:
+            self.analyze_items()
+        return self._test_statistics
+
+    @test_statistics.setter
+    def test_statistics(self, test_statistics):
+        self._test_statistics = test_statistics
+
+    @property
+    def distractor_analysis_df(self):
+        """Distractor analysis of every student, see analyze_distractors.
+        """
+        if 'distractors' in self._stale_analyses:
+            self.analyze_distractors()
+        return self._distractor_analysis_df
+
+    @distractor_analysis_df.setter
+    def distractor_analysis_df(self, distractor_analysis_df):
+        self._stale_analyses.discard('distractors')
+        self._distractor_analysis_df = distractor_analysis_df
 
     def __str__(self):
         """ Generates a diagnostic report for troubleshooting.
@@ -120,738 +297,1880 @@ class ClassData(object):
                 except NameError:
                     print('no random ID in roster')
 
-    def ingest_formscanner_data(self, formscanner_data_path):
+        # lookup for correcting mis-bubbled IDs
+        self.id_index = StudentIdIndex(self.id_to_name.keys())
+
+    def ingest_formscanner_data(self, formscanner_data_path,
+                                chunk_size=INGEST_CHUNK_SIZE):
         """ Import raw formscanner data from CSV file path provided.
 
-        Method creates a dictionary for each row of data from the formscanner
-        CSV file. Additionally all of the column headings are imported as
-        lists for later use.
+        The file is streamed a chunk of rows at a time and each chunk is
+        decoded straight into the response matrix, so only one chunk of
+        text is in memory at a time and clean_formscanner_data has nothing
+        left to do. Additionally all of the column headings are imported
+        as lists for later use.
 
         :param formscanner_data_path: path to formscanner CSV data. Expected
         group names are 'form', 'response', and 'OrgDefinedId'.
         If the formscanner group names differ from these values (case
         sensitive) the ingest will not function properly.
+        :param chunk_size: number of bubblesheets decoded at a time
         :return: None
         """
 
-        with open(formscanner_data_path) as csvfile:
-            # list of group names used with this scan
-            group_names_dict = dict()
+        self.fill_response_chunks(
+            self.stream_formscanner_data(formscanner_data_path, chunk_size),
+            expected_rows=count_data_rows(formscanner_data_path))
+
+        num_students_tested = len(self.student_ids)
+
+        # text feedback regarding the scan
+        print('\n%d student bubblesheet forms were processed\n'
+              % num_students_tested)
+        print('List of the formscanner group names:')
 
-            # reader creates a dictionary mapping the header row to the
-            # individual student entries using the dialect created above
-            formscanner_raw = csv.DictReader(csvfile, dialect='formscanner')
+        for heading in self.group_names:
+            print('    ' + heading)
 
-            # grab all the column headings from CSV file
-            self.all_fieldnames = formscanner_raw.fieldnames
+        return
 
-            # get the unique group names eg '[OrgDefinedId]'
-            for index, heading in enumerate(self.all_fieldnames):
-                group_name = re.search(r'(.+)\.(.+)', heading)
+    def parse_formscanner_header(self, fieldnames):
+        """ Works out the column layout from the FormScanner header row.
 
-                # prevent assignment of the None object to the dict (error)
-                if group_name is not None:
-                    # using dict ensures we don't duplicate group names
-                    group_names_dict[group_name.group(1)] = index
+        The header is compiled once into a plan of column positions, see
+        compile_formscanner_layout, which is used to decode every row.
 
-            group_names = group_names_dict.keys()
+        :param fieldnames: list of column headings from the CSV file
+        :return: None
+        """
 
-            # get the number of questions based on number of items in cat.
-            self.number_of_questions = (group_names_dict['response'] -
-                                        group_names_dict['form'])
+        layout = compile_formscanner_layout(fieldnames)
 
-            # =========== separate out column headings =================
+        self.formscanner_layout = layout
+        self.all_fieldnames = list(fieldnames)
+        self.group_names = layout['group names']
 
-            # todo: Fix column headings code to be cleaner
+        self.id_fieldnames = [fieldnames[column]
+                              for column in layout['id columns']]
+        self.form_fieldname = fieldnames[layout['form column']]
 
-            # list of column headings for questions
-            # first we need to figure out how to slice the headings
-            slice_max = group_names_dict['response'] + 1
-            slice_min = slice_max - self.number_of_questions
+        # question headings without the group prefix, e.g. 'question001'
+        self.ques_fieldnames = layout['question names']
+        self.number_of_questions = len(self.ques_fieldnames)
 
-            # now use the slice positions to get the question headings
-            self.ques_fieldnames = formscanner_raw.fieldnames[slice_min:slice_max]
+    def stream_formscanner_data(self, formscanner_data_path,
+                                chunk_size=INGEST_CHUNK_SIZE):
+        """ Generator that reads a FormScanner CSV file a chunk at a time.
 
-            # column headings for ID (to recover the correct order later)
-            try:
-                slice_max = group_names_dict['OrgDefinedId'] + 1
-            except KeyError:
-                slice_max = group_names_dict['OrgDefinedID'] + 1
-            # slice_min = slice_max - self.id_length
+        The header is parsed once, then every chunk of rows is decoded into
+        the compact arrays used by the response matrix. Only one chunk of
+        text is held in memory at a time.
 
-            # assumes that the student ID length is always 7 numbers
-            self.id_fieldnames = formscanner_raw.fieldnames[1:8]
+        :param formscanner_data_path: path to formscanner CSV data
+        :param chunk_size: number of bubblesheets per chunk
+        :return: yields (student_ids, form_codes, response_masks) tuples
+        """
 
-            # column heading for the form letter
-            # slice_max = group_names_dict['form'] + 1
-            # slice_min = slice_max - 1
+        with open(formscanner_data_path) as csvfile:
+            fieldnames = next(csv.reader(csvfile, dialect='formscanner'))
 
-            self.form_fieldname = formscanner_raw.fieldnames[8]
+        self.parse_formscanner_header(fieldnames)
 
-            # reformat the student ID data and save to our list
-            for row in formscanner_raw:
-                self.raw_data.append(row)
+        reader = pd.read_csv(formscanner_data_path, sep=';', dtype=str,
+                             keep_default_na=False, chunksize=chunk_size)
 
-        # check to see how many student bubblesheets were graded
-        num_students_tested = len(self.raw_data)
+        for chunk_df in reader:
+            yield self.decode_formscanner_chunk(chunk_df)
 
-        # text feedback regarding the scan
-        print('\n%d student bubblesheet forms were processed\n'
-              % num_students_tested)
-        print('List of the formscanner group names:')
+    def decode_formscanner_chunk(self, chunk_df):
+        """ Decodes a DataFrame of raw FormScanner rows into compact arrays.
 
-        for heading in group_names:
-            print('    ' + heading)
+        Everything is done a whole column at a time using the compiled
+        layout, so the Python work doesn't grow with the number of rows.
 
-        return
+        :param chunk_df: DataFrame with the original FormScanner columns
+        :return: tuple (student_ids, form_codes, response_masks)
+        """
+
+        layout = self.formscanner_layout
+
+        # concatenate student ID number one digit column at a time
+        id_numbers = pd.Series('#', index=chunk_df.index)
+        for id_column in layout['id columns']:
+            id_numbers = id_numbers + chunk_df.iloc[:, id_column].fillna(
+                '').astype(str)
+
+        student_ids = id_numbers.to_numpy(dtype=object)
+        form_codes = encode_forms(chunk_df.iloc[:, layout['form column']])
+        response_masks = encode_response_masks(
+            chunk_df.iloc[:, layout['response columns']].to_numpy())
+
+        return student_ids, form_codes, response_masks
+
+    def fill_response_chunks(self, chunks, expected_rows=0):
+        """ Fills the response matrix and student arrays from decoded
+        chunks, e.g. the output of stream_formscanner_data. Each chunk is
+        copied into place as it arrives, so the decoded chunks are never
+        all held at once.
+
+        :param chunks: iterable of (student_ids, form_codes,
+        response_masks) tuples
+        :param expected_rows: number of rows to make room for up front,
+        the arrays grow if there are more
+        :return: None
+        """
+
+        num_rows = 0
+        student_ids = np.empty(expected_rows, dtype=object)
+        form_codes = np.zeros(expected_rows, dtype=np.uint8)
+        response_masks = None
+
+        for chunk_ids, chunk_forms, chunk_masks in chunks:
+            # the header is only known once the first chunk is read
+            if response_masks is None:
+                response_masks = np.zeros((len(student_ids),
+                                           len(self.ques_fieldnames)),
+                                          dtype=np.uint8)
+
+            end = num_rows + len(chunk_ids)
+
+            if end > len(student_ids):
+                capacity = max(end, 2 * len(student_ids))
+                student_ids = np.resize(student_ids, capacity)
+                form_codes = np.resize(form_codes, capacity)
+                response_masks = np.resize(
+                    response_masks, (capacity, response_masks.shape[1]))
+
+            student_ids[num_rows:end] = chunk_ids
+            form_codes[num_rows:end] = chunk_forms
+            response_masks[num_rows:end] = chunk_masks
+            num_rows = end
+
+        if response_masks is None:
+            response_masks = np.zeros((0, len(self.ques_fieldnames)),
+                                      dtype=np.uint8)
+
+        self.student_ids = student_ids[:num_rows].copy()
+        self.form_codes = form_codes[:num_rows].copy()
+        self.response_masks = response_masks[:num_rows].copy()
+        self.response_codes = MASK_TO_CODE[self.response_masks]
+
+        # names are filled in when the roster is matched to the responses
+        self.student_names = np.full(num_rows, '', dtype=object)
+        self.student_random_ids = np.full(num_rows, 'none', dtype=object)
 
     def clean_formscanner_data(self):
         """ Method to clean up the formscanner data. Requires that data
         has already been ingested using the ingest_formscanner_data method.
 
-        Method populates the class_data list, which is presumed to be empty.
-        Method strips '[response] ' prefix from response names in
-        ques_fieldnames
+        The data is decoded into the response matrix while it is streamed
+        in, so there is nothing left to clean. Kept for the scripts that
+        still call it after ingesting.
         """
 
-        for student in self.raw_data:
-            id_number = str()
+        return
 
-            # concatenate student ID number
-            for id_filename in self.id_fieldnames:
-                # get rid of individual ID characters
-                id_number += str(student.pop(id_filename))
+    def load_responses_df(self, responses_df=None):
+        """ Populates the response matrix from a formatted responses
+        DataFrame, like the one written by write_to_csv.
 
-            # #
-            # print(id_number)
+        :param responses_df: DataFrame with the STUDENT_HEADINGS columns
+        followed by one column per question. Defaults to self.responses_df
+        :return: None
+        """
 
-            # add the concatenated ID back to the dictionary
-            student['OrgDefinedId'] = '#' + id_number
+        if responses_df is None:
+            responses_df = self.responses_df
 
-            # clean the 'form' heading
-            student['form'] = student.pop(str(self.form_fieldname))
+        ques_headings = [heading for heading in responses_df.columns
+                         if heading not in STUDENT_HEADINGS]
 
-            # remove  '[response]' from question heading keys
-            for question in self.ques_fieldnames:
-                # want to cut off the 'response' part of the heading
-                student[question[-len('[response] '):]] = student.pop(question)
+        num_students = len(responses_df)
 
-            # assemble individual student dictionaries into a new list
-            self.class_data.append(student)
+        def student_column(heading, default):
+            if heading in responses_df:
+                return responses_df[heading].fillna(default).to_numpy(
+                    dtype=object)
+            return np.full(num_students, default, dtype=object)
 
-            # #
-            # print('list length is %d' % len(self.class_data))
+        self.student_ids = student_column('OrgDefinedId', '')
+        self.student_names = student_column('name', '')
+        self.student_random_ids = student_column('random ID', 'none')
+        self.form_codes = encode_forms(student_column('form', ''))
+        self.response_masks = encode_response_masks(
+            responses_df[ques_headings].to_numpy())
+        self.response_codes = MASK_TO_CODE[self.response_masks]
 
-        # also remove '[response] ' from question headings list
-        short_ques_fieldnames = list()
+        self.ques_fieldnames = ques_headings
+        self.number_of_questions = len(ques_headings)
 
-        for question in self.ques_fieldnames:
-            # cut off the 'responses' part of the heading
-            short_ques_fieldnames.append(question[-len('[response] '):])
+    def observed_option_counts(self, form=None):
+        """Smallest number of options each question could have had: the
+        last answer letter anybody bubbled, or that the key uses. One OR
+        over the response masks of every column, so no prompting is needed
+        for questions where the answers speak for themselves.
 
-        # update the object question fieldnames heading list
-        self.ques_fieldnames = short_ques_fieldnames
+        Forms are scrambled, so pass a form letter to only count the
+        students who took that form (and that form's key). Counts never go
+        past the bubbles on the sheet (see OPTION_MASKS).
 
-    def match_roster_to_responses(self):
-        """ Method that matches names from roster to the submitted responses
-        pulled in from
-        FormScanner.
+        :param form: form letter, e.g. 'A', None for every student
+        :return: dict of question number => option count, 0 if nobody
+        answered the question
+        """
 
-        Gets student name from roster based on the OrgDefinedId field from
-        the response data.
-        If no student is found with matching ID, the student data is recorded
-        in a new list and the user is asked to identify the student using a
-        prompt.
+        # the matrix might not be populated if responses_df was set directly
+        if self.response_codes.size == 0:
+            self.load_responses_df()
+
+        students = np.ones(len(self.response_masks), dtype=bool)
+        if form is not None:
+            students = self.form_codes == encode_forms([form])[0]
+
+        marked = np.bitwise_or.reduce(self.response_masks[students], axis=0)
+
+        key_column = f'key{form} answer'
+        if form is not None and key_column in self.exam_keys_df:
+            if len(self.exam_keys_df) != len(marked):
+                raise ValueError(
+                    'key {} has {} questions but the scan data has {}'.format(
+                        form, len(self.exam_keys_df), len(marked)))
+            marked |= encode_response_masks(
+                self.exam_keys_df[[key_column]].to_numpy().T)[0]
+
+        # question numbers come from the FormScanner question names
+        ques_numbers = [int(re.search(r'(\d+)$', heading).group(1))
+                        for heading in self.ques_fieldnames]
+
+        return dict(zip(ques_numbers, MASK_LAST_OPTION[marked].tolist()))
+
+    def bubble_counts(self):
+        """Number of bubbles printed for each question on the sheet, from
+        the compiled FormScanner layout (see compile_formscanner_layout).
+
+        :return: dict of question number => bubbles on the sheet
+        """
+
+        bubbles = self.formscanner_layout.get(
+            'bubble counts', [len(OPTION_MASKS)] * len(self.ques_fieldnames))
+
+        ques_numbers = [int(re.search(r'(\d+)$', heading).group(1))
+                        for heading in self.ques_fieldnames]
+
+        return dict(zip(ques_numbers, bubbles))
+
+    def student_data_df(self):
+        """ DataFrame with the student columns that go along with each row
+        of the response matrix.
+
+        :return: DataFrame with the STUDENT_HEADINGS columns
+        """
 
+        return pd.DataFrame({'OrgDefinedId': self.student_ids,
+                             'random ID': self.student_random_ids,
+                             'form': FORM_LETTERS[self.form_codes],
+                             'name': self.student_names})
+
+    def get_responses_df(self):
+        """ Builds the formatted responses DataFrame from the response
+        matrix. Falls back on responses_df if the matrix was never populated.
+
+        :return: DataFrame with student columns followed by question columns
+        """
+
+        if self.response_codes.size == 0:
+            return self.responses_df.copy()
+
+        responses_df = pd.DataFrame(MASK_LETTERS[self.response_masks],
+                                    columns=self.ques_fieldnames)
+
+        return pd.concat([self.student_data_df(), responses_df], axis=1)
+
+    def join_roster_to_responses(self):
+        """ Matches the roster to the response ID array with a single
+        indexed (hash) join.
+
+        Names and random IDs are filled in for every matched bubblesheet.
+
+        :return: dict with 'matched' and 'unmatched responses' (rows of the
+        response matrix) and 'absent students' (roster IDs with no sheet)
+        """
+
+        roster_ids = np.array(list(self.id_to_name.keys()), dtype=object)
+        roster_names = np.array(list(self.id_to_name.values()), dtype=object)
+        roster_random_ids = np.array([self.id_to_randomid.get(roster_id,
+                                                              'none')
+                                      for roster_id in roster_ids],
+                                     dtype=object)
+
+        # roster row for every bubblesheet, -1 if the ID isn't on the roster
+        roster_rows = pd.Index(roster_ids).get_indexer(
+            self.student_ids.astype(object))
+        matched = roster_rows >= 0
+
+        self.student_names[matched] = roster_names[roster_rows[matched]]
+        self.student_random_ids[matched] = \
+            roster_random_ids[roster_rows[matched]]
+
+        turned_in = np.zeros(len(roster_ids), dtype=bool)
+        turned_in[roster_rows[matched]] = True
+
+        roster_match = {'matched': np.flatnonzero(matched),
+                        'unmatched responses': np.flatnonzero(~matched),
+                        'absent students': roster_ids[~turned_in]}
+
+        self.roster_match = roster_match
+
+        return roster_match
+
+    def apply_id_resolutions(self, resolutions):
+        """ Replaces mis-bubbled student IDs with the correct roster IDs.
+
+        :param resolutions: dict mapping the scanned ID to the roster ID
         :return: None
         """
 
-        # storage for rewritten list
-        temp_class_data_list = list()
+        if len(resolutions) == 0:
+            return
+
+        self.student_ids = pd.Series(self.student_ids, dtype=object).replace(
+            resolutions).to_numpy(dtype=object)
 
-        # list of students who provided incorrect student ID number
-        temp_no_id_match = list()
+    def auto_correct_ids(self):
+        """ Finds the roster ID for mis-bubbled student IDs that are one
+        digit off or have two neighbouring digits swapped.
 
-        # roster list with no matching responses
-        class_data_no_match = dict(self.id_to_name)
+        A sheet is only corrected if exactly one roster student within
+        that distance hasn't already turned in a sheet, and no other
+        unmatched sheet points at the same student.
 
-        for student in self.class_data:
+        :return: dict mapping the scanned ID to the roster ID
+        """
 
-            # get student ID from response data
-            student_id = student['OrgDefinedId']
+        if self.id_index is None:
+            self.id_index = StudentIdIndex(self.id_to_name.keys())
 
-            # convert id number from responses to student name
-            try:
-                student_name = self.id_to_name[student_id]
-            except KeyError:
-                # student_name = 'No matching name on roster.'
+        roster_match = self.join_roster_to_responses()
+        absent_students = set(roster_match['absent students'])
 
-                # add student to no match list
-                temp_no_id_match.append(student)
+        resolutions = dict()
 
-                # head back to the top of the for loop and skip the rest
-                continue
+        for row in roster_match['unmatched responses']:
+            scanned_id = self.student_ids[row]
 
-            # get random ID from student ID number
-            try:
-                student_random_id = self.id_to_randomid[student_id]
-            except KeyError:
-                student_random_id = 'none'
+            candidates = [roster_id for roster_id, distance
+                          in self.id_index.candidates(scanned_id,
+                                                      max_distance=1)
+                          if roster_id in absent_students]
 
-            # add data back to dictionary
-            student['name'] = student_name
-            student['random ID'] = student_random_id
+            if len(candidates) == 1:
+                resolutions[scanned_id] = candidates[0]
 
-            # add dictionary to temp list
-            temp_class_data_list.append(student)
+        # two different sheets can't belong to the same student
+        claimed = pd.Series(list(resolutions.values()), dtype=object)
+        duplicates = set(claimed[claimed.duplicated()])
+        resolutions = {scanned_id: roster_id
+                       for scanned_id, roster_id in resolutions.items()
+                       if roster_id not in duplicates}
 
-            # remove matched student from the no match list
-            try:
-                class_data_no_match.pop(student_id)
-            except NameError:
-                class_data_no_match[student_id] = 'id error'
-                continue
+        for scanned_id, roster_id in resolutions.items():
+            print('corrected ID {} to {} ({})'.format(
+                scanned_id, roster_id, self.id_to_name[roster_id]))
+
+        return resolutions
+
+    def match_roster_to_responses(self, resolutions_path=None,
+                                  interactive=True, auto_correct=True):
+        """ Method that matches names from roster to the submitted responses
+        pulled in from
+        FormScanner.
+
+        Gets student name from roster based on the OrgDefinedId field from
+        the response data, see join_roster_to_responses.
+        Mis-bubbled IDs are corrected from the resolutions file first, then
+        automatically where there is only one likely student (see
+        auto_correct_ids). If any sheets are still unmatched and
+        interactive is True the user is asked to identify the student using
+        a prompt, otherwise they are just reported so large batches can run
+        unattended.
+
+        :param resolutions_path: optional CSV file with 'scanned ID' and
+        'OrgDefinedId' columns. Interactive choices are appended to it.
+        :param interactive: prompt for IDs that are still unmatched
+        :param auto_correct: fix IDs that are one digit off or swapped
+        :return: dict from join_roster_to_responses
+        """
 
-        # rewrite the object class data list
-        self.class_data = temp_class_data_list
+        if resolutions_path is not None:
+            self.apply_id_resolutions(load_id_resolutions(resolutions_path))
+
+        if auto_correct:
+            self.apply_id_resolutions(self.auto_correct_ids())
+
+        roster_match = self.join_roster_to_responses()
+
+        unmatched_rows = roster_match['unmatched responses']
+        class_data_no_match_list = [
+            (student_id, self.id_to_name[student_id])
+            for student_id in roster_match['absent students']]
 
         # print out a list of students from the roster with no matching
         # response data
         print('\nThe following %d students have no matching response data '
               'from the exam:'
-              % len(class_data_no_match))
-
-        class_data_no_match_list = list(class_data_no_match.items())
+              % len(class_data_no_match_list))
 
         for index, no_match in enumerate(class_data_no_match_list):
             print(str(index) + ' - ' + str(no_match))
 
         # print out list of response sheets with no matching name
         print('\nThere are %d ID number(s) not associated with enrolled '
-              'students.\n'
-              'Please select the index beside the roster ID number that '
+              'students.' % len(unmatched_rows))
+
+        if self.id_index is None:
+            self.id_index = StudentIdIndex(self.id_to_name.keys())
+
+        # likely owners of each unmatched sheet, closest first
+        likely_students = {row: [roster_id for roster_id, distance in
+                                 self.id_index.candidates(
+                                     self.student_ids[row])]
+                           for row in unmatched_rows}
+
+        if not interactive or len(unmatched_rows) == 0:
+            for row in unmatched_rows:
+                print('    {} might be {}'.format(self.student_ids[row],
+                                                  likely_students[row]))
+
+            return roster_match
+
+        print('Please select the index beside the roster ID number that '
               'corresponds\n'
-              'to the correct student response ID and hit enter:'
-              % len(temp_no_id_match))
+              'to the correct student response ID and hit enter '
+              '(leave blank to skip):')
+
+        resolutions = dict()
 
         # select the correct value for the id
-        for no_match in temp_no_id_match:
-            matched_index = input(no_match['OrgDefinedId'] +
+        for row in unmatched_rows:
+            if len(likely_students[row]) > 0:
+                print('likely students: ' + ', '.join(likely_students[row]))
+
+            matched_index = input(str(self.student_ids[row]) +
                                   ' corresponds to: ')
+
+            if str(matched_index).strip() == '':
+                continue
+
             selected_student = class_data_no_match_list[int(matched_index)]
             print('\nyou selected: ' + str(selected_student))
             print('\n\n')
 
             # first tuple entry is the selected student ID number
-            no_match['OrgDefinedId'] = selected_student[0]
+            resolutions[self.student_ids[row]] = selected_student[0]
 
-            # second tuple entry is the selected student name
-            no_match['name'] = selected_student[1]
+        if resolutions_path is not None:
+            save_id_resolutions(resolutions_path, resolutions)
 
-            # add our missing student back to the class data
-            self.class_data.append(no_match)
+        self.apply_id_resolutions(resolutions)
+
+        return self.join_roster_to_responses()
 
     def write_to_csv(self, save_path):
         """ Method to output formatted data to a new CSV file.
 
-        Use 'data_headings' to specify what data you would like to output
-        to the
-        CSV file.
+        The student columns in STUDENT_HEADINGS are written first, followed
+        by the decoded responses for each question.
 
         :param save_path: directory path and desired CSV file name for
         saved file
         :return: None
         """
 
-        with open(save_path, 'w') as csvfile:
-
-            # data headings for the output file
-            data_headings = ['OrgDefinedId', 'random ID', 'form', 'name'] + \
-                             self.ques_fieldnames
+        self.get_responses_df().to_csv(save_path, index=False)
 
-            # use the list of column headings for the fieldnames
-            # extrasaction parameter determines what happens if key is in dict
-            # but not in fieldnames
-            writer = csv.DictWriter(csvfile, fieldnames=data_headings,
-                                    extrasaction='ignore')
-
-            # header row first, then the rest
-            writer.writeheader()
-            writer.writerows(self.class_data)
-
-    def ingest_exam_keys(self, keys=('keyA', 'keyB')):
+    def ingest_exam_keys(self, keys=('keyA', 'keyB'), key_paths=None,
+                         exam_keys=None):
         """Convert the pdf keys from testgen into a pandas dataframe
         representation.
 
-        :param: the keys parameter is used for testing
+        :param: keys is a tuple of key names, one per exam form, e.g.
+        ('keyA', 'keyB', 'keyC'). Also used for testing
+        :param key_paths: pdf path for each key, by default the paths come
+        from roster_data_path
+        :param exam_keys: (question number, answer) tables that were
+        already parsed, one per key. The pdfs aren't read when given
         :return: returns the DataFrame with exam answer keys
         """
 
         raw_data = list()
 
-        # regular expression pattern
-        pattern = re.compile(r'(\d+)\. ([A-Z, ]+)')
+        # only need the answer pages if we already know the exam length
+        expected_questions = self.number_of_questions or None
 
-        for key in keys:
-            exam_key = convert_pdf_to_txt(self.roster_data_path(key))
+        # keys are parsed in parallel and cached on disk, see key_functions
+        if key_paths is None:
+            key_paths = [self.roster_data_path(key) for key in keys]
 
-            raw_frame = pd.DataFrame(pattern.findall(exam_key), columns=(
+        if exam_keys is None:
+            exam_keys = read_exam_keys(key_paths,
+                                       expected_questions=expected_questions)
+
+        for key, exam_key in zip(keys, exam_keys):
+            raw_frame = pd.DataFrame(exam_key, columns=(
                 'ques number', f'{key} answer'))
 
             # store all the data as a list
             raw_data.append(raw_frame)
 
-        # merge the key data into a new dataframe
-        raw_data_frame = pd.merge(raw_data[0], raw_data[1], on='ques number')
+        # merge the key data for every form into a new dataframe
+        raw_data_frame = raw_data[0]
+        for raw_frame in raw_data[1:]:
+            raw_data_frame = pd.merge(raw_data_frame, raw_frame,
+                                      on='ques number')
 
         raw_data_frame.set_index('ques number')
         self.exam_keys_df = raw_data_frame
 
         return raw_data_frame
 
-    def get_num_of_ques(self):
-        """Number of questions in the test. Requires formscanner data cleaned
-        first.
+    def exam_key_matrix(self):
+        """Encodes every '<key> answer' column of exam_keys_df into a key
+        matrix. The form letter is the last letter of the key name, so
+        'keyA' and 'test_keyA' both grade form A.
 
-        :return:
+        :return: tuple (key_masks, key_forms) where key_masks is a
+        (forms x questions) array of option masks and key_forms is the array
+        of form codes for each row
         """
 
-        return int(self.number_of_questions)
+        key_columns = [column for column in self.exam_keys_df.columns
+                       if re.search(r'[A-Z] answer$', column)]
 
-    def get_root_dir(self):
-        """Gets the current root directory
-        """
+        key_forms = encode_forms([column[-len('A answer')]
+                                  for column in key_columns])
 
-        return self.project_root_dir
+        key_masks = encode_response_masks(
+            self.exam_keys_df[key_columns].to_numpy().T)
 
-    # todo: this code needs to be more fully integrated into class
-    def grade_exam(self):
-        """Custom grading code
-        """
-        # todo: Need to check for state variables present
+        self.number_of_forms = len(key_columns)
 
-        responses_df = self.responses_df
+        return key_masks, key_forms
 
-        # convert to numpy array for manipulation ease
-        responses_np = responses_df.to_numpy()
+    def select_student_keys(self, key_masks, key_forms):
+        """Picks the key used to grade each student from the bubbled form.
 
-        # create a new array that just includes response data
-        stripped_responses_np = responses_np[:, 4:]
+        Students who didn't bubble a form that matches one of the keys are
+        graded against whichever key gives them the most correct answers.
 
-        # probably a better way to do this but it will work with existing
-        exam_key_a = self.exam_keys_df['keyA answer'].to_numpy()
-        exam_key_b = self.exam_keys_df['keyB answer'].to_numpy()
+        :param key_masks: (forms x questions) key matrix
+        :param key_forms: form code for each row of key_masks
+        :return: array with the row of key_masks for each student
+        """
 
-        # might as well just score each test against both keys
-        exam_keys = (exam_key_a, exam_key_b)
+        # lookup table from form code to key row, -1 if there is no key
+        form_to_key = np.full(len(FORM_LETTERS), -1, dtype=np.intp)
+        form_to_key[key_forms] = np.arange(len(key_forms))
 
-        # list to contain scored arrays
-        scored_arrays = []
+        key_index = form_to_key[self.form_codes]
 
-        # check each item against the key for both keys
-        for key in exam_keys:
-            scored = key == stripped_responses_np
-            scored_arrays.append(scored)
+        # fall back on the best key for students without a usable form
+        unknown_form = key_index < 0
 
-        # total number of test takers (using first scored array)
-        # num_test_takers = m_scored.shape[0]
-        num_test_takers = scored_arrays[0].shape[0]
-        print('{} examinees total.\n'.format(num_test_takers))
+        form_inference_df = self.infer_forms(key_masks, key_forms)
+        inferred_index = form_to_key[encode_forms(
+            form_inference_df['inferred form'])]
 
-        # number of test items (questions)
-        num_questions = scored_arrays[0].shape[1]
-        print('{} questions total\n'.format(num_questions))
+        key_index[unknown_form] = inferred_index[unknown_form]
 
-        num_correct_arrays = []
+        num_mismatches = form_inference_df['form mismatch'].sum()
+        if num_mismatches > 0:
+            print('{} bubbled form(s) disagree with the inferred form, see '
+                  'form_inference_df\n'.format(num_mismatches))
 
-        # number of items each student gets correct, in array format
-        for scored in scored_arrays:
-            num_correct_array = scored.sum(axis=1, keepdims=True)
-            num_correct_arrays.append(num_correct_array)
+        return key_index
 
-        # ------- select the exams scored against best key --------#
+    def infer_forms(self, key_masks=None, key_forms=None):
+        """Works out which form each student most likely took, whatever was
+        bubbled.
 
-        # scored_exam_np = np.array([])
+        Responses and keys are one-hot encoded so a single matrix product
+        gives the number of agreements between every student and every key.
 
-        # Take the array scored against form A and multiply with the bool
-        # array that compares total score of A against B then repeat for B.
-        #
-        # This selects the row with best total score from two keys and then
-        # inserts it into the scored_exam_np array.
-        scored_exam_np = (scored_arrays[0] *
-                          (num_correct_arrays[0] >= num_correct_arrays[1])
-                          +
-                          scored_arrays[1] *
-                          (num_correct_arrays[0] < num_correct_arrays[1])
-                          )
+        :param key_masks: (forms x questions) key matrix, defaults to the
+        keys in exam_keys_df
+        :param key_forms: form code for each row of key_masks
+        :return: DataFrame with the bubbled form, inferred form, margin over
+        the runner up key and a flag for students whose bubble disagrees
+        """
 
-        # probably redundant sum of correct responses
-        number_correct_np = scored_exam_np.sum(axis=1, keepdims=True)
+        if key_masks is None:
+            key_masks, key_forms = self.exam_key_matrix()
 
-        # todo: might add a method to drop specific questions
-        # percent correct, then rounded to integer
-        percent_correct_np = (number_correct_np / int(num_questions) * 100)
-        percent_correct_np = percent_correct_np.round(decimals=0)
+        # multi-marked responses can't tell us anything about the form
+        single_masks = np.where(single_marks(self.response_codes),
+                                self.response_masks, 0)
 
-        # note that these results are saved as integer values
-        scores_df = pd.DataFrame(np.hstack((number_correct_np,
-                                            percent_correct_np)),
-                                 columns=['number correct',
-                                          'percent correct'],
-                                 dtype='int')
+        # (students x forms) number of answers that agree with each key
+        agreement = (one_hot_masks(single_masks) @
+                     one_hot_masks(key_masks).T)
 
-        # -------------- save scored exam array to class ------------- #
+        best_key = agreement.argmax(axis=1)
+        inferred_forms = key_forms[best_key]
 
-        # first need to grab the column titles for questions
-        responses_headings = len(list(responses_df))
-        ques_headings = list(responses_df)[(responses_headings -
-                                            num_questions):]
-        student_data_headings = list(responses_df)[:-num_questions]
-        # then convert to pandas dataframe
-        scored_exam_df = pd.DataFrame(scored_exam_np, columns=ques_headings)
-        # finally combine student data with it
-        scored_exam_df = pd.concat([responses_df[student_data_headings],
-                                    scored_exam_df],
-                                   axis=1)
-        # tack on the scores
-        scored_exam_df = pd.concat([scored_exam_df, scores_df],
-                                   axis=1)
+        # how far ahead the best key is of the next best one
+        ranked_agreement = np.sort(agreement, axis=1)
+        if len(key_forms) > 1:
+            margin = ranked_agreement[:, -1] - ranked_agreement[:, -2]
+        else:
+            margin = ranked_agreement[:, -1]
 
-        # update the state variable
-        self.scored_exam_df = scored_exam_df
+        form_mismatch = ((self.form_codes != 0) &
+                         (self.form_codes != inferred_forms))
 
-        # --------------------- old code ------------------------------ #
+        form_inference_df = pd.DataFrame(
+            {'OrgDefinedId': self.student_ids,
+             'bubbled form': FORM_LETTERS[self.form_codes],
+             'inferred form': FORM_LETTERS[inferred_forms],
+             'margin': margin.astype(int),
+             'form mismatch': form_mismatch})
 
-        # array containing number of correct answers graded against each key
-        # correct_for_key_a_and_key_b = np.hstack((num_correct_arrays[0],
-        #                                          num_correct_arrays[1]))
-        # print('Array of number correct for each key:\n'
-        #       '{}\n'.format(correct_for_key_a_and_key_b))
+        self.form_inference_df = form_inference_df
 
-        # grab the largest number of correct items between keys
-        # max_number_correct = correct_for_key_a_and_key_b.max(axis=1)
-        # print('Array of max number of correct answers:\n'
-        #       '{}\n'.format(max_number_correct))
+        return form_inference_df
 
-        # scores_arrays = []
+    def analyze_items(self, group_fraction=None):
+        """Classical item analysis of the scored matrix, see
+        item_statistics and reliability_statistics. The results are saved to
+        item_analysis_df with a row per statistic and a column per question,
+        and the reliability of the whole test to test_statistics. Dropped
+        questions don't count and their statistics are NaN.
 
-        # percent correct for each element in the array
-        # an array of scores for each test taker
-        # for num_correct in num_correct_arrays:
-        #     scores_array = num_correct / num_questions * 100
-        #     scores_arrays.append(scores_array)
-        #     print('Percent correct array:\n{}\n'.format(scores_array))
+        :param group_fraction: fraction of students in each of the upper and
+        lower groups used for discrimination, None splits at the median
+        :return: the item_analysis_df DataFrame
+        """
 
-        # another array with scores from both forms
-        # scores_for_key_a_and_key_b = np.hstack((scores_arrays[0],
-        #                                         scores_arrays[1]))
-        # best score of the forms
-        # max_scores = scores_for_key_a_and_key_b.max(axis=1)
+        # dropped questions are left out and get NaN statistics
+        counted = self.counted_items()
+        counted_matrix = self.scored_matrix[:, counted]
 
-        # this is a really weird approach to finding the max value
-        # create new array with scores for each key
-        # stacked_scores = np.hstack((scores_arrays[0], scores_arrays[1]))
+        statistics = item_statistics(counted_matrix, group_fraction)
+        reliability = reliability_statistics(counted_matrix)
 
-        # make a boolean mask to find largest value
-        # key_a_mask = scores_arrays[0] > scores_arrays[1]
+        statistics['alpha if deleted'] = reliability.pop('alpha if deleted')
+        self.test_statistics = {name: float(value)
+                                for name, value in reliability.items()}
 
-        # invert mask for key B
-        # key_b_mask = key_a_mask.copy()
+        item_analysis_df = pd.DataFrame(
+            {name: self.expand_counted_items(values)
+             for name, values in statistics.items()},
+            index=self.ques_fieldnames).T
 
-        # use bitwise xor to flip boolean values
-        # key_b_mask ^= True
+        self.item_analysis_df = item_analysis_df
 
-        # now sum the product of masks and data, but ignore last two rows (keys)
-        # number_correct_np = (key_a_mask * scores_arrays[0] + key_b_mask *
-        #                      scores_arrays[1])
+        return item_analysis_df
 
-        # use the key masks to only collect the best responses to questions
-        # assumes last two rows are keys and disregards them in calculation
-        # best_answers_array = (key_a_mask * scored_arrays[0] +
-        #                       key_b_mask * scored_arrays[1])
+    def counted_items(self):
+        """Columns of the scored matrix that still count, dropped
+        questions are left out of the item and distractor analyses.
 
-        # sums over columns to get number of times question answered correctly
-        correct_per_question_array = scored_exam_np.sum(axis=0,
-                                                        keepdims=True)
-        print('Number of times each question answered '
-              'correctly:\n{}\n'.format(correct_per_question_array))
+        :return: boolean array, one per question
+        """
 
-        # median score for test takers
-        median_score = np.median(number_correct_np)
-        print('The median exam score is {}\n'.format(median_score))
+        number_of_questions = self.scored_matrix.shape[1]
 
-        # ----------------- item analysis ------------------------- #
+        counted = np.ones(number_of_questions, dtype=bool)
+        counted[[self.question_index(ques_number, number_of_questions)
+                 for ques_number in self.dropped_items]] = False
 
-        # top performer mask
-        top_array_mask = number_correct_np >= median_score
-        # print('examinees who scored greater than or equal to median:\n'
-        #       '{}\n'.format(top_array_mask))
-
-        # number of top performing students
-        num_top_scorers = top_array_mask.sum()
-        print('{} top performers\n'.format(num_top_scorers))
-
-        # bottom performer mask
-        bottom_array_mask = number_correct_np < median_score
-        # print('bottom examinees mask:\n{}\n'.format(bottom_array_mask))
-
-        # number of bottom performing students
-        num_bottom_scorers = bottom_array_mask.sum()
-        print('{} bottom performers\n'.format(num_bottom_scorers))
-
-        # data for examinees with top 50% score
-        # top_array = top_array_mask * number_correct_np
-        # print('top examinees array:\n{}\n'.format(top_array))
-
-        # data for examinees with bottom 50% score
-        # bottom_array = bottom_array_mask * number_correct_np
-        # print('bottom examinees array:\n{}\n'.format(bottom_array))
-
-        # todo: issues in here, have to hit it later
-        # correct questions for top performers
-        # num_correct_top_array = top_array.sum(axis=1, keepdims=True)
-        # print('Number of correct answers for top performers:\n'
-        #       '{}\n'.format(num_correct_top_array))
-
-        # correct questions for bottom performers
-        # num_correct_bottom_array = bottom_array.sum(axis=1, keepdims=True)
-        # print('Number of correct answers for bottom performers:\n'
-        #       '{}\n'.format(num_correct_bottom_array))
-
-        # array of discrimination values for each question
-        # item_discrimination_array = ( (num_correct_top_array -
-        #                               num_correct_bottom_array) /
-        #                               num_top_scorers )
-        # print('array of item discrimination values:\n'
-        #       '{}\n'.format(item_discrimination_array))
-
-        # dataframe for the discrimination results (to make combining easier)
-        # naming the `index` means I'll have a row heading
-        # item_discrimination_frame = \
-        #     pd.DataFrame(item_discrimination_array,
-        #                  columns=responses_df.columns[4:],
-        #                  index=['item discrimination'])
-
-        # the size of the `number_correct_np` lets us know how many test takers
-        # item_difficulty_array = \
-        #     correct_per_question_array / num_test_takers * 100
-        # print('Array of item difficulty percentages:\n'
-        #       '{}'.format(item_difficulty_array))
-
-        # dataframe version
-        # item_difficulty_frame = pd.DataFrame(item_difficulty_array,
-        #                                      columns=responses_df.columns[3:],
-        #                                      index=['item difficulty'])
-        #
-        # item_analysis_frame = pd.concat([item_difficulty_frame,
-        #                                  item_discrimination_frame])
-
-        # save this to the state of the object
-        # self.item_analysis_df = item_analysis_frame
-
-        # code to export csv file with item analysis data
-        # item_analysis_frame.to_csv('~/item_analysis.csv')
+        return counted
 
-        # todo: might want to keep all of the data generated in an array
-        # for each student or some other place for later analysis
+    def expand_counted_items(self, values):
+        """Puts per question results for the counted questions back in
+        their columns, with NaN for the dropped questions.
 
-        # todo: same analysis for exam distractors
+        :param values: (..., counted questions) array
+        :return: (..., questions) float array
+        """
 
-        # export to csv file that doesn't include an index column
-        # scored_exam_data[['OrgDefinedId', 'score']].to_csv(
-        #                     '~/Desktop/graded exams and ID numbers.csv',
-        #                     index=False)
+        values = np.asarray(values, dtype=float)
+        counted = self.counted_items()
 
-        return True
+        expanded = np.full(values.shape[:-1] + counted.shape, np.nan)
+        expanded[..., counted] = values
+
+        return expanded
+
+    def bootstrap_item_analysis(self, replicates=2000, confidence=0.95,
+                                seed=0, processes=None, group_fraction=None):
+        """Bootstrap confidence intervals for the item analysis and the
+        reliability, see bootstrap_intervals. Item intervals are saved to
+        item_confidence_df (a ('statistic', 'lower'/'upper') row per bound
+        and a column per question), test intervals to test_confidence_df.
 
-    # todo: would be better to save state to sqlite db
-    def save_state_to_db(self):
-        """Method saves current state to shelve database for easy reuse
+        :param replicates: number of bootstrap resamples
+        :param confidence: coverage of the percentile intervals
+        :param seed: same seed gives the same intervals
+        :param processes: number of worker processes, None for one per CPU
+        :param group_fraction: see score_groups
+        :return: tuple (item_confidence_df, test_confidence_df)
         """
 
-        # tuple containing state variables you'd like to save
-        state_variables = {'roster_df': self.roster_df,
-                           'exam_keys_df': self.exam_keys_df,
-                           'scored_exam_df': self.scored_exam_df,
-                           'item_analsis_df': self.item_analysis_df,
-                           'responses_df': self.responses_df}
+        intervals = bootstrap_intervals(
+            self.scored_matrix[:, self.counted_items()], replicates,
+            confidence, seed, processes, group_fraction)
+
+        test_names = ['alpha', 'standard error of measurement']
+        item_names = [name for name in intervals if name not in test_names]
+
+        item_rows = pd.MultiIndex.from_product([item_names,
+                                                ['lower', 'upper']])
+        self.item_confidence_df = pd.DataFrame(
+            np.concatenate([self.expand_counted_items(intervals[name])
+                            for name in item_names]),
+            index=item_rows, columns=self.ques_fieldnames)
+
+        self.test_confidence_df = pd.DataFrame(
+            [intervals[name] for name in test_names],
+            index=test_names, columns=['lower', 'upper'])
+
+        return self.item_confidence_df, self.test_confidence_df
+
+    def analyze_distractors(self, form=None, group_fraction=0.27):
+        """Distractor analysis: how often each option was picked by the
+        lower, middle and upper scoring groups for every question.
+
+        Scrambled forms put different questions in the same column, so
+        with more than one key the students are split by the key they were
+        graded with and each form gets its own table, scored groups and
+        keyed options. Dropped questions are left out.
+
+        :param form: form letter, e.g. 'A', to only look at the students
+        who bubbled it. None for every student
+        :param group_fraction: fraction of students in each of the upper
+        and lower groups, see score_groups
+        :return: DataFrame indexed by (question, option) with the counts
+        for each group, the selection rate, the option discrimination and
+        whether the option is keyed. Indexed by (form, question, option)
+        when form is None and more than one key was used
+        """
 
-        with shelve.open('saved state') as db:
-            for variable_name, state_variable in state_variables.items():
-                # todo: needs something to catch error
-                db[variable_name] = state_variable
+        key_rows = np.unique(self.key_index)
 
-        return
+        # dropped questions are left out of the table and the totals
+        counted = self.counted_items()
+        codes = self.response_codes[:, counted]
+        credit = self.scored_matrix[:, counted]
+        key_masks = self.key_masks[:, counted]
+        fieldnames = [fieldname for fieldname, keep
+                      in zip(self.ques_fieldnames, counted) if keep]
 
-    def get_state_from_db(self):
-        """Method loads last saved state to class variables
-        """
-        pass
+        if form is not None or len(key_rows) <= 1:
+            students = np.ones(len(self.response_codes), dtype=bool)
+            if form is not None:
+                students = self.form_codes == encode_forms([form])[0]
 
-    def change_root_dir(self, project_root_dir):
-        """Method changes the project root directory from the initilization
-        value to the new path
-        """
+            # options that earn credit for the students in this analysis
+            student_keys = np.unique(self.key_index[students])
+            keyed_masks = (key_masks[student_keys[0]]
+                           if len(student_keys) == 1 else None)
 
-        # todo: check to ensure that value passed is actually valid path
-        self.project_root_dir = project_root_dir
+            distractor_analysis_df = distractor_table(
+                codes[students], credit[students].sum(axis=1), keyed_masks,
+                fieldnames, group_fraction)
 
-        return
+        else:
+            key_forms = self.exam_key_matrix()[1]
 
-    def roster_data_path(self, desired_path):
-        """Helper function that generates a path to the class roster, exam
-        data, and exam keys.
-        :param desired_path: 'roster', 'data', 'keyA', 'keyB'
-        :return:
-        """
-        # use project root directory for relative paths
-        root_dir = self.project_root_dir
+            distractor_analysis_df = pd.concat(
+                {FORM_LETTERS[key_forms[key_row]]: distractor_table(
+                    codes[self.key_index == key_row],
+                    credit[self.key_index == key_row].sum(axis=1),
+                    key_masks[key_row], fieldnames, group_fraction)
+                 for key_row in key_rows},
+                names=['form'])
 
-        # directory path to exam keys
-        if (desired_path == 'keyA' or
-                desired_path == 'keyB' or
-                desired_path == 'test_keyA' or
-                desired_path == 'test_keyB'):
+        self.distractor_analysis_df = distractor_analysis_df
 
-            keys_data_path = os.path.join(root_dir, 'exam keys/',
-                                          f'{desired_path}.pdf')
+        return distractor_analysis_df
 
-            return keys_data_path
+    def calibrate_irt(self, model='2pl', **fit_options):
+        """Fits a Rasch or 2PL model to the scored matrix, see
+        irt_functions.fit_irt_model. Item parameters are saved to
+        item_parameters_df (a row per question) and abilities to
+        abilities_df (a row per student).
 
-        elif desired_path is 'data':
-            exam_data_path = os.path.join(root_dir,
-                                          '4-python scripts/results/',
-                                          'scanned bubblesheets '
-                                          'formatted.csv')
-            return exam_data_path
-        elif desired_path is 'roster':
-            # course roster dictionary
-            rosters = {'1401_6303': 'PHYS-1401 6303 roster.csv',
-                       '1410_6301': 'PHYS-1410 6301 roster.csv'}
+        :param model: 'rasch' or '2pl'
+        :param fit_options: passed on to fit_irt_model
+        :return: the fit_irt_model result dict
+        """
 
-            course_number, roster_file_name = list_picker(rosters)
+        result = fit_irt_model(self.scored_matrix, model, **fit_options)
 
-            # get the path from the course number
-            # assuming that data directory is above current working directory
-            roster_file_path = os.path.join(root_dir, '4-python scripts/data/',
-                                            roster_file_name)
+        if not result['converged']:
+            print('IRT calibration did not converge after {} '
+                  'iterations\n'.format(result['iterations']))
 
-            return roster_file_path
+        self.item_parameters_df = result['items'].set_axis(
+            self.ques_fieldnames, axis=0)
 
-        return
+        abilities_df = result['abilities']
+        abilities_df.insert(0, 'OrgDefinedId', self.student_ids)
+        self.abilities_df = abilities_df
 
-    def to_d2l_gradebook(self):
-        """Method creates a csv file that can be directly imported into the
-        D2L gradebook.
-        """
+        self.test_statistics['ability sd'] = result['ability sd']
+        self.test_statistics['irt log likelihood'] = result['log likelihood']
 
-        # get copy of scores from state
-        scored_exam_df = self.scored_exam_df.copy()
+        return result
 
-        # add required end of line indicator
-        scored_exam_df['End-of-Line Indicator'] = '#'
+    def question_index(self, ques_number, number_of_questions=None):
+        """Column of a question number from the scoring_rules, item_weights
+        or dropped_items settings.
 
-        # todo: this is a hack, needs to be passed to method instead
-        # rename percent correct to the proper exam name
-        scored_exam_df = scored_exam_df.rename(index=str,
-                                               columns={'percent correct':
-                                                        'exam 2 Points Grade'})
+        :param ques_number: question number, 1 is the first question
+        :param number_of_questions: defaults to the response matrix width
+        :return: column index
+        """
 
-        # export to csv file that doesn't include an index column
-        scored_exam_df[['OrgDefinedId',
-                        'exam 2 Points Grade',
-                        'End-of-Line Indicator']].to_csv(
-            '~/Downloads/graded exams and ID numbers.csv', index=False)
+        if number_of_questions is None:
+            number_of_questions = self.response_masks.shape[1]
 
-        return
+        # 0 would wrap around to the last question instead of failing
+        if not 1 <= int(ques_number) <= number_of_questions:
+            raise ValueError('question {} is not on the exam, questions are '
+                             'numbered 1 to {}'.format(ques_number,
+                                                       number_of_questions))
 
-    def to_d2l_feedback(self):
-        """Method creates a csv file that can be imported into d2l as student
-        feedback"""
-
-        responses_df = self.responses_df.copy()
-        # drop unused columns that aren't necessary
-        responses_df.drop(columns=['form', 'name', 'random ID'],
-                          inplace=True)
-        # dataframe for the scored data.
-        scored_exam_df = self.scored_exam_df.copy()
-        scored_exam_df.drop(columns=['form', 'name', 'random ID'],
-                            inplace=True)
-
-        # list of column headings for use parsing below
-        responses_df_headings = list(responses_df)
-        scored_exam_df_headings = list(scored_exam_df)
-
-        # I got an error if I didn't initialize these new columns
-        responses_df['responses'] = ''
-        scored_exam_df['scored'] = ''
-
-        # I use this to know when the loop is at last question, for formatting
-        num_items = len(responses_df_headings) - 2
-
-        # make sure to use 'fillna()' otherwise missing data screws it up
-        for dummy, heading in enumerate(responses_df_headings[1:]):
-            if dummy < num_items:
-                responses_df['responses'] += (
-                        responses_df[heading].fillna('-') + ', ')
-                responses_df.drop(columns=heading, inplace=True)
-            else:
-                responses_df['responses'] += (
-                    responses_df[heading].fillna('-'))
-                responses_df.drop(columns=heading, inplace=True)
-
-        # need to change the names in order for clean d2l import
-        responses_df = (
-            responses_df.rename(index=str,
-                                columns={'responses':'exam 2 responses Text '
-                                         'Grade'}))
-
-        # d2l formatting and export
-        responses_df['End-of-Line Indicator'] = '#'
-        responses_df.to_csv(
-            '~/Downloads/graded exams and ID numbers.csv', index=False)
-
-        num_items = len(scored_exam_df_headings) - 2
-
-        for dummy, heading in enumerate(scored_exam_df_headings[1:]):
-
-            # this is annoying but I needed string type for export
-            scored_exam_df = scored_exam_df.astype({heading: 'int'}, copy=False)
-            scored_exam_df = scored_exam_df.astype({heading: 'str'}, copy=False)
-
-            if dummy < num_items:
-                scored_exam_df['scored'] += (
-                        scored_exam_df[heading] + ', ')
-                scored_exam_df.drop(columns=heading, inplace=True)
-            else:
-                # the last item is actually the percent score
-                scored_exam_df['scored'] += (scored_exam_df[heading] + '%')
-                scored_exam_df.drop(columns=heading, inplace=True)
-
-        scored_exam_df = (
-            scored_exam_df.rename(index=str,
-                                  columns={'scored': 'exam 2 points Text '
-                                                     'Grade'}))
-
-        scored_exam_df['End-of-Line Indicator'] = '#'
-        scored_exam_df.to_csv(
-            '~/Downloads/scored exams and ID numbers.csv', index=False)
+        return int(ques_number) - 1
 
-        return
+    def scoring_rule_array(self):
+        """Scoring rule for every question, from the scoring_rules dict.
 
+        :return: array of rule names, one per question
+        """
 
-""" Helper functions
+        rules = np.full(self.response_masks.shape[1], 'any', dtype=object)
 
-These are useful functions for carrying out the steps required to scan a
-bubblesheet graded exam.
-"""
+        for ques_number, rule in self.scoring_rules.items():
+            if rule not in SCORING_RULES:
+                raise ValueError('unknown scoring rule {} for question '
+                                 '{}'.format(rule, ques_number))
+            rules[self.question_index(ques_number)] = rule
 
+        return rules
 
-def create_dir():
-    """ Function that takes the exam directory path copied to the clipboard
-    and generates the additional directory structure required to process
-    exam data. User must copy the correct path to the clipboard *before*
-    running this part of the script.
+    def item_weight_array(self):
+        """Points for every question, from the item_weights dict.
+
+        :return: float array of points, one per question
+        """
+
+        weights = np.ones(self.response_masks.shape[1])
+
+        for ques_number, points in self.item_weights.items():
+            weights[self.question_index(ques_number)] = points
+
+        # dropped questions aren't worth anything
+        for ques_number in self.dropped_items:
+            weights[self.question_index(ques_number)] = 0
+
+        return weights
+
+    def get_num_of_ques(self):
+        """Number of questions in the test. Requires formscanner data cleaned
+        first.
+
+        :return:
+        """
+
+        return int(self.number_of_questions)
+
+    def get_root_dir(self):
+        """Gets the current root directory
+        """
+
+        return self.project_root_dir
+
+    def build_scored_exam_df(self, number_correct, percent_correct):
+        """Combines the student data, the scored matrix and the totals
+        into scored_exam_df.
+
+        :param number_correct: points earned by each student
+        :param percent_correct: percent score for each student
+        :return: the new scored_exam_df
+        """
+
+        # whole numbers unless partial credit or weights were used
+        number_correct = np.asarray(number_correct, dtype=float).round(
+            decimals=2)
+        if np.all(number_correct == number_correct.round()):
+            number_correct = number_correct.astype(int)
+
+        # note that percent scores are saved as integer values
+        scores_df = pd.DataFrame({'number correct': number_correct,
+                                  'percent correct':
+                                      np.asarray(percent_correct).astype(int)})
+
+        scored_exam_df = pd.concat([self.student_data_df(),
+                                    pd.DataFrame(self.scored_matrix,
+                                                 columns=self.ques_fieldnames),
+                                    scores_df],
+                                   axis=1)
+
+        self.scored_exam_df = scored_exam_df
+
+        return scored_exam_df
+
+    def correct_exam_keys(self, key_corrections):
+        """Fixes answers that are wrong in the pdf keys.
+
+        :param key_corrections: dict of key name => {question number:
+        answer}, e.g. {'keyA': {12: 'C'}}
+        :return: the corrected exam_keys_df
+        """
+
+        for key, corrections in key_corrections.items():
+            for ques_number, answer in corrections.items():
+                ques_rows = (self.exam_keys_df['ques number'] ==
+                             str(ques_number))
+                self.exam_keys_df.loc[ques_rows, f'{key} answer'] = answer
+
+        return self.exam_keys_df
+
+    def regrade(self, dropped_items=(), key_corrections=None):
+        """Updates a graded exam after questions are dropped or rekeyed,
+        without grading it again. Only the scored matrix columns of the
+        changed questions are rescored, the totals are adjusted by the
+        difference, and the item and distractor analyses are refreshed the
+        next time they are looked at.
+
+        :param dropped_items: question numbers that no longer count
+        :param key_corrections: see correct_exam_keys
+        :return: array of the question numbers that changed
+        """
+
+        # the state database keeps the keys but not the key matrix
+        if self.key_masks.size == 0:
+            self.key_masks, key_forms = self.exam_key_matrix()
+            self.key_index = self.select_student_keys(self.key_masks,
+                                                      key_forms)
+
+        old_weights = self.item_weight_array()
+        old_key_masks = self.key_masks
+
+        dropped_items = [int(ques) for ques in dropped_items]
+
+        remaining_weights = old_weights.copy()
+        remaining_weights[[ques - 1 for ques in dropped_items]] = 0
+        if remaining_weights.sum() <= 0:
+            raise ValueError('dropping questions {} leaves no points on the '
+                             'exam'.format(dropped_items))
+
+        self.dropped_items.update(dropped_items)
+
+        if key_corrections:
+            self.correct_exam_keys(key_corrections)
+            self.key_masks, key_forms = self.exam_key_matrix()
+
+        new_weights = self.item_weight_array()
+
+        changed = np.flatnonzero(
+            (old_weights != new_weights) |
+            (old_key_masks != self.key_masks).any(axis=0))
+
+        if changed.size == 0:
+            return changed + 1
+
+        # state loaded from a snapshot is read only and has no totals
+        if not self.scored_matrix.flags.writeable:
+            self.scored_matrix = self.scored_matrix.copy()
+        if self.total_points.shape != (len(self.scored_matrix),):
+            self.total_points = self.scored_matrix @ old_weights
+
+        # gather only the changed columns of each student's key
+        new_scores = score_responses(
+            self.response_masks[:, changed],
+            self.key_masks[:, changed][self.key_index],
+            self.scoring_rule_array()[changed])
+
+        self.total_points = self.total_points + (
+            new_scores @ new_weights[changed] -
+            self.scored_matrix[:, changed] @ old_weights[changed])
+        self.scored_matrix[:, changed] = new_scores
+
+        percent_correct = (self.total_points / new_weights.sum() *
+                           100).round(decimals=0)
+
+        number_correct = self.total_points.round(decimals=2)
+        if np.all(number_correct == number_correct.round()):
+            number_correct = number_correct.astype(int)
+
+        # a snapshot loaded without frames has no scored_exam_df yet
+        if self.scored_exam_df.empty:
+            self.build_scored_exam_df(number_correct, percent_correct)
+        else:
+            changed_fieldnames = [self.ques_fieldnames[column]
+                                  for column in changed]
+            self.scored_exam_df[changed_fieldnames] = new_scores
+            self.scored_exam_df['number correct'] = number_correct
+            self.scored_exam_df['percent correct'] = \
+                percent_correct.astype(int)
+
+        self._stale_analyses.update(('items', 'distractors'))
+
+        print('Regraded questions {}, the median exam score is now '
+              '{}\n'.format((changed + 1).tolist(),
+                             np.median(self.total_points)))
+
+        return changed + 1
+
+    # todo: this code needs to be more fully integrated into class
+    def grade_exam(self):
+        """Custom grading code
+        """
+        # todo: Need to check for state variables present
+
+        # the matrix might not be populated if responses_df was set directly
+        if self.response_codes.size == 0:
+            self.load_responses_df()
+
+        stripped_responses_np = self.response_masks
+
+        # one row per form in the exam keys
+        key_masks, key_forms = self.exam_key_matrix()
+
+        # row of key_masks used to grade each student
+        key_index = self.select_student_keys(key_masks, key_forms)
+
+        self.key_masks = key_masks
+        self.key_index = key_index
+
+        # total number of test takers
+        num_test_takers = stripped_responses_np.shape[0]
+        print('{} examinees total.\n'.format(num_test_takers))
+
+        # number of test items (questions)
+        num_questions = stripped_responses_np.shape[1]
+        print('{} questions total\n'.format(num_questions))
+
+        # gather each student's key in one go and score with bitwise ops,
+        # this is the credit (0 to 1) earned on each item
+        scored_exam_np = score_responses(stripped_responses_np,
+                                         key_masks[key_index],
+                                         self.scoring_rule_array())
+
+        # points earned for each student
+        item_weights = self.item_weight_array()
+        if item_weights.sum() <= 0:
+            raise ValueError('the exam is worth no points, check '
+                             'item_weights and dropped_items')
+        number_correct_np = (scored_exam_np @ item_weights).reshape(-1, 1)
+
+        # dropped questions have no weight, see regrade
+        # percent correct, then rounded to integer
+        percent_correct_np = (number_correct_np / item_weights.sum() * 100)
+        percent_correct_np = percent_correct_np.round(decimals=0)
+
+        # -------------- save scored exam array to class ------------- #
+
+        # update the state variables
+        self.scored_matrix = scored_exam_np
+        self.total_points = number_correct_np.ravel()
+        self.build_scored_exam_df(number_correct_np.ravel(),
+                                  percent_correct_np.ravel())
+
+        # --------------------- old code ------------------------------ #
+
+        # array containing number of correct answers graded against each key
+        # correct_for_key_a_and_key_b = np.hstack((num_correct_arrays[0],
+        #                                          num_correct_arrays[1]))
+        # print('Array of number correct for each key:\n'
+        #       '{}\n'.format(correct_for_key_a_and_key_b))
+
+        # grab the largest number of correct items between keys
+        # max_number_correct = correct_for_key_a_and_key_b.max(axis=1)
+        # print('Array of max number of correct answers:\n'
+        #       '{}\n'.format(max_number_correct))
+
+        # scores_arrays = []
+
+        # percent correct for each element in the array
+        # an array of scores for each test taker
+        # for num_correct in num_correct_arrays:
+        #     scores_array = num_correct / num_questions * 100
+        #     scores_arrays.append(scores_array)
+        #     print('Percent correct array:\n{}\n'.format(scores_array))
+
+        # another array with scores from both forms
+        # scores_for_key_a_and_key_b = np.hstack((scores_arrays[0],
+        #                                         scores_arrays[1]))
+        # best score of the forms
+        # max_scores = scores_for_key_a_and_key_b.max(axis=1)
+
+        # this is a really weird approach to finding the max value
+        # create new array with scores for each key
+        # stacked_scores = np.hstack((scores_arrays[0], scores_arrays[1]))
+
+        # make a boolean mask to find largest value
+        # key_a_mask = scores_arrays[0] > scores_arrays[1]
+
+        # invert mask for key B
+        # key_b_mask = key_a_mask.copy()
+
+        # use bitwise xor to flip boolean values
+        # key_b_mask ^= True
+
+        # now sum the product of masks and data, but ignore last two rows (keys)
+        # number_correct_np = (key_a_mask * scores_arrays[0] + key_b_mask *
+        #                      scores_arrays[1])
+
+        # use the key masks to only collect the best responses to questions
+        # assumes last two rows are keys and disregards them in calculation
+        # best_answers_array = (key_a_mask * scored_arrays[0] +
+        #                       key_b_mask * scored_arrays[1])
+
+        # sums over columns to get number of times question answered correctly
+        correct_per_question_array = scored_exam_np.sum(axis=0,
+                                                        keepdims=True)
+        print('Number of times each question answered '
+              'correctly:\n{}\n'.format(correct_per_question_array))
+
+        # median score for test takers
+        median_score = np.median(number_correct_np)
+        print('The median exam score is {}\n'.format(median_score))
+
+        # ----------------- item analysis ------------------------- #
+
+        # difficulty, discrimination, item-total correlations and reliability
+        self.analyze_items()
+
+        print('Cronbach alpha (KR-20) is {:.3f}, SEM is {:.2f}\n'.format(
+            self.test_statistics['alpha'],
+            self.test_statistics['standard error of measurement']))
+
+        # todo: might want to keep all of the data generated in an array
+        # for each student or some other place for later analysis
+
+        # same analysis for exam distractors
+        self.analyze_distractors()
+
+        # export to csv file that doesn't include an index column
+        # scored_exam_data[['OrgDefinedId', 'score']].to_csv(
+        #                     '~/Desktop/graded exams and ID numbers.csv',
+        #                     index=False)
+
+        return True
+
+    def save_state_to_db(self, db_path='saved state.sqlite', tables=None,
+                         rows=None):
+        """Method saves current state to a SQLite database for easy reuse.
+
+        Rows are upserted on their primary key and only rewritten when
+        their contents changed, so saving after a regrade or a late sheet
+        only touches the affected rows. Rows that are no longer in the
+        current state, like the old ID of a corrected sheet, are deleted.
+
+        :param db_path: path to the SQLite database file
+        :param tables: names of the tables to save, default is all of
+        STATE_TABLES that have data
+        :param rows: optional rows of the response matrix to save, default
+        is every row
+        :return: None
+        """
+
+        if tables is None:
+            tables = STATE_TABLES
+
+        if rows is None:
+            rows = np.arange(len(self.student_ids))
+
+        with connect_state_db(db_path) as db:
+            db.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?)',
+                           [('ques_fieldnames',
+                             json.dumps(self.ques_fieldnames)),
+                            ('scoring_rules',
+                             json.dumps(self.scoring_rules)),
+                            ('item_weights', json.dumps(self.item_weights)),
+                            ('dropped_items',
+                             json.dumps(sorted(self.dropped_items)))])
+
+            if 'roster' in tables:
+                db.executemany(
+                    'INSERT INTO roster VALUES (?, ?, ?) '
+                    'ON CONFLICT (OrgDefinedId) DO UPDATE SET '
+                    'name = excluded.name, random_id = excluded.random_id '
+                    'WHERE (name, random_id) IS NOT '
+                    '(excluded.name, excluded.random_id)',
+                    [(roster_id, name,
+                      self.id_to_randomid.get(roster_id, 'none'))
+                     for roster_id, name in self.id_to_name.items()])
+                delete_stale_rows(db, 'roster', ['OrgDefinedId'],
+                                  [(roster_id,) for roster_id
+                                   in self.id_to_name])
+
+            if 'exam_keys' in tables and not self.exam_keys_df.empty:
+                key_columns = [column for column in self.exam_keys_df
+                               if column.endswith(' answer')]
+                key_rows = self.exam_keys_df.melt(
+                    id_vars='ques number', value_vars=key_columns,
+                    var_name='key', value_name='answer')
+                db.executemany(
+                    'INSERT INTO exam_keys VALUES (?, ?, ?) '
+                    'ON CONFLICT (key, ques_number) DO UPDATE SET '
+                    'answer = excluded.answer '
+                    'WHERE answer IS NOT excluded.answer',
+                    [(key[:-len(' answer')], int(ques_number), answer)
+                     for ques_number, key, answer
+                     in key_rows.itertuples(index=False)])
+                delete_stale_rows(db, 'exam_keys', ['key', 'ques_number'],
+                                  [(key[:-len(' answer')], int(ques_number))
+                                   for ques_number, key, answer
+                                   in key_rows.itertuples(index=False)])
+
+            if 'responses' in tables and self.response_masks.size > 0:
+                form_letters = FORM_LETTERS[self.form_codes]
+                db.executemany(
+                    'INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (sheet) DO UPDATE SET '
+                    'OrgDefinedId = excluded.OrgDefinedId, '
+                    'random_id = excluded.random_id, '
+                    'form = excluded.form, name = excluded.name, '
+                    'responses = excluded.responses '
+                    'WHERE (OrgDefinedId, random_id, form, name, responses) '
+                    'IS NOT (excluded.OrgDefinedId, excluded.random_id, '
+                    'excluded.form, excluded.name, excluded.responses)',
+                    [(int(row), self.student_ids[row],
+                      self.student_random_ids[row], form_letters[row],
+                      self.student_names[row],
+                      self.response_masks[row].tobytes())
+                     for row in rows])
+                delete_stale_rows(db, 'responses', ['sheet'],
+                                  [(sheet,) for sheet
+                                   in range(len(self.student_ids))])
+
+            if 'scores' in tables and self.scored_matrix.size > 0:
+                totals = self.scored_exam_df[['number correct',
+                                              'percent correct']].to_numpy()
+                db.executemany(
+                    'INSERT INTO scores VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (sheet) DO UPDATE SET '
+                    'scored = excluded.scored, '
+                    'number_correct = excluded.number_correct, '
+                    'percent_correct = excluded.percent_correct '
+                    'WHERE (scored, number_correct, percent_correct) IS NOT '
+                    '(excluded.scored, excluded.number_correct, '
+                    'excluded.percent_correct)',
+                    [(int(row),
+                      self.scored_matrix[row].astype(np.float32).tobytes(),
+                      float(totals[row, 0]), int(totals[row, 1]))
+                     for row in rows])
+                delete_stale_rows(db, 'scores', ['sheet'],
+                                  [(sheet,) for sheet
+                                   in range(len(self.student_ids))])
+
+            if 'item_statistics' in tables and not self.item_analysis_df.empty:
+                item_rows = self.item_analysis_df.stack()
+                db.executemany(
+                    'INSERT INTO item_statistics VALUES (?, ?, ?) '
+                    'ON CONFLICT (question, statistic) DO UPDATE SET '
+                    'value = excluded.value '
+                    'WHERE value IS NOT excluded.value',
+                    [(question, statistic, float(value))
+                     for (statistic, question), value in item_rows.items()])
+                delete_stale_rows(db, 'item_statistics',
+                                  ['question', 'statistic'],
+                                  [(question, statistic) for statistic,
+                                   question in item_rows.index])
+
+        return
+
+    def get_state_from_db(self, db_path='saved state.sqlite', tables=None):
+        """Method loads last saved state to class variables.
+
+        Only the tables asked for are read, so a stage that just needs the
+        keys doesn't pay for loading every response.
+
+        :param db_path: path to the SQLite database file
+        :param tables: names of the tables to load, default is all of
+        STATE_TABLES. 'scores' also needs 'responses' for the student data
+        :return: None
+        """
+
+        if tables is None:
+            tables = STATE_TABLES
+
+        with connect_state_db(db_path) as db:
+            metadata = dict(db.execute('SELECT name, value FROM metadata'))
+
+            self.ques_fieldnames = json.loads(
+                metadata.get('ques_fieldnames', '[]'))
+            self.number_of_questions = len(self.ques_fieldnames)
+            self.scoring_rules = {int(ques_number): rule for ques_number, rule
+                                  in json.loads(metadata.get(
+                                      'scoring_rules', '{}')).items()}
+            self.item_weights = {int(ques_number): points
+                                 for ques_number, points
+                                 in json.loads(metadata.get(
+                                     'item_weights', '{}')).items()}
+            self.dropped_items = set(json.loads(
+                metadata.get('dropped_items', '[]')))
+
+            # regrade works the totals out again from the scored matrix
+            self.total_points = np.array([], dtype=float)
+
+            if 'roster' in tables:
+                roster = db.execute('SELECT OrgDefinedId, name, random_id '
+                                    'FROM roster').fetchall()
+                self.id_to_name = {row[0]: row[1] for row in roster}
+                self.id_to_randomid = {row[0]: row[2] for row in roster}
+                self.roster_order = [(row[0], row[1]) for row in roster]
+                self.roster_df = pd.DataFrame(roster,
+                                              columns=['OrgDefinedId', 'name',
+                                                       'random ID'])
+                self.id_index = StudentIdIndex(self.id_to_name.keys())
+
+            if 'exam_keys' in tables:
+                key_rows = pd.read_sql_query(
+                    'SELECT key, ques_number, answer FROM exam_keys', db)
+                if not key_rows.empty:
+                    exam_keys_df = key_rows.pivot(index='ques_number',
+                                                  columns='key',
+                                                  values='answer')
+                    exam_keys_df.columns = [f'{key} answer'
+                                            for key in exam_keys_df.columns]
+                    exam_keys_df.index = exam_keys_df.index.astype(str)
+                    self.exam_keys_df = exam_keys_df.rename_axis(
+                        'ques number').reset_index()
+
+            if 'responses' in tables:
+                responses = db.execute(
+                    'SELECT OrgDefinedId, random_id, form, name, responses '
+                    'FROM responses ORDER BY sheet').fetchall()
+                student_ids, random_ids, forms, names, masks = (
+                    zip(*responses) if responses else ([],) * 5)
+
+                self.student_ids = np.array(student_ids, dtype=object)
+                self.student_random_ids = np.array(random_ids, dtype=object)
+                self.student_names = np.array(names, dtype=object)
+                self.form_codes = encode_forms(list(forms))
+                self.response_masks = np.frombuffer(
+                    b''.join(masks), dtype=np.uint8).reshape(
+                    len(responses), len(self.ques_fieldnames)).copy()
+                self.response_codes = MASK_TO_CODE[self.response_masks]
+
+            if 'scores' in tables:
+                scores = db.execute(
+                    'SELECT scored, number_correct, percent_correct '
+                    'FROM responses LEFT JOIN scores '
+                    'USING (sheet) ORDER BY sheet'
+                ).fetchall()
+
+                if scores and all(score[0] is not None for score in scores):
+                    scored, number_correct, percent_correct = zip(*scores)
+                    self.scored_matrix = np.frombuffer(
+                        b''.join(scored), dtype=np.float32).reshape(
+                        len(scores), len(self.ques_fieldnames)).copy()
+
+                    self.build_scored_exam_df(number_correct,
+                                              percent_correct)
+
+            if 'item_statistics' in tables:
+                item_rows = pd.read_sql_query(
+                    'SELECT question, statistic, value FROM item_statistics',
+                    db)
+                if not item_rows.empty:
+                    item_analysis_df = item_rows.pivot(index='statistic',
+                                                       columns='question',
+                                                       values='value')
+                    self.item_analysis_df = item_analysis_df.reindex(
+                        columns=self.ques_fieldnames).rename_axis(
+                        index=None, columns=None)
+
+        return
+
+    def save_snapshot(self, snapshot_dir):
+        """Saves the state to a columnar snapshot directory.
+
+        Every array is written as its own .npy file so it can be memory
+        mapped when the snapshot is reopened, and everything else goes in
+        a small JSON manifest.
+
+        :param snapshot_dir: directory for the snapshot, created if needed
+        :return: None
+        """
+
+        snapshot_dir = os.path.expanduser(snapshot_dir)
+        os.makedirs(snapshot_dir, exist_ok=True)
+
+        arrays = {'response_masks': self.response_masks,
+                  'response_codes': self.response_codes,
+                  'form_codes': self.form_codes,
+                  'scored_matrix': self.scored_matrix,
+                  'key_masks': self.key_masks,
+                  'key_index': self.key_index,
+                  # text is stored fixed width so it can be mapped too
+                  'student_ids': self.student_ids.astype(str),
+                  'student_names': self.student_names.astype(str),
+                  'student_random_ids': self.student_random_ids.astype(str)}
+
+        if not self.scored_exam_df.empty:
+            arrays['number_correct'] = self.scored_exam_df[
+                'number correct'].to_numpy(dtype=float)
+            arrays['percent_correct'] = self.scored_exam_df[
+                'percent correct'].to_numpy(dtype=int)
+
+        for name, array in arrays.items():
+            np.save(os.path.join(snapshot_dir, name + '.npy'),
+                    np.ascontiguousarray(array))
+
+        manifest = {'snapshot version': SNAPSHOT_VERSION,
+                    'arrays': {name: {'dtype': str(array.dtype),
+                                      'shape': list(array.shape)}
+                               for name, array in arrays.items()},
+                    'ques_fieldnames': self.ques_fieldnames,
+                    'scoring_rules': self.scoring_rules,
+                    'item_weights': self.item_weights,
+                    'dropped_items': sorted(self.dropped_items),
+                    'id_to_name': self.id_to_name,
+                    'id_to_randomid': self.id_to_randomid,
+                    'exam_keys': self.exam_keys_df.to_dict(orient='list'),
+                    'item_analysis': self.item_analysis_df.to_dict(
+                        orient='split')}
+
+        with open(os.path.join(snapshot_dir, 'manifest.json'), 'w') as file:
+            json.dump(manifest, file, indent=1)
+
+        return
+
+    def load_snapshot(self, snapshot_dir, mmap=True, frames=False):
+        """Reopens a snapshot written by save_snapshot.
+
+        The response and scored matrices are memory mapped read-only by
+        default, so nothing is copied into RAM until it is used.
+
+        :param snapshot_dir: directory written by save_snapshot
+        :param mmap: set False to read the arrays into memory instead
+        :param frames: also rebuild scored_exam_df, which copies the scored
+        matrix into a DataFrame
+        :return: None
+        """
+
+        snapshot_dir = os.path.expanduser(snapshot_dir)
+
+        with open(os.path.join(snapshot_dir, 'manifest.json')) as file:
+            manifest = json.load(file)
+
+        if manifest['snapshot version'] != SNAPSHOT_VERSION:
+            raise ValueError('snapshot version {} is not supported'.format(
+                manifest['snapshot version']))
+
+        mmap_mode = 'r' if mmap else None
+
+        arrays = {name: np.load(os.path.join(snapshot_dir, name + '.npy'),
+                                mmap_mode=mmap_mode)
+                  for name in manifest['arrays']}
+
+        self.response_masks = arrays['response_masks']
+        self.response_codes = arrays['response_codes']
+        self.form_codes = arrays['form_codes']
+        self.scored_matrix = arrays['scored_matrix']
+        self.key_masks = arrays['key_masks']
+        self.key_index = arrays['key_index']
+        self.student_ids = arrays['student_ids'].astype(object)
+        self.student_names = arrays['student_names'].astype(object)
+        self.student_random_ids = arrays['student_random_ids'].astype(
+            object)
+
+        self.ques_fieldnames = manifest['ques_fieldnames']
+        self.number_of_questions = len(self.ques_fieldnames)
+        self.scoring_rules = {int(ques_number): rule for ques_number, rule
+                              in manifest['scoring_rules'].items()}
+        self.item_weights = {int(ques_number): points for ques_number, points
+                             in manifest['item_weights'].items()}
+        self.dropped_items = set(manifest['dropped_items'])
+        self.id_to_name = manifest['id_to_name']
+        self.id_to_randomid = manifest['id_to_randomid']
+        self.exam_keys_df = pd.DataFrame(manifest['exam_keys'])
+
+        # roster lookups are derived, rebuild them from the saved roster
+        self.roster_order = list(self.id_to_name.items())
+        self.roster_df = pd.DataFrame(
+            [(student_id, name, self.id_to_randomid.get(student_id))
+             for student_id, name in self.roster_order],
+            columns=['OrgDefinedId', 'name', 'random ID'])
+        self.id_index = StudentIdIndex(self.id_to_name.keys())
+
+        item_analysis = manifest['item_analysis']
+        self.item_analysis_df = pd.DataFrame(item_analysis['data'],
+                                             index=item_analysis['index'],
+                                             columns=item_analysis['columns'])
+
+        # regrade works the totals out again from the scored matrix
+        self.total_points = np.array([], dtype=float)
+        self.scored_exam_df = pd.DataFrame()
+
+        if frames and 'number_correct' in arrays:
+            self.build_scored_exam_df(arrays['number_correct'],
+                                      arrays['percent_correct'])
+
+        return
+
+    def change_root_dir(self, project_root_dir):
+        """Method changes the project root directory from the initilization
+        value to the new path
+        """
+
+        # todo: check to ensure that value passed is actually valid path
+        self.project_root_dir = project_root_dir
+
+        return
+
+    def roster_data_path(self, desired_path):
+        """Helper function that generates a path to the class roster, exam
+        data, and exam keys.
+        :param desired_path: 'roster', 'data', or a key name like 'keyA'
+        or 'test_keyA', any form letter is allowed
+        :return:
+        """
+        # use project root directory for relative paths
+        root_dir = self.project_root_dir
+
+        # directory path to exam keys
+        if re.fullmatch(r'(test_)?key[A-Z]', desired_path):
+
+            keys_data_path = os.path.join(root_dir, 'exam keys/',
+                                          f'{desired_path}.pdf')
+
+            return keys_data_path
+
+        elif desired_path is 'data':
+            exam_data_path = os.path.join(root_dir,
+                                          '4-python scripts/results/',
+                                          'scanned bubblesheets '
+                                          'formatted.csv')
+            return exam_data_path
+        elif desired_path is 'roster':
+            # course roster dictionary
+            rosters = {'1401_6303': 'PHYS-1401 6303 roster.csv',
+                       '1410_6301': 'PHYS-1410 6301 roster.csv'}
+
+            course_number, roster_file_name = list_picker(rosters)
+
+            # get the path from the course number
+            # assuming that data directory is above current working directory
+            roster_file_path = os.path.join(root_dir, '4-python scripts/data/',
+                                            roster_file_name)
+
+            return roster_file_path
+
+        return
+
+    def to_d2l_gradebook(self, exam_name='exam', output_dir='~/Downloads',
+                         gradebook_path=None):
+        """Method creates a csv file that can be directly imported into the
+        D2L gradebook, see to_d2l.
+
+        :return: dict of output name => path written
+        """
+
+        return self.to_d2l(exam_name, output_dir, outputs=('gradebook',),
+                           gradebook_path=gradebook_path)
+
+    def to_d2l_feedback(self, exam_name='exam', output_dir='~/Downloads',
+                        responses_path=None, points_path=None):
+        """Method creates csv files that can be imported into d2l as student
+        feedback, see to_d2l.
+
+        :return: dict of output name => path written
+        """
+
+        return self.to_d2l(exam_name, output_dir,
+                           outputs=('responses', 'points'),
+                           responses_path=responses_path,
+                           points_path=points_path)
+
+    def to_d2l(self, exam_name='exam', output_dir='~/Downloads',
+               outputs=('gradebook', 'responses', 'points'),
+               gradebook_path=None, responses_path=None, points_path=None):
+        """Writes the D2L import files in a single pass over the students,
+        see export_functions.
+
+        'gradebook' => percent score as '<exam_name> Points Grade'
+        'responses' => feedback text of the bubbled answers, e.g.
+                       'A, -, B|C' ('-' is a blank)
+        'points'    => feedback text of the credit on each question, then
+                       the number correct and the percent, e.g. '1, 0, 1, 2,
+                       67%'
+
+        :param exam_name: name of the grade item in D2L, e.g. 'exam 2'
+        :param output_dir: directory used for paths that aren't given
+        :param outputs: which of the files to write
+        :param gradebook_path: defaults to '<exam_name> gradebook.csv'
+        :param responses_path: defaults to '<exam_name> responses.csv'
+        :param points_path: defaults to '<exam_name> points.csv'
+        :return: dict of output name => path written
+        """
+
+        sink_types = {'gradebook': (D2LGradebookSink, gradebook_path),
+                      'responses': (D2LResponsesSink, responses_path),
+                      'points': (D2LPointsSink, points_path)}
+
+        sinks = list()
+        for name in outputs:
+            sink_type, path = sink_types[name]
+            path = path or os.path.join(output_dir,
+                                        '{} {}.csv'.format(exam_name, name))
+            sinks.append(sink_type(path, exam_name))
+
+        return self.export(sinks)
+
+    def export(self, sinks, chunk_size=EXPORT_CHUNK_SIZE):
+        """Writes any number of output files in one pass, see
+        export_functions.export_results.
+
+        :param sinks: list of export_functions sinks
+        :param chunk_size: number of students per chunk
+        :return: dict of sink name => path written
+        """
+
+        return export_results(self, sinks, chunk_size)
+
+    def export_chunks(self, chunk_size=EXPORT_CHUNK_SIZE):
+        """Generator of student rows for the export sinks. Every text form
+        of the data is made once per chunk and shared by all the sinks.
+
+        :param chunk_size: number of students per chunk
+        :return: yields dicts of column name => array for chunk_size rows,
+        score columns are only there if the exam was graded
+        """
+
+        # the matrix might not be populated if responses_df was set directly
+        if self.response_codes.size == 0:
+            self.load_responses_df()
+
+        forms = FORM_LETTERS[self.form_codes]
+
+        graded = not self.scored_exam_df.empty
+        if graded:
+            number_text = self.scored_exam_df['number correct'].astype(
+                str).to_numpy()
+            percent_text = self.scored_exam_df['percent correct'].astype(
+                str).to_numpy()
+
+        for start in range(0, len(self.student_ids), chunk_size):
+            rows = slice(start, start + chunk_size)
+
+            letters = MASK_LETTERS[self.response_masks[rows]]
+            feedback_letters = letters.copy()
+            feedback_letters[feedback_letters == ''] = '-'
+
+            chunk = {'OrgDefinedId': self.student_ids[rows],
+                     'random ID': self.student_random_ids[rows],
+                     'form': forms[rows],
+                     'name': self.student_names[rows],
+                     'letters': letters,
+                     'feedback letters': feedback_letters}
+
+            if graded:
+                # whole credit prints as 0 or 1, partial credit as e.g. 0.33
+                chunk['credit'] = np.char.mod(
+                    '%g', np.round(self.scored_matrix[rows], 2))
+                chunk['number correct'] = number_text[rows]
+                chunk['percent correct'] = percent_text[rows]
+
+            yield chunk
+
+
+class StudentIdIndex(object):
+    """ Precomputed index of roster IDs used to find the likely owner of a
+    mis-bubbled student ID.
+
+    Every roster ID is stored under each pattern made by blanking out one
+    or two of its digits, so IDs one or two digits off share a pattern.
+    Swapped neighbouring digits are found by swapping the scanned ID
+    instead. Lookups cost the same whatever the size of the roster.
+    """
+
+    def __init__(self, roster_ids):
+        self.roster_ids = set(roster_ids)
+
+        # wildcard pattern => set of roster IDs
+        self.neighbourhood = dict()
+
+        for roster_id in self.roster_ids:
+            for pattern in id_wildcard_patterns(roster_id):
+                self.neighbourhood.setdefault(pattern, set()).add(roster_id)
+
+    def candidates(self, scanned_id, max_distance=2):
+        """ Roster IDs close to the scanned ID.
+
+        :param scanned_id: student ID from the bubblesheet, e.g. '#0012345'
+        :param max_distance: number of wrong digits allowed, a swap of two
+        neighbouring digits counts as 1
+        :return: list of (roster ID, distance) tuples, closest first
+        """
+
+        scanned_id = str(scanned_id)
+        found = set()
+
+        for pattern in id_wildcard_patterns(scanned_id):
+            found.update(self.neighbourhood.get(pattern, ()))
+
+        found.update(swap for swap in id_adjacent_swaps(scanned_id)
+                     if swap in self.roster_ids)
+
+        ranked = [(roster_id, id_distance(scanned_id, roster_id))
+                  for roster_id in found]
+
+        return sorted((candidate for candidate in ranked
+                       if 0 < candidate[1] <= max_distance),
+                      key=lambda candidate: (candidate[1], candidate[0]))
+
+
+""" Helper functions
+
+These are useful functions for carrying out the steps required to scan a
+bubblesheet graded exam.
+"""
+
+
+def grade_section(section):
+    """Runs one section through the whole unattended workflow: ingest,
+    roster matching, grading and export. Used by grade_sections, so it has
+    to stay a module level function that worker processes can import.
+
+    Section dict keys:
+    'course number' => name of the section, e.g. '1401_6303'
+    'roster'        => path to the D2L roster CSV
+    'scan data'     => path to the FormScanner CSV export
+    'keys'          => dict of key name => pdf path, e.g. {'keyA': ...}
+    'exam keys'     => (optional) the keys already parsed by read_exam_keys,
+                       in the same order, so the pdfs aren't read again
+    'resolutions'   => (optional) ID corrections CSV, see
+                       match_roster_to_responses
+    'output dir'    => (optional) directory for the formatted responses
+                       and scored exam CSV files
+
+    :param section: dict describing the section
+    :return: the graded ClassData
+    """
+
+    class_data = ClassData()
+
+    class_data.ingest_roster(section['roster'])
+    class_data.ingest_formscanner_data(section['scan data'])
+    class_data.clean_formscanner_data()
+
+    # nobody is around to answer prompts in a worker process
+    class_data.match_roster_to_responses(section.get('resolutions'),
+                                         interactive=False)
+
+    keys = list(section['keys'])
+    class_data.ingest_exam_keys(keys, [section['keys'][key] for key in keys],
+                                exam_keys=section.get('exam keys'))
+
+    class_data.grade_exam()
+
+    output_dir = section.get('output dir')
+    if output_dir is not None:
+        class_data.write_to_csv(os.path.join(
+            output_dir, section['course number'] + ' formatted.csv'))
+        class_data.scored_exam_df.to_csv(os.path.join(
+            output_dir, section['course number'] + ' scored.csv'),
+            index=False)
+
+    return class_data
+
+
+def grade_sections(sections, processes=None):
+    """Grades every section in parallel worker processes, then combines
+    them for a cross-section item analysis (see combine_sections).
+
+    The pdf keys are parsed once here and handed to every section, so
+    the workers never read a pdf or touch the key cache.
+
+    :param sections: list of section dicts, see grade_section
+    :param processes: number of worker processes, None for one per CPU
+    :return: tuple (dict of course number => graded ClassData, combined
+    ClassData)
+    """
+
+    # parse every shared key once, before the workers start
+    key_paths = sorted({path for section in sections
+                        for path in section['keys'].values()})
+    parsed_keys = dict(zip(key_paths, read_exam_keys(key_paths,
+                                                     processes=processes)))
+
+    sections = [dict(section, **{'exam keys': [parsed_keys[path] for path
+                                               in section['keys'].values()]})
+                for section in sections]
+
+    graded = parallel_map(grade_section, sections, processes=processes)
+
+    section_data = {section['course number']: class_data
+                    for section, class_data in zip(sections, graded)}
+
+    combined = combine_sections(section_data)
+
+    return section_data, combined
+
+
+def combine_sections(section_data):
+    """Stacks graded sections into one ClassData and runs the item
+    analysis on all students at once. The sections have to be graded with
+    the same keys.
+
+    :param section_data: dict of course number => graded ClassData
+    :return: combined ClassData, group_names holds the course numbers and
+    scored_exam_df has a 'section' column
+    """
+
+    sections = list(section_data.values())
+    first = sections[0]
+
+    for class_data in sections[1:]:
+        if (class_data.ques_fieldnames != first.ques_fieldnames or
+                not class_data.exam_keys_df.equals(first.exam_keys_df)):
+            raise ValueError('sections were not graded with the same keys')
+
+    combined = ClassData(number_of_forms=first.number_of_forms,
+                         id_length=first.id_length)
+
+    combined.group_names = list(section_data)
+    combined.ques_fieldnames = list(first.ques_fieldnames)
+    combined.number_of_questions = first.number_of_questions
+    combined.exam_keys_df = first.exam_keys_df.copy()
+    combined.key_masks = first.key_masks
+    combined.scoring_rules = dict(first.scoring_rules)
+    combined.item_weights = dict(first.item_weights)
+    combined.dropped_items = set(first.dropped_items)
+
+    for attribute in ('response_codes', 'response_masks', 'form_codes',
+                      'student_ids', 'student_names', 'student_random_ids',
+                      'scored_matrix', 'total_points', 'key_index'):
+        setattr(combined, attribute, np.concatenate(
+            [getattr(class_data, attribute) for class_data in sections]))
+
+    for class_data in sections:
+        combined.id_to_name.update(class_data.id_to_name)
+        combined.id_to_randomid.update(class_data.id_to_randomid)
+
+    combined.scored_exam_df = pd.concat(
+        [class_data.scored_exam_df.assign(section=course_number)
+         for course_number, class_data in section_data.items()],
+        ignore_index=True)
+
+    combined.analyze_items()
+    combined.analyze_distractors()
+
+    return combined
+
+
+def create_dir():
+    """ Function that takes the exam directory path copied to the clipboard
+    and generates the additional directory structure required to process
+    exam data. User must copy the correct path to the clipboard *before*
+    running this part of the script.
 
     :return: Returns the tuple (exam_dir, parent_dir, data_dir). 'exam_dir'
     is the current exam directory, 'parent_dir' is the directory that the
@@ -947,49 +2266,699 @@ def list_picker(selection_list):
     return selected_item
 
 
-def shelve_data(data_to_shelve, variable_name):
-    """Function to store data for easy retrieval later on.
+def compile_formscanner_layout(fieldnames):
+    """Compiles a FormScanner header row into a plan of column positions.
+
+    Headings look like 'group.name', e.g. 'response.question001'. Columns
+    are grouped by the part before the dot, keeping the header order.
+
+    :param fieldnames: list of column headings from the CSV file
+    :return: dict with the 'id columns', 'form column', 'response columns',
+    'question names', 'bubble counts' and 'group names', plus 'extra
+    groups' mapping any other group name to its column positions
+    """
+
+    groups = dict()
+
+    for column, heading in enumerate(fieldnames):
+        group_name = re.match(r'([^.]+)\.(.+)', heading)
+
+        # prevent assignment of the None object to the dict (error)
+        if group_name is not None:
+            groups.setdefault(group_name.group(1), []).append(column)
+
+    # the ID group name has been capitalised both ways over the years
+    id_group = next((name for name in groups
+                     if name.lower() == 'orgdefinedid'), None)
+
+    for required, group in (('OrgDefinedId', id_group),
+                            ('form', 'form'), ('response', 'response')):
+        if group not in groups:
+            raise KeyError('FormScanner group {} is missing from the '
+                           'header'.format(required))
+
+    response_columns = groups['response']
+
+    layout = {'id columns': groups[id_group],
+              'form column': groups['form'][0],
+              'response columns': response_columns,
+              'question names': [fieldnames[column].split('.', 1)[1]
+                                 for column in response_columns],
+              # the header doesn't say, every question is read as A-E
+              'bubble counts': [len(OPTION_MASKS)] * len(response_columns),
+              'group names': list(groups),
+              'extra groups': {name: columns
+                               for name, columns in groups.items()
+                               if name not in (id_group, 'form',
+                                               'response')}}
+
+    return layout
+
+
+def option_letters(response):
+    """Pulls the answer letters out of a single response or key entry.
+
+    Handles both FormScanner multi-mark output and keys like 'A, C'.
+
+    :param response: response string
+    :return: sorted string of the unique letters, '' if blank
+    """
+
+    return ''.join(sorted(set(re.findall(r'[A-E]', str(response)))))
+
+
+def option_mask(response):
+    """Converts a single response or key string into its option mask.
+
+    :param response: response string, e.g. 'B' or 'A, C'
+    :return: integer mask, see OPTION_MASKS
+    """
+
+    return sum(OPTION_MASKS[letter] for letter in option_letters(response))
+
+
+def encode_response_masks(responses):
+    """Converts an array of response letters into option masks.
+
+    Only the unique values are looked at in Python, everything else is a
+    single array lookup.
+
+    :param responses: array-like of response strings, NaN or '' for blanks
+    :return: np.uint8 array with the same shape as responses
+    """
+
+    values = np.asarray(responses, dtype=object)
+
+    if values.size == 0:
+        return np.zeros(values.shape, dtype=np.uint8)
+
+    # missing values come through from pandas as NaN
+    values = np.where(pd.isna(values), '', values).astype(str)
+
+    uniques, inverse = np.unique(values.ravel(), return_inverse=True)
+    lookup = np.array([option_mask(value) for value in uniques],
+                      dtype=np.uint8)
+
+    return lookup[inverse].reshape(values.shape)
+
+
+def encode_responses(responses):
+    """Converts an array of response letters into the compact integer codes
+    used by the response matrix.
+
+    :param responses: array-like of response strings, NaN or '' for blanks
+    :return: np.uint8 array with the same shape as responses
+    """
+
+    return MASK_TO_CODE[encode_response_masks(responses)]
+
+
+def single_marks(codes):
+    """Boolean mask of the responses that have exactly one bubble filled.
+
+    :param codes: array of codes from encode_responses
+    :return: boolean array with the same shape as codes
+    """
+
+    return (codes != BLANK_CODE) & (codes != MULTI_MARK_CODE)
+
+
+def one_hot_masks(masks):
+    """One-hot encodes a matrix of option masks, five columns per question.
+
+    :param masks: (rows x questions) array of option masks
+    :return: (rows x questions * 5) float32 array
+    """
+
+    num_rows, num_questions = masks.shape
+    option_bits = np.arange(len(OPTION_MASKS), dtype=np.uint8)
+
+    one_hot = (masks[:, :, np.newaxis] >> option_bits) & 1
+
+    return one_hot.reshape(num_rows, -1).astype(np.float32)
+
+
+def score_responses(response_masks, key_masks, rules=None):
+    """Scores option masks against key masks, one item rule per column.
+
+    'any'     => one bubble filled and it is one of the key answers
+    'all'     => exactly the key answers are filled in
+    'partial' => key answers filled minus wrong answers filled, divided by
+                 the number of key answers, never below zero
+
+    :param response_masks: (students x questions) response option masks
+    :param key_masks: (students x questions) key masks for each student
+    :param rules: array of rule names per question, defaults to 'any'
+    :return: (students x questions) float32 array of credit from 0 to 1
+    """
+
+    if rules is None:
+        rules = np.full(response_masks.shape[1], 'any', dtype=object)
+
+    credit = np.zeros(response_masks.shape, dtype=np.float32)
+
+    for rule in SCORING_RULES:
+        columns = np.flatnonzero(rules == rule)
+
+        if len(columns) == 0:
+            continue
+
+        responses = response_masks[:, columns]
+        keys = key_masks[:, columns]
+        hits = responses & keys
+
+        if rule == 'any':
+            credit[:, columns] = ((MASK_POPCOUNT[responses] == 1) &
+                                  (hits != 0))
+        elif rule == 'all':
+            credit[:, columns] = (responses == keys) & (keys != 0)
+        else:
+            num_right = MASK_POPCOUNT[hits].astype(np.float32)
+            num_wrong = MASK_POPCOUNT[responses & ~keys]
+            num_keyed = MASK_POPCOUNT[keys]
+            partial = np.divide(num_right - num_wrong, num_keyed,
+                                out=np.zeros_like(num_right),
+                                where=num_keyed > 0)
+            credit[:, columns] = partial.clip(0, 1)
+
+    return credit
+
+
+def count_data_rows(csv_path):
+    """Number of rows after the header in a CSV file, counted from the
+    raw bytes without parsing anything.
+
+    :param csv_path: path to the CSV file
+    :return: int
+    """
+
+    num_lines = 0
+    ends_with_newline = True
+
+    with open(csv_path, 'rb') as fileobj:
+        for block in iter(lambda: fileobj.read(1 << 20), b''):
+            num_lines += block.count(b'\n')
+            ends_with_newline = block.endswith(b'\n')
+
+    # a last line without a newline still counts
+    if not ends_with_newline:
+        num_lines += 1
+
+    return max(num_lines - 1, 0)
+
+
+def encode_forms(forms):
+    """Converts an array of form letters into integer form codes, A=1,
+    B=2 and so on. Blank, multi-marked or unreadable forms are coded 0.
+
+    :param forms: array-like of form letters
+    :return: np.uint8 array with the same shape as forms
+    """
+
+    values = np.asarray(forms, dtype=object)
+
+    if values.size == 0:
+        return np.zeros(values.shape, dtype=np.uint8)
+
+    values = np.where(pd.isna(values), '', values).astype(str)
+
+    uniques, inverse = np.unique(values.ravel(), return_inverse=True)
+    lookup = np.array([string.ascii_uppercase.find(value.strip()) + 1
+                       if len(value.strip()) == 1 else 0
+                       for value in uniques], dtype=np.uint8)
+
+    return lookup[inverse].reshape(values.shape)
+
+
+def decode_responses(codes):
+    """Converts integer response codes back into letters.
+
+    :param codes: array of codes from encode_responses
+    :return: object array of letters, '' for blanks and '*' for multi-marks
+    """
+
+    return CODE_LETTERS[np.asarray(codes)]
+
+
+def id_digit_positions(student_id):
+    """Positions of the digits in a student ID, skipping the '#' prefix.
     """
-    with shelve.open('grading_code_temp_db.db') as db:
-        try:
-            db[variable_name] = data_to_shelve
-        except KeyError:
-            print('***** data was NOT shelved! *****')
+
+    return [index for index, character in enumerate(student_id)
+            if character.isdigit()]
+
+
+def id_wildcard_patterns(student_id):
+    """Patterns made by replacing one or two digits of the ID with '*'.
+
+    :param student_id: ID string like '#0012345'
+    :return: list of pattern strings
+    """
+
+    positions = id_digit_positions(student_id)
+    patterns = list()
+
+    for first, position in enumerate(positions):
+        one_blank = student_id[:position] + '*' + student_id[position + 1:]
+        patterns.append(one_blank)
+
+        for second in positions[first + 1:]:
+            patterns.append(one_blank[:second] + '*' + one_blank[second + 1:])
+
+    return patterns
+
+
+def id_adjacent_swaps(student_id):
+    """IDs made by swapping each pair of neighbouring digits.
+    """
+
+    positions = id_digit_positions(student_id)
+    swaps = list()
+
+    for first, second in zip(positions, positions[1:]):
+        if second == first + 1:
+            swaps.append(student_id[:first] + student_id[second] +
+                         student_id[first] + student_id[second + 1:])
+
+    return swaps
+
+
+def id_distance(scanned_id, roster_id):
+    """Number of wrong digits between two IDs of the same length, where a
+    swap of neighbouring digits only counts as one mistake.
+    """
+
+    if len(scanned_id) != len(roster_id):
+        return max(len(scanned_id), len(roster_id))
+
+    differences = [index for index, (scanned, roster)
+                   in enumerate(zip(scanned_id, roster_id))
+                   if scanned != roster]
+
+    if (len(differences) == 2 and differences[1] == differences[0] + 1 and
+            scanned_id in id_adjacent_swaps(roster_id)):
+        return 1
+
+    return len(differences)
+
+
+def load_id_resolutions(resolutions_path):
+    """Reads a file of student ID corrections.
+
+    :param resolutions_path: CSV file with 'scanned ID' and 'OrgDefinedId'
+    columns, it's fine if the file doesn't exist yet
+    :return: dict mapping the scanned ID to the roster ID
+    """
+
+    if not os.path.exists(os.path.expanduser(resolutions_path)):
+        return dict()
+
+    resolutions_df = pd.read_csv(os.path.expanduser(resolutions_path),
+                                 dtype=str)
+
+    return dict(zip(resolutions_df['scanned ID'],
+                    resolutions_df['OrgDefinedId']))
+
+
+def save_id_resolutions(resolutions_path, resolutions):
+    """Adds student ID corrections to the resolutions file so later runs
+    can be done without prompting.
+
+    :param resolutions_path: CSV file path
+    :param resolutions: dict mapping the scanned ID to the roster ID
+    :return: None
+    """
+
+    abs_path = os.path.expanduser(resolutions_path)
+
+    all_resolutions = load_id_resolutions(abs_path)
+    all_resolutions.update(resolutions)
+
+    pd.DataFrame({'scanned ID': list(all_resolutions.keys()),
+                  'OrgDefinedId': list(all_resolutions.values())}).to_csv(
+        abs_path, index=False)
 
     return
 
 
-def convert_pdf_to_txt(path):
-    """ Function to convert a pdf document into a string of text for processing.
+def score_groups(totals, group_fraction=None):
+    """Masks for the upper and lower scoring groups of students.
+
+    :param totals: (..., students) total scores, leading axes are batches
+    :param group_fraction: fraction of students in each group, None
+    splits at the median like the old bubblesheet grader
+    :return: tuple of (upper, lower) boolean masks shaped like totals
+    """
+
+    if group_fraction is None:
+        median_score = np.median(totals, axis=-1, keepdims=True)
+        return totals >= median_score, totals < median_score
+
+    upper_cut = np.quantile(totals, 1 - group_fraction, axis=-1,
+                            keepdims=True)
+    lower_cut = np.quantile(totals, group_fraction, axis=-1, keepdims=True)
+
+    return totals >= upper_cut, totals <= lower_cut
+
+
+def distractor_table(response_codes, totals, keyed_masks, ques_fieldnames,
+                     group_fraction=0.27):
+    """Distractor table for a group of students who all took the same
+    form, see ClassData.analyze_distractors.
+
+    :param response_codes: (students x questions) response codes
+    :param totals: total score of each student
+    :param keyed_masks: key option mask for each question, None if the
+    students weren't all graded with the same key
+    :param ques_fieldnames: question names for the index
+    :param group_fraction: see score_groups
+    :return: DataFrame indexed by (question, option)
+    """
+
+    # 0 lower, 1 middle, 2 upper
+    upper, lower = score_groups(totals, group_fraction)
+    groups = np.where(upper, 2, np.where(lower, 0, 1))
+
+    counts = option_count_tensor(response_codes, groups, num_groups=3)
+
+    group_sizes = np.bincount(groups, minlength=3)
+    num_students = group_sizes.sum()
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        selection_rate = counts.sum(axis=2) / num_students
+        option_discrimination = (counts[:, :, 2] / group_sizes[2] -
+                                 counts[:, :, 0] / group_sizes[0])
+
+    if keyed_masks is not None:
+        keyed = (keyed_masks[:, np.newaxis] &
+                 CODE_MASKS[np.newaxis, :]) != 0
+    else:
+        keyed = np.zeros(selection_rate.shape, dtype=bool)
+
+    index = pd.MultiIndex.from_product([ques_fieldnames, OPTION_LABELS],
+                                       names=['question', 'option'])
+
+    return pd.DataFrame(
+        {'lower count': counts[:, :, 0].ravel(),
+         'middle count': counts[:, :, 1].ravel(),
+         'upper count': counts[:, :, 2].ravel(),
+         'selection rate': selection_rate.ravel(),
+         'option discrimination': option_discrimination.ravel(),
+         'keyed': keyed.ravel()},
+        index=index)
+
+
+def item_statistics(scored_matrix, group_fraction=None):
+    """Classical item statistics, each one a single matrix expression over
+    the scored matrix.
+
+    'item difficulty'      => percent of students who got the item right
+    'item discrimination'  => proportion right in the upper group minus the
+                              proportion right in the lower group
+    'point biserial'       => correlation of the item with the total score
+    'corrected item-total' => correlation of the item with the total score
+                              of the other items
+
+    Leading axes are treated as batches, so a stack of resampled matrices
+    can be analysed in one call.
+
+    :param scored_matrix: (..., students, questions) credit for each item
+    :param group_fraction: see score_groups
+    :return: dict of statistic name => (..., questions) array
+    """
+
+    scored = np.asarray(scored_matrix, dtype=np.float64)
+
+    totals = scored.sum(axis=-1)
+
+    # ------------------- difficulty and discrimination ------------------
+    difficulty = scored.mean(axis=-2) * 100
+
+    upper, lower = score_groups(totals, group_fraction)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        upper_right = (np.matmul(upper[..., np.newaxis, :], scored)[..., 0, :]
+                       / upper.sum(axis=-1, keepdims=True))
+        lower_right = (np.matmul(lower[..., np.newaxis, :], scored)[..., 0, :]
+                       / lower.sum(axis=-1, keepdims=True))
+
+    discrimination = upper_right - lower_right
+
+    # ------------------- item-total correlations ------------------------
+    item_variance, total_variance, item_total_covariance = \
+        item_total_moments(scored)
+
+    # the rest score is the total without the item itself
+    rest_covariance = item_total_covariance - item_variance
+    rest_variance = total_variance - 2 * item_total_covariance + item_variance
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        point_biserial = item_total_covariance / np.sqrt(item_variance *
+                                                         total_variance)
+        corrected_item_total = rest_covariance / np.sqrt(item_variance *
+                                                         rest_variance)
+
+    return {'item difficulty': difficulty,
+            'item discrimination': discrimination,
+            'point biserial': point_biserial,
+            'corrected item-total': corrected_item_total}
+
+
+def bootstrap_batch(scored_matrix, seed_sequence, batch_size,
+                    group_fraction=None):
+    """Item and reliability statistics for one batch of bootstrap
+    resamples. Students are resampled as an index array and the whole
+    batch is analysed in one batched call.
 
-    :param path: path to pdf file (might need to escape spaces)
-    :return: plain text
+    :param scored_matrix: (students x questions) credit for each item
+    :param seed_sequence: np.random.SeedSequence for this batch
+    :param batch_size: number of resamples in the batch
+    :param group_fraction: see score_groups
+    :return: dict of statistic name => (batch_size, ...) array
     """
 
-    abs_path = os.path.expanduser(path)
+    scored = np.asarray(scored_matrix)
+    num_students = scored.shape[0]
 
-    rsrcmgr = PDFResourceManager()
-    retstr = io.StringIO()
-    codec = 'utf-8'
-    laparams = LAParams()
-    device = TextConverter(rsrcmgr, retstr, codec=codec, laparams=laparams)
-    fp = open(abs_path, 'rb')
-    interpreter = PDFPageInterpreter(rsrcmgr, device)
-    password = ""
-    maxpages = 0
-    caching = True
-    pagenos = set()
+    generator = np.random.default_rng(seed_sequence)
+    resample_index = generator.integers(num_students,
+                                        size=(batch_size, num_students))
+    resampled = scored[resample_index]
 
-    for page in PDFPage.get_pages(fp, pagenos,
-                                  maxpages=maxpages,
-                                  password=password,
-                                  caching=caching):
-        interpreter.process_page(page)
+    statistics = item_statistics(resampled, group_fraction)
+    statistics.update(reliability_statistics(resampled))
 
-    text = retstr.getvalue()
+    return statistics
 
-    fp.close()
-    device.close()
-    retstr.close()
 
-    return text
+def bootstrap_intervals(scored_matrix, replicates=2000, confidence=0.95,
+                        seed=0, processes=None, group_fraction=None,
+                        batch_size=100):
+    """Percentile bootstrap intervals for every statistic from
+    item_statistics and reliability_statistics.
+
+    Resamples are split into batches and the batches are spread over
+    worker processes. Each batch gets its own seed spawned from seed, so
+    the intervals only depend on seed and not on the number of processes.
+
+    :param scored_matrix: (students x questions) credit for each item
+    :param replicates: number of bootstrap resamples
+    :param confidence: coverage of the intervals, e.g. 0.95
+    :param seed: seed for the resampling
+    :param processes: number of worker processes, None for one per CPU
+    :param group_fraction: see score_groups
+    :param batch_size: number of resamples analysed in one call
+    :return: dict of statistic name => (2, ...) array of lower and upper
+    bounds
+    """
+
+    scored = np.asarray(scored_matrix, dtype=np.float32)
+
+    batch_sizes = [batch_size] * (replicates // batch_size)
+    if replicates % batch_size:
+        batch_sizes.append(replicates % batch_size)
+
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+    batch_args = ([scored] * len(batch_sizes), seed_sequences, batch_sizes,
+                  [group_fraction] * len(batch_sizes))
+
+    batches = parallel_map(bootstrap_batch, *batch_args, processes=processes)
+
+    tail = (1 - confidence) / 2 * 100
+
+    intervals = dict()
+    for name in batches[0]:
+        samples = np.concatenate([batch[name] for batch in batches])
+        # resamples where a statistic is undefined (no variance) are skipped
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            intervals[name] = np.nanpercentile(samples, [tail, 100 - tail],
+                                               axis=0)
+
+    return intervals
+
+
+def item_total_moments(scored_matrix):
+    """Variances of the items and the total score, and the covariance of
+    each item with the total, all from one centering of the scored matrix.
+
+    :param scored_matrix: (..., students, questions) credit for each item
+    :return: tuple of item variance (..., questions), total variance
+    (..., 1) and item-total covariance (..., questions)
+    """
+
+    scored = np.asarray(scored_matrix, dtype=np.float64)
+    num_students = scored.shape[-2]
+
+    item_centered = scored - scored.mean(axis=-2, keepdims=True)
+    total_centered = item_centered.sum(axis=-1)
+
+    item_variance = (item_centered ** 2).mean(axis=-2)
+    total_variance = (total_centered ** 2).mean(axis=-1, keepdims=True)
+    item_total_covariance = np.matmul(total_centered[..., np.newaxis, :],
+                                      item_centered)[..., 0, :] / num_students
+
+    return item_variance, total_variance, item_total_covariance
+
+
+def reliability_statistics(scored_matrix):
+    """Internal consistency of the test in closed form, so the jMetrik
+    round trip isn't needed after every exam.
+
+    'alpha'                         => Cronbach's alpha, the same as KR-20
+                                       when every item is scored 0 or 1
+    'standard error of measurement' => total score standard deviation
+                                       times sqrt(1 - alpha)
+    'alpha if deleted'              => alpha of the test without each item
+
+    The variance of the test without item i is
+    var(total) - 2 cov(item i, total) + var(item i), so every alpha if
+    deleted comes from the same moments as alpha itself. Leading axes are
+    treated as batches like item_statistics.
+
+    :param scored_matrix: (..., students, questions) credit for each item
+    :return: dict of statistic name => (...) array, (..., questions) for
+    'alpha if deleted'
+    """
+
+    item_variance, total_variance, item_total_covariance = \
+        item_total_moments(scored_matrix)
+    num_questions = item_variance.shape[-1]
+
+    item_variance_sum = item_variance.sum(axis=-1, keepdims=True)
+    rest_variance = total_variance - 2 * item_total_covariance + item_variance
+
+    # alpha needs at least 2 items, alpha if deleted at least 3
+    alpha_factor = (num_questions / (num_questions - 1)
+                    if num_questions > 1 else np.nan)
+    deleted_factor = ((num_questions - 1) / (num_questions - 2)
+                      if num_questions > 2 else np.nan)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        alpha = alpha_factor * (1 - item_variance_sum / total_variance)
+        alpha_if_deleted = deleted_factor * (
+            1 - (item_variance_sum - item_variance) / rest_variance)
+
+    sem = np.sqrt(total_variance * (1 - alpha))
+
+    return {'alpha': alpha[..., 0],
+            'standard error of measurement': sem[..., 0],
+            'alpha if deleted': alpha_if_deleted}
+
+
+def option_count_tensor(response_codes, groups, num_groups):
+    """Counts how many students in each group picked each option of each
+    question, with one bincount over the encoded responses.
+
+    :param response_codes: (students x questions) response codes
+    :param groups: group number for each student, 0 to num_groups - 1
+    :param num_groups: number of score groups
+    :return: (questions x options x groups) array of counts, options are
+    ordered like CODE_LETTERS
+    """
+
+    num_students, num_questions = response_codes.shape
+    num_options = len(CODE_LETTERS)
+
+    # offset every response by its item and group so one bincount does it
+    flat_index = ((np.arange(num_questions) * num_options + response_codes)
+                  * num_groups + np.asarray(groups)[:, np.newaxis])
+
+    counts = np.bincount(flat_index.ravel(),
+                         minlength=num_questions * num_options * num_groups)
+
+    return counts.reshape(num_questions, num_options, num_groups)
+
+
+@contextlib.contextmanager
+def connect_state_db(db_path):
+    """Opens the SQLite state database, creating the tables if needed.
+    Everything done inside the with block is committed together and the
+    connection is closed at the end.
+
+    Responses and scores are stored one row per bubblesheet, keyed by the
+    sheet's position in the scan so correcting an ID only updates its row.
+    The option masks and credit for every question are packed into a blob.
+    A database written with an older STATE_SCHEMA_VERSION is emptied and
+    rebuilt.
+
+    :param db_path: path to the SQLite database file
+    :return: sqlite3 connection
+    """
+
+    db = sqlite3.connect(os.path.expanduser(db_path))
+
+    try:
+        if db.execute('PRAGMA user_version').fetchone()[0] != \
+                STATE_SCHEMA_VERSION:
+            tables = [row[0] for row in db.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'")]
+            db.executescript(''.join('DROP TABLE {};'.format(table)
+                                     for table in tables))
+            db.execute('PRAGMA user_version = {}'.format(
+                STATE_SCHEMA_VERSION))
+
+        db.executescript(STATE_SCHEMA)
+
+        with db:
+            yield db
+    finally:
+        db.close()
+
+
+def delete_stale_rows(db, table, key_columns, keys):
+    """Deletes the rows of a state table whose primary key is not one of
+    keys. Meant to be called inside the connect_state_db block, so the
+    upserts and deletes are committed together.
+
+    :param db: sqlite3 connection from connect_state_db
+    :param table: table name from STATE_SCHEMA
+    :param key_columns: primary key columns of the table
+    :param keys: tuples of key values that are still in use
+    :return: None
+    """
+
+    columns = ', '.join(key_columns)
+    keys = set(keys)
+
+    stale_rows = [row for row in db.execute(
+                      'SELECT {} FROM {}'.format(columns, table))
+                  if row not in keys]
+
+    db.executemany('DELETE FROM {} WHERE ({}) = ({})'.format(
+                       table, columns, ', '.join('?' * len(key_columns))),
+                   stale_rows)
+
+    return
+
+
+def shelve_data(data_to_shelve, variable_name):
+    """Function to store data for easy retrieval later on.
+    """
+    with shelve.open('grading_code_temp_db.db') as db:
+        try:
+            db[variable_name] = data_to_shelve
+        except KeyError:
+            print('***** data was NOT shelved! *****')
+
+    return
@@ -0,0 +1,235 @@
+""" Item response theory calibration of a scored exam.
+
+Replaces the jMetrik import/score/export cycle for Rasch and 2PL models.
+Item parameters are fit by marginal maximum likelihood with the EM
+algorithm, integrating ability over a fixed grid of quadrature points.
+Every step is a matrix expression over (students x questions) or
+(quadrature points x questions) arrays, so there are no python loops over
+students or items.
+
+Parameterization: the chance of credit on item j at ability theta is
+1 / (1 + exp(-a_j (theta - b_j))), with discrimination a_j and difficulty
+b_j. Internally the fit uses the slope/intercept form a_j theta + c_j with
+c_j = -a_j b_j. Abilities are assumed normal with mean 0.
+"""
+
+import numpy as np
+import pandas as pd
+
+IRT_MODELS = ('rasch', '2pl')
+
+# weak normal priors keep items that everyone got right (or wrong) finite
+INTERCEPT_PRIOR_SD = 5.0
+SLOPE_PRIOR_SD = 1.0
+MIN_SLOPE = 0.05
+
+
+def quadrature_grid(num_points=41, bound=6.0):
+    """Evenly spaced ability points with standard normal weights.
+
+    :param num_points: number of quadrature points
+    :param bound: the grid runs from -bound to bound
+    :return: tuple (points, weights), weights sum to 1
+    """
+
+    points = np.linspace(-bound, bound, num_points)
+    weights = np.exp(-0.5 * points ** 2)
+
+    return points, weights / weights.sum()
+
+
+def item_logits(points, slopes, intercepts):
+    """Logit of credit for every quadrature point and item.
+
+    :return: (points x questions) array
+    """
+
+    return np.outer(points, slopes) + intercepts
+
+
+def ability_posterior(scored, points, log_weights, slopes, intercepts):
+    """E step: posterior weight of each quadrature point for each student.
+
+    :param scored: (students x questions) credit, 0 to 1
+    :param points: quadrature points
+    :param log_weights: log prior weight of each point
+    :param slopes: item slopes
+    :param intercepts: item intercepts
+    :return: tuple of the (students x points) posterior and the marginal
+    log likelihood of the data
+    """
+
+    logits = item_logits(points, slopes, intercepts)
+
+    # log P and log (1 - P) without overflow
+    log_right = -np.logaddexp(0, -logits)
+    log_wrong = -np.logaddexp(0, logits)
+
+    log_joint = (scored @ log_right.T + (1 - scored) @ log_wrong.T +
+                 log_weights)
+    log_marginal = np.logaddexp.reduce(log_joint, axis=1, keepdims=True)
+
+    return np.exp(log_joint - log_marginal), log_marginal.sum()
+
+
+def fit_irt_model(scored_matrix, model='2pl', num_points=41,
+                  max_iterations=500, tolerance=1e-4):
+    """Calibrates a Rasch or 2PL model by marginal maximum likelihood.
+
+    Each EM iteration collects the expected number of students and the
+    expected credit at every quadrature point (two matrix products), then
+    takes a Newton step for all items at once. Partial credit between 0
+    and 1 is used as a fractional response.
+
+    Rasch results are reported on the usual Rasch scale: every
+    discrimination is 1 and the ability standard deviation is estimated
+    instead ('ability sd').
+
+    Item standard errors come from the cross-product of each student's
+    score contribution at the final estimates. Abilities are posterior
+    means (EAP) with the posterior standard deviation as standard error.
+
+    :param scored_matrix: (students x questions) credit for each item
+    :param model: 'rasch' or '2pl'
+    :param num_points: number of quadrature points
+    :param max_iterations: give up after this many EM iterations
+    :param tolerance: stop when no parameter moves more than this
+    :return: dict with 'items' DataFrame (discrimination, discrimination se,
+    difficulty, difficulty se), 'abilities' DataFrame (ability, ability
+    se), 'ability sd', 'log likelihood', 'iterations' and 'converged'
+    """
+
+    if model not in IRT_MODELS:
+        raise ValueError('model must be one of {}'.format(IRT_MODELS))
+
+    scored = np.asarray(scored_matrix, dtype=np.float64)
+    num_questions = scored.shape[1]
+
+    points, weights = quadrature_grid(num_points)
+    log_weights = np.log(weights)
+
+    # start from the proportion correct on each item
+    proportion = np.clip(scored.mean(axis=0), 0.01, 0.99)
+    intercepts = np.log(proportion / (1 - proportion))
+    slopes = np.ones(num_questions)
+
+    converged = False
+
+    for iteration in range(1, max_iterations + 1):
+
+        # ----------------- E step ------------------------- #
+        posterior, log_likelihood = ability_posterior(
+            scored, points, log_weights, slopes, intercepts)
+
+        # expected students and expected credit at each point
+        expected_students = posterior.sum(axis=0)[:, np.newaxis]
+        expected_credit = posterior.T @ scored
+
+        # ----------------- M step ------------------------- #
+        right = 1 / (1 + np.exp(-item_logits(points, slopes, intercepts)))
+        residual = expected_credit - expected_students * right
+        information = expected_students * right * (1 - right)
+
+        intercept_gradient = (residual.sum(axis=0) -
+                              intercepts / INTERCEPT_PRIOR_SD ** 2)
+        intercept_information = (information.sum(axis=0) +
+                                 1 / INTERCEPT_PRIOR_SD ** 2)
+        slope_gradient = (points @ residual -
+                          (slopes - 1) / SLOPE_PRIOR_SD ** 2)
+        slope_information = ((points ** 2) @ information +
+                             1 / SLOPE_PRIOR_SD ** 2)
+
+        if model == 'rasch':
+            # one slope shared by every item, i.e. the ability spread
+            slope_step = (slope_gradient.sum() /
+                          slope_information.sum()) * np.ones(num_questions)
+            intercept_step = intercept_gradient / intercept_information
+
+        else:
+            # solve the 2 x 2 Newton system of every item at once
+            cross_information = points @ information
+            determinant = (slope_information * intercept_information -
+                           cross_information ** 2)
+            slope_step = (intercept_information * slope_gradient -
+                          cross_information * intercept_gradient) / determinant
+            intercept_step = (slope_information * intercept_gradient -
+                              cross_information * slope_gradient) / determinant
+
+        slope_step = np.clip(slope_step, -1, 1)
+        intercept_step = np.clip(intercept_step, -1, 1)
+
+        slopes = np.maximum(slopes + slope_step, MIN_SLOPE)
+        intercepts = intercepts + intercept_step
+
+        if max(np.abs(slope_step).max(), np.abs(intercept_step).max()) \
+                < tolerance:
+            converged = True
+            break
+
+    # ----------------- abilities ------------------------- #
+    posterior, log_likelihood = ability_posterior(
+        scored, points, log_weights, slopes, intercepts)
+
+    ability = posterior @ points
+    ability_se = np.sqrt(np.maximum(posterior @ points ** 2 - ability ** 2,
+                                    0))
+
+    # ----------------- standard errors ------------------------- #
+    right = 1 / (1 + np.exp(-item_logits(points, slopes, intercepts)))
+
+    # each student's score for the intercept and slope of each item
+    intercept_scores = scored - posterior @ right
+    slope_scores = (scored * ability[:, np.newaxis] -
+                    posterior @ (points[:, np.newaxis] * right))
+
+    intercept_information = (intercept_scores ** 2).sum(axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if model == 'rasch':
+            # rescale so the shared slope becomes the ability spread
+            ability_sd = slopes[0]
+            discrimination = np.ones(num_questions)
+            discrimination_se = np.zeros(num_questions)
+            difficulty = -intercepts
+            difficulty_se = 1 / np.sqrt(intercept_information)
+            ability = ability * ability_sd
+            ability_se = ability_se * ability_sd
+
+        else:
+            ability_sd = 1.0
+            slope_information = (slope_scores ** 2).sum(axis=0)
+            cross_information = (slope_scores * intercept_scores).sum(axis=0)
+            determinant = (slope_information * intercept_information -
+                           cross_information ** 2)
+
+            # inverse of each 2 x 2 information matrix
+            slope_variance = intercept_information / determinant
+            intercept_variance = slope_information / determinant
+            covariance = -cross_information / determinant
+
+            discrimination = slopes
+            discrimination_se = np.sqrt(slope_variance)
+            difficulty = -intercepts / slopes
+
+            # delta method for b = -c / a
+            slope_derivative = intercepts / slopes ** 2
+            intercept_derivative = -1 / slopes
+            difficulty_se = np.sqrt(
+                slope_derivative ** 2 * slope_variance +
+                2 * slope_derivative * intercept_derivative * covariance +
+                intercept_derivative ** 2 * intercept_variance)
+
+    items = pd.DataFrame({'discrimination': discrimination,
+                          'discrimination se': discrimination_se,
+                          'difficulty': difficulty,
+                          'difficulty se': difficulty_se})
+
+    abilities = pd.DataFrame({'ability': ability,
+                              'ability se': ability_se})
+
+    return {'items': items,
+            'abilities': abilities,
+            'ability sd': float(ability_sd),
+            'log likelihood': float(log_likelihood),
+            'iterations': iteration,
+            'converged': converged}
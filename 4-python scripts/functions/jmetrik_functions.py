@@ -3,14 +3,24 @@ for jMetrik.
 """
 
 import re
+import os
 import datetime
+import numpy as np
 
-# imports for convert_pdf_to_txt
-import io
-from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
-from pdfminer.converter import TextConverter
-from pdfminer.layout import LAParams
-from pdfminer.pdfpage import PDFPage
+# pdf answer key parsing (cached) is shared with grader_functions
+from key_functions import convert_pdf_to_txt, parse_key_text
+
+# answer letters in option order, jMetrik options are a prefix of these
+OPTION_LETTERS = 'ABCDEF'
+
+# template placeholders look like «exam number»
+PLACEHOLDER_PATTERN = re.compile('«[^«»]*»')
+
+# script templates live next to this file
+TEMPLATE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# template path => (modification time, compiled template)
+compiled_templates = dict()
 
 
 def get_metadata_from_user():
@@ -57,40 +67,6 @@ def get_metadata_from_user():
     return exam_metadata
 
 
-def convert_pdf_to_txt(path):
-    """ Function to convert a pdf document into a string of text for processing.
-
-    :param path: path to pdf file (might need to escape spaces)
-    :return: plain text
-    """
-
-    rsrcmgr = PDFResourceManager()
-    retstr = io.StringIO()
-    codec = 'utf-8'
-    laparams = LAParams()
-    device = TextConverter(rsrcmgr, retstr, codec=codec, laparams=laparams)
-    fp = open(path, 'rb')
-    interpreter = PDFPageInterpreter(rsrcmgr, device)
-    password = ""
-    maxpages = 0
-    caching = True
-    pagenos = set()
-
-    for page in PDFPage.get_pages(fp, pagenos, maxpages=maxpages,
-                                  password=password,
-                                  caching=caching,
-                                  check_extractable=True):
-        interpreter.process_page(page)
-
-    text = retstr.getvalue()
-
-    fp.close()
-    device.close()
-    retstr.close()
-
-    return text
-
-
 def clean_key(exam_key):
     """ Takes the raw text from the answer key, scrapes and selects only
     the question number and corresponding answer letter.
@@ -99,11 +75,8 @@ def clean_key(exam_key):
     :return: list of tuples
     """
 
-    # regular expression pattern
-    pattern = re.compile(r'(\d+)\. ([A-Z, ]+)')
-
     # store all the data as a list
-    all_data = pattern.findall(exam_key)
+    all_data = parse_key_text(exam_key)
 
     return all_data
 
@@ -148,66 +121,229 @@ def get_options_list(key_a, num_of_choices = []):
     return updated_data
 
 
-def combine_key_lists(formA_data, formB_data):
-    """ Combines the two exam keys into one list
+def infer_options_list(key_a, observed_counts, sheet_options=5,
+                       interactive=True):
+    """ Works out the number of options for each question from the scan
+    data instead of asking for every question, see
+    ClassData.observed_option_counts. Each question gets the larger of the
+    last letter anybody bubbled and the last letter in the key. Questions
+    that don't match the most common count are the only ones the user is
+    asked about.
+
+    :param key_a: cleaned key data
+    :param observed_counts: dict of question number => option count
+    :param sheet_options: bubbles per question on the sheet, either one
+    number for every question or a dict of question number => bubbles, see
+    ClassData.bubble_counts
+    :param interactive: set False to accept the inferred counts
+    :return: list of possible options for each question, same format as
+    get_options_list
+    """
+
+    answers = [question[1] for question in key_a]
+
+    if isinstance(sheet_options, dict):
+        bubbles = np.array([sheet_options[int(question[0])]
+                            for question in key_a])
+    else:
+        bubbles = np.full(len(key_a), sheet_options)
+
+    # last option used by the key
+    key_matrix = key_option_matrix(
+        answers, bubbles, ['question {}'.format(question[0])
+                           for question in key_a])
+    key_counts = ((key_matrix > 0) *
+                  np.arange(1, key_matrix.shape[1] + 1)).max(axis=1)
+
+    observed = np.array([observed_counts.get(int(question[0]), 0)
+                         for question in key_a])
+
+    counts = np.minimum(np.maximum(observed, key_counts), bubbles)
+
+    typical = np.bincount(counts).argmax()
+    exceptions = np.flatnonzero(counts != typical)
+
+    print('{} of {} questions look like they have {} options'.format(
+        len(key_a) - len(exceptions), len(key_a), typical))
+
+    if interactive:
+        for index in exceptions:
+            # nobody answered and the key is empty
+            last_letter = OPTION_LETTERS[counts[index] - 1] \
+                if counts[index] > 0 else '?'
+            prompt = ('question #{} looks like it has options A-{}, press '
+                      'enter to accept or type the last answer '
+                      'letter: '.format(key_a[index][0], last_letter))
+            possible_answers = str(input(prompt)).strip().upper()
+            if len(possible_answers) == 1 and \
+                    possible_answers in OPTION_LETTERS:
+                counts[index] = OPTION_LETTERS.index(possible_answers) + 1
+
+    return [(question[0], question[1], int(count))
+            for question, count in zip(key_a, counts)]
+
+
+def combine_key_lists(formA_data, *other_forms_data):
+    """ Combines the exam keys into one list
 
     :param formA_data: formA data plus options list
-    :param formB_data: formB data, no options list
-    :return: [ (ques #, ans-A, ans-B, # of options), ... ]
+    :param other_forms_data: keys for forms B, C, ..., no options list.
+    Empty keys at the end are ignored, e.g. key B for a single form exam
+    :return: [ (ques #, ans-A, ans-B, ..., # of options), ... ]
     """
 
+    other_forms_data = list(other_forms_data)
+    while other_forms_data and len(other_forms_data[-1]) == 0:
+        other_forms_data.pop()
+
+    # the position of each key is its form letter, a gap would shift the
+    # later forms onto the wrong letter
+    for index, form_data in enumerate(other_forms_data):
+        if len(form_data) == 0:
+            raise ValueError('the key for form {} is empty but a later form '
+                             'has a key'.format(chr(ord('B') + index)))
+
     # return only form A data if the exam is a single form exam
-    if  len(formB_data) == 0:
+    if len(other_forms_data) == 0:
         return formA_data  # just use form A data if only one form
 
-    # combine form A and B if both are present
-    all_keys = map(lambda x, y: x[0:2] + y[1:] + x[2:], formA_data, formB_data)
-    all_keys_list = list(all_keys)
+    # answers of every other form go between the form A answer and options
+    all_keys_list = [question[0:2] +
+                     tuple(form_data[index][1] for form_data in other_forms_data) +
+                     question[2:]
+                     for index, question in enumerate(formA_data)]
 
     return all_keys_list
 
 
+def key_option_matrix(answers, number_of_options, question_names=None):
+    """ 0/1 matrix of the correct options for each question, padded with -1
+    past the last option so questions with different option counts never
+    share a row.
+
+    :param answers: answer strings, e.g. ['A', 'B, D']
+    :param number_of_options: options for each question
+    :param question_names: name of each question, used in error messages
+    :return: (questions x options) int array
+    """
+
+    answers = np.asarray(answers, dtype=str)
+    number_of_options = np.asarray(number_of_options)
+
+    # one vectorized search per option letter
+    keyed = np.stack([np.char.find(answers, letter) >= 0
+                      for letter in OPTION_LETTERS], axis=1)
+
+    # a keyed letter past the last option would silently score as wrong
+    out_of_range = keyed & (np.arange(len(OPTION_LETTERS)) >=
+                            number_of_options[:, np.newaxis])
+    if out_of_range.any():
+        question = np.flatnonzero(out_of_range.any(axis=1))[0]
+        if question_names is None:
+            name = 'question {}'.format(question + 1)
+        else:
+            name = question_names[question]
+        raise ValueError('{} is keyed {} but only has {} options'.format(
+            name, answers[question], number_of_options[question]))
+
+    if number_of_options.max() > len(OPTION_LETTERS):
+        question = int(number_of_options.argmax())
+        if question_names is None:
+            name = 'question {}'.format(question + 1)
+        else:
+            name = question_names[question]
+        raise ValueError('{} has {} options, at most {} ({}) are '
+                         'supported'.format(name, number_of_options[question],
+                                            len(OPTION_LETTERS),
+                                            OPTION_LETTERS))
+
+    width = max(int(number_of_options.max()), 1)
+    key_matrix = keyed[:, :width].astype(int)
+
+    key_matrix[np.arange(width) >= number_of_options[:, np.newaxis]] = -1
+
+    return key_matrix
+
+
+def group_questions_by_key(key_matrix, question_names):
+    """ Groups questions that share the same row of the key matrix with a
+    unique rows operation. Groups are in order of their first question.
+
+    :param key_matrix: output of key_option_matrix
+    :param question_names: name of each question
+    :return: dict of key tuple (padding removed) => list of question names
+    """
+
+    unique_keys, first_index, inverse = np.unique(
+        key_matrix, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+
+    # renumber the groups by where they first show up
+    group_order = np.argsort(first_index)
+    group_rank = np.empty_like(group_order)
+    group_rank[group_order] = np.arange(len(group_order))
+    groups = group_rank[inverse]
+
+    # questions sorted by group, then split at the group boundaries
+    question_order = np.argsort(groups, kind='stable')
+    boundaries = np.cumsum(np.bincount(groups))[:-1]
+    grouped_names = np.split(np.asarray(question_names,
+                                        dtype=object)[question_order],
+                             boundaries)
+
+    return {tuple(int(option) for option in unique_keys[group] if option >= 0):
+            list(names)
+            for group, names in zip(group_order, grouped_names)}
+
+
 def scoring_key_generator(form, all_keys_list):
     """ Generates a scoring key that jmetrik can understand.
 
-    :param form: exam key form letter
-    :param all_keys_list: list that includes both keys
-    :return: returns the scoring key that jmetrik can use
+    :param form: exam key form letter, any letter with a key in the list
+    :param all_keys_list: list that includes every key, see
+    combine_key_lists
+    :return: returns the scoring key that jmetrik can use, dict of key tuple
+    => list of question names
     """
-    # this dictionary keeps track of questions associated with a given unique key
-    scoring_key = dict()
-    # conversion dictionary
-    answer_length = {'A': 1, 'B': 2, 'C': 3, 'D': 4, 'E': 5}
 
-    for question in all_keys_list:
-        #     print(question)
-        number_of_options = question[-1]
-        key_list = [0, 0, 0, 0, 0, 0]
-        key_list = key_list[:number_of_options]
+    return scoring_keys_generator(all_keys_list, [form])[form]
+
+
+def scoring_keys_generator(all_keys_list, forms=None):
+    """ Scoring keys for several forms at once.
+
+    :param all_keys_list: list that includes every key, see
+    combine_key_lists
+    :param forms: form letters, defaults to every form in the list
+    :return: dict of form letter => scoring key
+    """
 
-        # possibility of multiple answer logic
-        # correct answer or answers
-        correct_answer = question[answer_length[form]].split(", ")
+    number_of_forms = len(all_keys_list[0]) - 2
+    if forms is None:
+        forms = [chr(ord('A') + index) for index in range(number_of_forms)]
 
-        # grab the correct answer for each item
-        for answer in correct_answer:
-            correct_answer_position = answer_length[answer] - 1
-            key_list[correct_answer_position] = 1
+    question_numbers = [question[0] for question in all_keys_list]
+    number_of_options = [question[-1] for question in all_keys_list]
+    question_names = ['question{:03d}'.format(int(number))
+                      for number in question_numbers]
 
-        key_list = tuple(key_list)
+    scoring_keys = dict()
+    for form in forms:
+        # the form A answer is the second column, then B, and so on
+        answer_column = ord(form) - ord('A') + 1
+        answers = [question[answer_column] for question in all_keys_list]
 
-        try:
-            scoring_key[key_list].append('question000'[:-len(question[0])] + str(question[0]))
-        except KeyError:
-            scoring_key[key_list] = ['question000'[:-len(question[0])] + str(question[0])]
+        scoring_keys[form] = group_questions_by_key(
+            key_option_matrix(answers, number_of_options, question_names),
+            question_names)
 
-    return scoring_key
+    return scoring_keys
 
 
 def scoring_string_generator(form, metadata, scoring_key):
     """ Function to generate the jmetrik scoring string text.
 
-    :param form: form A or B
+    :param form: form letter
     :param metadata: metadata input from user
     :param scoring_key: scoring key generated earlier
     :return: string describing how to score data
@@ -217,52 +353,71 @@ def scoring_string_generator(form, metadata, scoring_key):
     database = metadata[2][1] + metadata[1][1] + metadata[3][1]
     table = metadata[0][1] + form
 
-    # helper function to get tuples in proper string format
-    def list_to_string_list(list_of_strings):
-        string = ''
+    # one line per unique key, e.g.
+    # key1(options = (A,B,C,D), scores = (0,1,0,0), variables = (...));
+    key_lines = ['     key{}(options = ({}), scores = ({}), variables = ({}));'
+                 .format(index + 1,
+                         ','.join(OPTION_LETTERS[:len(key)]),
+                         ','.join(map(str, key)),
+                         ','.join(questions))
+                 for index, (key, questions)
+                 in enumerate(scoring_key.items())]
 
-        for item in list_of_strings:
-            string += item + ','
+    # create the jmetrik key string
+    scoring_string = '\n'.join(
+        ['scoring{',
+         '     data(db = {}, table = {});'.format(database, table),
+         '     keys({});'.format(len(scoring_key))] +
+        key_lines +
+        ['}'])
 
-        return string[:-1]
+    return scoring_string
 
-    number_of_keys = len(scoring_key)
-    unique_keys = scoring_key.keys()
 
-    # options dictionary to make life easier in string below
-    options_dict = {2: '(A,B)',
-                    3: '(A,B,C)',
-                    4: '(A,B,C,D)',
-                    5: '(A,B,C,D,E)'}
+def compile_template(script_template):
+    """ Splits a script template into the literal text between
+    placeholders and the placeholders themselves, so rendering is a single
+    join. Compiled templates are cached until the file changes.
 
-    # create the jmetrik key string
-    scoring_string = 'scoring{\n'
-
-    # database information
-    scoring_string += '     data(db = {}, table = {});\n'.format(database, table)
-
-    # number of keys
-    scoring_string += '     keys(%s);\n' % str(number_of_keys)
-
-    # generate the key string for each unique key
-    for index, key in enumerate(unique_keys):
-        # grab the questions that share the same key
-        questions = list_to_string_list(scoring_key[key])
-        # generate the 'scores' value from key (must get rid of spaces)
-        scores = str(key).replace(" ", "")
-        # generate the key item string
-        #     scoring_string += '     key{}(variables = ({}), nr = null, scores = {}, \
-        # options = {}, omit = null);\n'.format(index + 1, questions,
-        #                                         str(key), options_dict[len(key)])
-        scoring_string += '     key{}(options = {}, scores = {}, variables = ({}));\n'.format(index + 1,
-                                                                                              options_dict[len(key)],
-                                                                                              scores,
-                                                                                              questions)
-
-    # close up the string
-    scoring_string += '}'
+    :param script_template: template file name, relative to TEMPLATE_DIR
+    :return: tuple (literals, placeholders), there is one more literal
+    than there are placeholders
+    """
 
-    return scoring_string
+    template_path = os.path.join(TEMPLATE_DIR, script_template)
+    modified = os.path.getmtime(template_path)
+
+    cached = compiled_templates.get(template_path)
+    if cached is not None and cached[0] == modified:
+        return cached[1]
+
+    with open(template_path, 'r') as file_object:
+        template_text = file_object.read()
+
+    compiled = (PLACEHOLDER_PATTERN.split(template_text),
+                PLACEHOLDER_PATTERN.findall(template_text))
+    compiled_templates[template_path] = (modified, compiled)
+
+    return compiled
+
+
+def render_template(compiled, values):
+    """ Fills in a compiled template in one pass. Values are inserted as
+    is (no regex escapes), placeholders without a value are left alone.
+
+    :param compiled: output of compile_template
+    :param values: dict of placeholder => replacement text
+    :return: string containing the rendered script
+    """
+
+    literals, placeholders = compiled
+
+    pieces = [literals[0]]
+    for placeholder, literal in zip(placeholders, literals[1:]):
+        pieces.append(values.get(placeholder, placeholder))
+        pieces.append(literal)
+
+    return ''.join(pieces)
 
 
 def populate_jmetrik_template(number_of_questions, scoring_string_A, scoring_string_B, exam_metadata):
@@ -270,34 +425,24 @@ def populate_jmetrik_template(number_of_questions, scoring_string_A, scoring_str
 
     :param number_of_questions: how many questions were asked on the test?
     :param scoring_string_A: pass the scoring string for form A
-    :param scoring_string_B:
+    :param scoring_string_B: scoring string for form B, '' for 1 form
     :param exam_metadata: need the metadata provided by user
     :return: string containing jmetrik script
     """
 
-    # add metadata to the search and replace list
-    search_replace = exam_metadata
+    # search and replace values, starting with the metadata
+    search_replace = dict(exam_metadata)
 
-    # add the scoring strings to the list
-    search_replace.append(('«scoring A»', scoring_string_A))
+    # add the scoring strings
+    search_replace['«scoring A»'] = scoring_string_A
     # check to see if there is a second form
     if not len(scoring_string_B) == 0:
-        search_replace.append(('«scoring B»', scoring_string_B))
-
-    ques_labels = str()
+        search_replace['«scoring B»'] = scoring_string_B
 
     # generate a string of question labels that were on the test
-    for index in range(number_of_questions):
-        number = str(index + 1)
-        ques_label = 'question000'[:-len(number)] + number
-
-        ques_labels += ques_label + ','
-
-    # kill that last trailing comma
-    ques_labels = ques_labels[:-1]
-
-    # add question labels to the list
-    search_replace.append(('«all question names»', ques_labels))
+    search_replace['«all question names»'] = ','.join(
+        'question{:03d}'.format(index + 1)
+        for index in range(number_of_questions))
 
     # check to see if we are using 1 form or two forms
     if len(scoring_string_B) == 0:
@@ -307,44 +452,16 @@ def populate_jmetrik_template(number_of_questions, scoring_string_A, scoring_str
         print('selecting 2 Form template')
         script_template = 'jmetric script template.txt'
 
-    # grab a copy of the script template to work with
-    # assumes code is always with script template
-    with open(script_template, 'r') as file_object:
-        jmetrik_script = file_object.read()
-
-    # now find and replace all the metadata in the template
-    edited_jmetrik_script = jmetrik_script
-
-    # probably not a good idea but this is a destructive operation
-    for pattern, repl in search_replace:
-        edited_jmetrik_script = re.sub(pattern, repl, edited_jmetrik_script)
-
-    return edited_jmetrik_script
+    return render_template(compile_template(script_template), search_replace)
 
 
-def add_keys_as_student_data(formscanner_data_path, exam_key, form):
-    """ Add the exam key to the scanned and cleaned bubblesheet csv file as if
-    it were student data. This makes it easier to verify that the key was
-    processed correctly by the PDF parser.
+def populate_jmetrik_templates(exams):
+    """ Renders the jmetrik scripts for several sections or exams in one
+    call. Each template is only read and compiled once.
 
-    :param formscanner_data_path: string corresponding to path to data
-    :param exam_key: cleaned exam key data in the form of list of tuples
-    :param form: name of the form corresponding to key
-
-    :return: True if write was successful
+    :param exams: list of (number_of_questions, scoring_string_A,
+    scoring_string_B, exam_metadata) tuples, see populate_jmetrik_template
+    :return: list of scripts in the same order
     """
 
-    # we'll append this to the CSV file
-    data_string = '#9999999,' \
-                  + str(form) + ',' \
-                  + '"' + 'key' + str(form) + '"'
-
-    # grab the answer values from the key and append to string
-    for key_value in exam_key:
-        data_string += ',' + key_value[1]
-
-    data_string += '\n'
-
-    # write the key data out to formscanner data file
-    with open(formscanner_data_path,'a') as fileobj:
-        fileobj.write(data_string)
\ No newline at end of file
+    return [populate_jmetrik_template(*exam) for exam in exams]
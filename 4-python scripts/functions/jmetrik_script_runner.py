@@ -1,29 +1,54 @@
 #! /Users/peej/anaconda/envs/grading
 
 import jmetrik_functions as jf
+from grader_functions import ClassData
+from export_functions import export_results, JMetrikImportSink
+import pandas as pd
 import shelve
+import os
 import pyperclip as cb
 
 metadata = jf.get_metadata_from_user()
 formscanner_data_path = metadata[5][1]
 
-# get the exam keys into memory
-key_a = jf.convert_pdf_to_txt('exam keys/keyA.pdf')
-key_a = jf.clean_key(key_a)
-# add key a to the formscanner data csv file
-jf.add_keys_as_student_data(formscanner_data_path, key_a, 'A')
+# the keys are added as students in a separate import file, the jMetrik
+# script imports that file instead of the formatted scan data
+jmetrik_import_path = formscanner_data_path[:-len('.csv')] + \
+                      ' jmetrik import.csv'
+metadata[5] = ('«file path»', jmetrik_import_path)
 
-# try to load second exam form if it exists
-try:
-    key_b = jf.convert_pdf_to_txt('exam keys/keyB.pdf')
-    key_b = jf.clean_key(key_b)
-except FileNotFoundError:
+# older versions of this script appended the key rows to the scan data
+responses_df = pd.read_csv(formscanner_data_path, dtype=str,
+                           keep_default_na=False)
+responses_df = responses_df[responses_df['OrgDefinedId'] !=
+                            JMetrikImportSink.KEY_ID]
+
+class_data = ClassData()
+class_data.load_responses_df(responses_df)
+
+# get the exam keys into memory, both forms are parsed at the same time
+if os.path.exists('exam keys/keyB.pdf'):
+    key_names = ['keyA', 'keyB']
+else:
     print("Couldn't find keyB, assuming it's single form exam.")
+    key_names = ['keyA']
+
+class_data.ingest_exam_keys(key_names, ['exam keys/{}.pdf'.format(key)
+                                        for key in key_names])
+
+key_a = list(zip(class_data.exam_keys_df['ques number'],
+                 class_data.exam_keys_df['keyA answer']))
+if 'keyB' in key_names:
+    key_b = list(zip(class_data.exam_keys_df['ques number'],
+                     class_data.exam_keys_df['keyB answer']))
+else:
     key_b = []    # set key_b to empty list which indicates 1 form mode
 
-# add key B data to the formscanner data if it exists
-if not key_b == []:
-    jf.add_keys_as_student_data(formscanner_data_path, key_b, 'B')
+# option counts bubbled on each form A question
+observed_counts = class_data.observed_option_counts('A')
+
+# formatted responses with the keys added as students
+export_results(class_data, [JMetrikImportSink(jmetrik_import_path)])
 
 num_ques = jf.get_number_of_questions(key_a)
 
@@ -57,8 +82,9 @@ if shelf_data_exists:
 
 # if there's no key data already, prompt user for it
 if shelf_data_exists == False:
-    # prompt user for number of options for each question
-    key_a_and_options = jf.get_options_list(key_a)
+    # only prompt for questions that don't look like the rest
+    key_a_and_options = jf.infer_options_list(
+        key_a, observed_counts, sheet_options=class_data.bubble_counts())
     shelfFile['key_a_and_options'] = key_a_and_options
 
 all_keys_list = jf.combine_key_lists(key_a_and_options,key_b)
@@ -66,17 +92,19 @@ all_keys_list = jf.combine_key_lists(key_a_and_options,key_b)
 # close the shelf file
 shelfFile.close()
 
-scoring_key_a = jf.scoring_key_generator('A', all_keys_list)
-scoring_string_a = jf.scoring_string_generator('A', metadata, scoring_key_a)
+# scoring keys for every form in the key list at once
+scoring_keys = jf.scoring_keys_generator(all_keys_list)
+scoring_string_a = jf.scoring_string_generator('A', metadata,
+                                               scoring_keys['A'])
 
 # if there's no key B, no need to generate scoring strings.
-if len(key_b) == 0:
+if 'B' not in scoring_keys:
     print("Don't need to generate scoring string B")
     scoring_string_b = ''
 else:
     # generate scoring strings for form B
-    scoring_key_b = jf.scoring_key_generator('B', all_keys_list)
-    scoring_string_b = jf.scoring_string_generator('B', metadata, scoring_key_b)
+    scoring_string_b = jf.scoring_string_generator('B', metadata,
+                                                   scoring_keys['B'])
 
 # populate the scoring script with data generated so far
 jmetrik_script = jf.populate_jmetrik_template(num_ques, scoring_string_a, scoring_string_b, metadata)
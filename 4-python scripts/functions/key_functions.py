@@ -0,0 +1,338 @@
+""" Functions to pull answer keys out of the TestGen pdf files.
+
+Shared by grader_functions and jmetrik_functions. Parsing a pdf is by far
+the slowest step of grading, so pages are only laid out until the answer
+table is finished, several keys are parsed at once in worker processes,
+and the extracted text and answer table are cached on disk by the content
+of the pdf. Editing a key or upgrading the parser gives the file a new
+cache entry and the old one is thrown away.
+"""
+
+import re
+import os
+import json
+import fcntl
+import hashlib
+import contextlib
+
+from parallel_functions import parallel_map
+
+# imports for pdf conversion
+import pdfminer
+from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+from pdfminer.converter import PDFPageAggregator
+from pdfminer.layout import LAParams, LTTextBox
+from pdfminer.pdfpage import PDFPage
+
+# bump this if the text extraction or key parsing changes
+PARSER_VERSION = '4-pdfminer-' + pdfminer.__version__
+
+# question number followed by the answer letter(s), e.g. '12. A, C'
+KEY_PATTERN = re.compile(r'(\d+)\. ([A-Z, ]+)')
+
+# set GRADING_CODE_CACHE to keep the cache somewhere else
+DEFAULT_CACHE_DIR = '~/.cache/grading_code/pdf keys'
+
+
+def pdf_cache_dir():
+    """Directory used to store cached pdf keys, created if needed.
+    """
+
+    cache_dir = os.path.expanduser(os.environ.get('GRADING_CODE_CACHE',
+                                                  DEFAULT_CACHE_DIR))
+    os.makedirs(cache_dir, exist_ok=True)
+
+    return cache_dir
+
+
+def pdf_digest(path, expected_questions=None):
+    """Hash of the pdf contents, the parser version and the number of
+    questions the parse stopped at, used as cache key.
+
+    :param path: path to pdf file
+    :param expected_questions: number of questions on the exam, if known
+    :return: hex digest string
+    """
+
+    digest = hashlib.sha256(PARSER_VERSION.encode())
+    digest.update(str(expected_questions).encode())
+
+    with open(os.path.expanduser(path), 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def extract_pdf_text(path, expected_questions=None):
+    """ Runs the pdfminer layout analysis over the answer pages, no caching.
+
+    Pages are read one at a time. The text boxes on each page are put in
+    reading order (top to bottom, then left to right) and parsed for
+    answers. Layout analysis stops at the first page without answers once
+    the answer table has started, or once expected_questions answers have
+    been found.
+
+    :param path: path to pdf file (might need to escape spaces)
+    :param expected_questions: number of questions on the exam, if known
+    :return: plain text of the answer pages
+    """
+
+    abs_path = os.path.expanduser(path)
+
+    rsrcmgr = PDFResourceManager()
+    # answer keys are plain horizontal text, skip the extra layout work
+    laparams = LAParams(detect_vertical=False, all_texts=False)
+    device = PDFPageAggregator(rsrcmgr, laparams=laparams)
+    interpreter = PDFPageInterpreter(rsrcmgr, device)
+
+    page_texts = list()
+    questions_found = set()
+
+    with open(abs_path, 'rb') as fp:
+        for page in PDFPage.get_pages(fp, caching=True,
+                                      check_extractable=True):
+            interpreter.process_page(page)
+
+            text_boxes = sorted((layout_object for layout_object
+                                 in device.get_result()
+                                 if isinstance(layout_object, LTTextBox)),
+                                key=lambda box: (-box.y1, box.x0))
+            page_text = ''.join(box.get_text() for box in text_boxes)
+
+            answers = parse_key_text(page_text)
+
+            # the answer table is over
+            if len(answers) == 0 and len(questions_found) > 0:
+                break
+
+            page_texts.append(page_text)
+            questions_found.update(question for question, answer in answers)
+
+            if (expected_questions is not None and
+                    len(questions_found) >= expected_questions):
+                break
+
+    device.close()
+
+    return ''.join(page_texts)
+
+
+def parse_key_text(text):
+    """ Scrapes the question number and answer letter(s) from key text.
+
+    Rows are sorted by question number, the text boxes of a multi-column
+    answer table don't always come out of the layout in question order.
+
+    :param text: text from the TestGen answer key
+    :return: list of (question number, answer) tuples
+    """
+
+    return sorted(KEY_PATTERN.findall(text), key=lambda row: int(row[0]))
+
+
+def cache_lookup(path, expected_questions=None):
+    """ Looks for a cache entry matching the current contents of a pdf.
+
+    A parse that stopped after expected_questions answers can be missing
+    later pages, so it is only used for the same expected_questions.
+
+    :param path: path to pdf file
+    :param expected_questions: number of questions on the exam, if known
+    :return: tuple (digest, entry) where entry is None on a cache miss
+    """
+
+    digest = pdf_digest(path, expected_questions)
+    entry_path = os.path.join(pdf_cache_dir(), digest + '.json')
+
+    try:
+        with open(entry_path) as fileobj:
+            entry = json.load(fileobj)
+        entry['key'] = [tuple(row) for row in entry['key']]
+    except (FileNotFoundError, ValueError, KeyError):
+        entry = None
+
+    return digest, entry
+
+
+def cache_store(path, digest, text, expected_questions=None):
+    """ Saves the text and parsed answer table for a pdf to the cache.
+
+    :param path: path to pdf file
+    :param digest: digest from cache_lookup
+    :param text: text extracted from the pdf
+    :param expected_questions: number of questions the parse stopped at
+    :return: the new cache entry
+    """
+
+    entry_path = os.path.join(pdf_cache_dir(), digest + '.json')
+
+    entry = {'parser version': PARSER_VERSION,
+             'source': os.path.abspath(os.path.expanduser(path)),
+             'expected questions': expected_questions,
+             'text': text,
+             'key': parse_key_text(text)}
+
+    # full and shortened parses of a pdf are separate entries
+    if expected_questions is None:
+        index_name = entry['source']
+    else:
+        index_name = '{} ({} questions)'.format(entry['source'],
+                                                expected_questions)
+
+    # the entry is written and indexed under one lock, so another process
+    # never sees it as unused and evicts it
+    with cache_lock():
+        # write to a temp file first so a crash never leaves half an entry
+        temp_path = '{}.{}.tmp'.format(entry_path, os.getpid())
+        with open(temp_path, 'w') as fileobj:
+            json.dump(entry, fileobj)
+        os.replace(temp_path, entry_path)
+
+        evict_stale_entries(index_name, digest)
+
+    return entry
+
+
+def load_cached_keys(paths, use_cache=True, expected_questions=None,
+                     processes=None):
+    """ Gets the text and answer table for several pdf keys. Keys that
+    aren't cached are parsed in parallel worker processes.
+
+    The cache is only written from this process, so workers never race
+    each other on the cache index. Other grading runs are kept out by
+    cache_lock.
+
+    :param paths: list of paths to pdf files
+    :param use_cache: set False to always parse the pdfs
+    :param expected_questions: number of questions on the exam, if known
+    :param processes: number of worker processes, None for one per CPU
+    :return: list of dicts with 'text' and 'key', in the order of paths
+    """
+
+    entries = [None] * len(paths)
+    digests = [None] * len(paths)
+
+    if use_cache:
+        for index, path in enumerate(paths):
+            digests[index], entries[index] = cache_lookup(
+                path, expected_questions)
+
+    to_parse = [index for index, entry in enumerate(entries) if entry is None]
+    parse_paths = [paths[index] for index in to_parse]
+    parse_counts = [expected_questions] * len(parse_paths)
+
+    texts = parallel_map(extract_pdf_text, parse_paths, parse_counts,
+                         processes=processes)
+
+    for index, text in zip(to_parse, texts):
+        if use_cache:
+            entries[index] = cache_store(paths[index], digests[index], text,
+                                         expected_questions)
+        else:
+            entries[index] = {'text': text, 'key': parse_key_text(text)}
+
+    return entries
+
+
+def load_cached_key(path, use_cache=True, expected_questions=None):
+    """ Gets the text and answer table for a pdf key, parsing it only if
+    there is no cache entry for its current contents.
+
+    :param path: path to pdf file
+    :param use_cache: set False to always parse the pdf
+    :param expected_questions: number of questions on the exam, if known
+    :return: dict with 'text' and 'key' (list of (question, answer))
+    """
+
+    return load_cached_keys([path], use_cache, expected_questions)[0]
+
+
+@contextlib.contextmanager
+def cache_lock():
+    """ Holds an exclusive lock on the cache directory, so grading runs in
+    other processes can't update the index at the same time.
+    """
+
+    with open(os.path.join(pdf_cache_dir(), 'index.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def evict_stale_entries(source, digest):
+    """ Points the cache index for a pdf at its newest entry and deletes
+    any entry that is no longer used by some pdf. Call it while holding
+    cache_lock.
+
+    :param source: absolute path to the pdf, plus the number of questions
+    for a parse that stopped early
+    :param digest: digest of the entry just written
+    :return: None
+    """
+
+    cache_dir = pdf_cache_dir()
+    index_path = os.path.join(cache_dir, 'index.json')
+
+    try:
+        with open(index_path) as fileobj:
+            index = json.load(fileobj)
+    except (FileNotFoundError, ValueError):
+        index = dict()
+
+    index[source] = digest
+    in_use = set(index.values())
+
+    for file_name in os.listdir(cache_dir):
+        if (file_name.endswith('.json') and file_name != 'index.json' and
+                file_name[:-len('.json')] not in in_use):
+            os.remove(os.path.join(cache_dir, file_name))
+
+    temp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+    with open(temp_path, 'w') as fileobj:
+        json.dump(index, fileobj, indent=1)
+    os.replace(temp_path, index_path)
+
+    return
+
+
+def convert_pdf_to_txt(path, use_cache=True):
+    """ Function to convert a pdf document into a string of text for processing.
+
+    :param path: path to pdf file (might need to escape spaces)
+    :param use_cache: set False to skip the on-disk cache
+    :return: plain text
+    """
+
+    return load_cached_key(path, use_cache)['text']
+
+
+def read_exam_key(path, use_cache=True, expected_questions=None):
+    """ Reads the (question number, answer) table from a pdf answer key.
+
+    :param path: path to pdf file
+    :param use_cache: set False to skip the on-disk cache
+    :param expected_questions: number of questions on the exam, if known
+    :return: list of (question number, answer) tuples
+    """
+
+    return load_cached_key(path, use_cache, expected_questions)['key']
+
+
+def read_exam_keys(paths, use_cache=True, expected_questions=None,
+                   processes=None):
+    """ Reads the answer tables from several pdf keys, in parallel.
+
+    :param paths: list of paths to pdf files, one per exam form
+    :param use_cache: set False to skip the on-disk cache
+    :param expected_questions: number of questions on the exam, if known
+    :param processes: number of worker processes, None for one per CPU
+    :return: list of (question number, answer) tables, in the order of paths
+    """
+
+    entries = load_cached_keys(paths, use_cache, expected_questions,
+                               processes)
+
+    return [entry['key'] for entry in entries]
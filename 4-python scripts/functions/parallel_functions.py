@@ -0,0 +1,30 @@
+""" Worker process helper shared by the key parser and the grading code.
+
+Parsing pdf keys, grading sections and bootstrap batches all farm their
+jobs out the same way: a process pool when there is more than one job,
+otherwise the jobs run in the calling process.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+def parallel_map(function, *iterables, processes=None):
+    """ map() over worker processes.
+
+    A pool isn't worth starting for a single job, or when processes is 1,
+    so those run in this process.
+
+    :param function: picklable function to call
+    :param iterables: arguments for each call, like map
+    :param processes: number of worker processes, None for one per CPU
+    :return: list of results in the order of the arguments
+    """
+
+    iterables = [list(iterable) for iterable in iterables]
+    num_jobs = min(map(len, iterables)) if iterables else 0
+
+    if num_jobs > 1 and processes != 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            return list(executor.map(function, *iterables))
+
+    return list(map(function, *iterables))
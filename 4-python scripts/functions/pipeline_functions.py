@@ -0,0 +1,351 @@
+""" Headless, incremental runner for the grading workflow.
+
+The workflow is declared as a small DAG of stages (ingest, keys, grade,
+export). Every stage gets a content hash built from its parameters, the
+contents of its input files and the hashes of the stages it depends on.
+Stage outputs are pickled in a cache directory under that hash, so a stage
+only runs again when something it depends on has actually changed.
+Correcting a key answer, for example, only reruns grading and the exports;
+the scanned data and the pdf keys are not read again.
+"""
+
+import os
+import copy
+import json
+import pickle
+import hashlib
+
+from grader_functions import ClassData
+from export_functions import (FormattedResponsesSink, JMetrikImportSink,
+                              D2LGradebookSink, D2LResponsesSink,
+                              D2LPointsSink, ItemAnalysisSink)
+
+# bump this if a stage function changes what it produces
+PIPELINE_VERSION = 2
+
+
+def file_digest(path):
+    """Hash of a file's contents.
+
+    :param path: path to file
+    :return: hex digest string
+    """
+
+    digest = hashlib.sha256()
+
+    with open(os.path.expanduser(path), 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def missing_output_files(output):
+    """Paths in a stage output that no longer exist. Stages that write
+    files, like export, return a dict of name => path.
+
+    :param output: stage output
+    :return: list of missing paths, empty for other kinds of output
+    """
+
+    if not isinstance(output, dict):
+        return []
+
+    return [path for path in output.values()
+            if isinstance(path, str) and not os.path.exists(path)]
+
+
+class Pipeline(object):
+    """ DAG of stages whose outputs are cached by the hash of their inputs.
+
+    A stage function is called with the outputs of its upstream stages as
+    positional arguments, then its files and params as keyword arguments.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # name => stage dict, in the order the stages were added
+        self.stages = dict()
+
+        # name => 'ran' or 'cached' for the last call to run
+        self.status = dict()
+
+        self._keys = dict()
+
+    def add_stage(self, name, function, inputs=(), files=None, params=None):
+        """ Declares a stage. Upstream stages have to be added first.
+
+        :param name: stage name
+        :param function: callable that does the work
+        :param inputs: names of the stages whose outputs are passed in
+        :param files: dict of argument name => path, hashed by content.
+        None or missing paths are passed through and hash as None
+        :param params: dict of other keyword arguments, must be JSON-able
+        :return: None
+        """
+
+        for upstream in inputs:
+            if upstream not in self.stages:
+                raise ValueError('stage {} needs {} to be added '
+                                 'first'.format(name, upstream))
+
+        self.stages[name] = {'function': function,
+                             'inputs': tuple(inputs),
+                             'files': dict(files or {}),
+                             'params': dict(params or {})}
+
+        return
+
+    def stage_key(self, name):
+        """ Content hash of a stage, see the module docstring.
+
+        :param name: stage name
+        :return: hex digest string
+        """
+
+        if name not in self._keys:
+            stage = self.stages[name]
+
+            # optional files that don't exist yet hash as None
+            files = {argument: (file_digest(path) if path is not None and
+                                os.path.exists(os.path.expanduser(path))
+                                else None)
+                     for argument, path in stage['files'].items()}
+
+            description = {'version': PIPELINE_VERSION,
+                           'name': name,
+                           'function': '{}.{}'.format(
+                               stage['function'].__module__,
+                               stage['function'].__qualname__),
+                           'params': stage['params'],
+                           'files': files,
+                           'inputs': [self.stage_key(upstream)
+                                      for upstream in stage['inputs']]}
+
+            self._keys[name] = hashlib.sha256(json.dumps(
+                description, sort_keys=True, default=str).encode()
+            ).hexdigest()
+
+        return self._keys[name]
+
+    def run(self, targets=None):
+        """ Brings the target stages up to date, running only the stages
+        whose hash has no cached output. Input files are re-hashed on
+        every run.
+
+        :param targets: stage names, None for every stage
+        :return: dict of stage name => output for the targets and every
+        stage that had to be loaded or run on the way
+        """
+
+        self._keys = dict()
+        self.status = dict()
+
+        outputs = dict()
+
+        for name in (targets or list(self.stages)):
+            self._output(name, outputs)
+
+        return outputs
+
+    def _output(self, name, outputs):
+        """ Gets the output of a stage from the cache, or runs it.
+        """
+
+        if name in outputs:
+            return outputs[name]
+
+        stage = self.stages[name]
+        key = self.stage_key(name)
+        cache_path = os.path.join(self.cache_dir,
+                                  '{} {}.pkl'.format(name, key))
+
+        cached = os.path.exists(cache_path)
+
+        if cached:
+            with open(cache_path, 'rb') as fileobj:
+                output = pickle.load(fileobj)
+
+            # the cache is no good if the files it points to were deleted
+            if missing_output_files(output):
+                print('{}: output files are missing'.format(name))
+                cached = False
+            else:
+                print('{}: unchanged, using cached output'.format(name))
+                self.status[name] = 'cached'
+
+        if not cached:
+            upstream_outputs = [self._output(upstream, outputs)
+                                for upstream in stage['inputs']]
+
+            print('{}: running'.format(name))
+            output = stage['function'](*upstream_outputs, **stage['files'],
+                                       **stage['params'])
+
+            # write to a temp file first so a crash never leaves half a file
+            with open(cache_path + '.tmp', 'wb') as fileobj:
+                pickle.dump(output, fileobj)
+            os.replace(cache_path + '.tmp', cache_path)
+
+            self.evict_stale_outputs(name, cache_path)
+            self.status[name] = 'ran'
+
+        outputs[name] = output
+
+        return output
+
+    def evict_stale_outputs(self, name, cache_path):
+        """ Deletes older cached outputs of a stage.
+        """
+
+        for file_name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, file_name)
+            if (file_name.startswith(name + ' ') and
+                    file_name.endswith('.pkl') and path != cache_path):
+                os.remove(path)
+
+        return
+
+
+""" Stages of the grading workflow
+"""
+
+
+def ingest_stage(roster, scan_data, resolutions=None):
+    """ Ingests the roster and FormScanner export and matches them up
+    without prompting.
+
+    :return: ClassData with matched responses
+    """
+
+    class_data = ClassData()
+
+    class_data.ingest_roster(roster)
+    class_data.ingest_formscanner_data(scan_data)
+    class_data.clean_formscanner_data()
+    class_data.match_roster_to_responses(resolutions, interactive=False)
+
+    return class_data
+
+
+def keys_stage(key_names, **key_paths):
+    """ Parses the pdf answer keys.
+
+    :param key_names: key names in form order, e.g. ['keyA', 'keyB']
+    :param key_paths: pdf path for each key name
+    :return: exam_keys_df DataFrame
+    """
+
+    class_data = ClassData()
+
+    return class_data.ingest_exam_keys(
+        key_names, [key_paths[key] for key in key_names])
+
+
+def grade_stage(class_data, exam_keys_df, key_corrections=None,
+                scoring_rules=None, item_weights=None):
+    """ Grades the matched responses.
+
+    :param class_data: output of ingest_stage
+    :param exam_keys_df: output of keys_stage
+    :param key_corrections: dict of key name => {question number: answer}
+    for answers that are wrong in the pdf key
+    :param scoring_rules: see ClassData.scoring_rules
+    :param item_weights: see ClassData.item_weights
+    :return: graded ClassData
+    """
+
+    # the ingest output is cached and shared, grade a copy of it
+    class_data = copy.deepcopy(class_data)
+
+    class_data.exam_keys_df = exam_keys_df.copy()
+    class_data.correct_exam_keys(key_corrections or {})
+    class_data.scoring_rules = dict(scoring_rules or {})
+    class_data.item_weights = dict(item_weights or {})
+
+    class_data.grade_exam()
+
+    return class_data
+
+
+def export_stage(class_data, output_dir, exam_name):
+    """ Writes the formatted responses, jMetrik import file, D2L files and
+    item analysis in one pass, plus the scored exam table.
+
+    :param class_data: output of grade_stage
+    :param output_dir: directory for the CSV files
+    :param exam_name: prefix for the file names and D2L grade items
+    :return: dict of output name => path written
+    """
+
+    def path(suffix):
+        return os.path.join(output_dir, exam_name + ' ' + suffix)
+
+    paths = class_data.export([
+        FormattedResponsesSink(path('formatted.csv')),
+        JMetrikImportSink(path('jmetrik import.csv')),
+        D2LGradebookSink(path('gradebook.csv'), exam_name),
+        D2LResponsesSink(path('responses.csv'), exam_name),
+        D2LPointsSink(path('points.csv'), exam_name),
+        ItemAnalysisSink(path('item analysis.csv'))])
+
+    paths['scored'] = path('scored.csv')
+    class_data.scored_exam_df.to_csv(paths['scored'], index=False)
+
+    return paths
+
+
+def grading_pipeline(roster, scan_data, key_paths, output_dir, exam_name,
+                     resolutions=None, key_corrections=None,
+                     scoring_rules=None, item_weights=None, cache_dir=None):
+    """ Declares the grading workflow as a Pipeline:
+
+    ingest (roster, scan data) --+
+                                 +--> grade --> export
+    keys (pdf keys) -------------+
+
+    :param roster: path to the D2L roster CSV
+    :param scan_data: path to the FormScanner CSV export
+    :param key_paths: dict of key name => pdf path, e.g. {'keyA': ...}
+    :param output_dir: directory for the exported CSV files
+    :param exam_name: prefix for the exported file names
+    :param resolutions: optional ID corrections CSV
+    :param key_corrections: see grade_stage
+    :param scoring_rules: see ClassData.scoring_rules
+    :param item_weights: see ClassData.item_weights
+    :param cache_dir: where stage outputs are kept, defaults to
+    'pipeline cache' inside output_dir
+    :return: Pipeline, call run() on it
+    """
+
+    if cache_dir is None:
+        cache_dir = os.path.join(output_dir, 'pipeline cache')
+
+    pipeline = Pipeline(cache_dir)
+
+    pipeline.add_stage('ingest', ingest_stage,
+                       files={'roster': roster, 'scan_data': scan_data,
+                              'resolutions': resolutions})
+
+    pipeline.add_stage('keys', keys_stage, files=key_paths,
+                       params={'key_names': list(key_paths)})
+
+    # JSON turns question numbers into strings, do it up front so equal
+    # corrections always hash the same
+    pipeline.add_stage('grade', grade_stage, inputs=('ingest', 'keys'),
+                       params={'key_corrections': {
+                                   key: {str(ques): answer
+                                         for ques, answer in
+                                         corrections.items()}
+                                   for key, corrections in
+                                   (key_corrections or {}).items()},
+                               'scoring_rules': scoring_rules,
+                               'item_weights': item_weights})
+
+    pipeline.add_stage('export', export_stage, inputs=('grade',),
+                       params={'output_dir': output_dir,
+                               'exam_name': exam_name})
+
+    return pipeline
@@ -0,0 +1,56 @@
+#! /Users/peej/anaconda/envs/grading
+
+"""Grades every section in the course roster dictionary in one run,
+instead of picking one roster at a time like clean_formscanner_raw_data.
+
+Sections are graded in parallel worker processes. ID numbers that can't be
+matched are reported instead of prompting, fix them in the section's
+'id corrections.csv' file and run again.
+"""
+import os
+import sys
+
+# this changes the working directory so we can import `grader_functions`
+sys.path.insert(0, './functions/')
+
+from grader_functions import *
+
+# worker processes import this script again, only run from the top level
+if __name__ == '__main__':
+
+    # course roster dictionary
+    rosters = course_details()
+
+    # get the formscanner data name
+    exam_number = input('What exam number is this? ')
+
+    if exam_number == 'final exam':
+        exam_name = ' FA18 ' + exam_number
+    else:
+        exam_name = ' FA18 exam ' + exam_number
+
+    # every section takes the same exam
+    key_paths = {key: ClassData().roster_data_path(key)
+                 for key in ('keyA', 'keyB')}
+
+    sections = list()
+    for course_number, roster_file_name in rosters.items():
+        file_name = course_number + exam_name + ' scanned bubblesheets.csv'
+
+        sections.append({'course number': course_number,
+                         'roster': 'data/' + roster_file_name,
+                         'scan data': 'data/' + file_name,
+                         'keys': key_paths,
+                         'resolutions': 'data/' + file_name[:-4] +
+                                        ' id corrections.csv',
+                         'output dir': 'results/'})
+
+    section_data, combined = grade_sections(sections)
+
+    # item analysis of every student across all sections
+    combined.item_analysis_df.to_csv(
+        os.path.join('results/', exam_name.strip() + ' item analysis.csv'))
+
+    print('\nCombined item analysis for {}:'.format(
+        ', '.join(combined.group_names)))
+    print(combined.item_analysis_df)
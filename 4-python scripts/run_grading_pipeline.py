@@ -0,0 +1,44 @@
+#! /Users/peej/anaconda/envs/grading
+
+"""Headless version of the grading workflow, see pipeline_functions.
+
+usage: python run_grading_pipeline.py <course number> <exam number>
+
+Stages whose inputs haven't changed since the last run are skipped, so
+running it again after fixing an answer in KEY_CORRECTIONS only regrades.
+"""
+import sys
+
+# this changes the working directory so we can import `grader_functions`
+sys.path.insert(0, './functions/')
+
+from grader_functions import *
+from pipeline_functions import grading_pipeline
+
+# answers that are wrong in the pdf keys, e.g. {'keyA': {12: 'C'}}
+KEY_CORRECTIONS = {}
+
+course_number, exam_number = sys.argv[1:3]
+
+rosters = course_details()
+
+if exam_number == 'final exam':
+    file_name = course_number + ' FA18 ' + exam_number + \
+                ' scanned bubblesheets.csv'
+else:
+    file_name = course_number + ' FA18 exam ' + exam_number + \
+                ' scanned bubblesheets.csv'
+
+pipeline = grading_pipeline(
+    roster='data/' + rosters[course_number],
+    scan_data='data/' + file_name,
+    key_paths={key: ClassData().roster_data_path(key)
+               for key in ('keyA', 'keyB')},
+    output_dir='results/',
+    exam_name=file_name[:-len(' scanned bubblesheets.csv')],
+    resolutions='data/' + file_name[:-4] + ' id corrections.csv',
+    key_corrections=KEY_CORRECTIONS)
+
+pipeline.run()
+
+print(pipeline.status)
@@ -9,6 +9,9 @@ sys.path.insert(0, './4-python scripts/functions/')
 print(os.getcwd())
 
 from grader_functions import *
+from pipeline_functions import grading_pipeline
+from export_functions import *
+import jmetrik_functions
 # from bubblesheet_grader import course_details
 
 
@@ -270,4 +273,1085 @@ def test_convert_pdf_to_txt(create_class):
 #     # see what state information is present in db
 #     with shelve.open('saved state') as db:
 #         for variable_name in db:
-#             print(variable_name)
\ No newline at end of file
+#             print(variable_name)
+
+@pytest.fixture()
+def graded_class():
+    """Small made up class with two forms, used instead of the shelved
+    reference data.
+    """
+    classdata = ClassData()
+
+    classdata.responses_df = pd.DataFrame(
+        {'OrgDefinedId': ['#0000001', '#0000002', '#0000003', '#0000004'],
+         'random ID': ['r1', 'r2', 'r3', 'r4'],
+         'form': ['A', 'B', 'A', 'B'],
+         'name': ['Doe, Jane', 'Roe, Rick', 'Poe, Ed', 'Loe, Lu'],
+         'question001': ['A', 'B', 'A', np.nan],
+         'question002': ['B', 'C', 'C', 'C'],
+         'question003': ['C', 'A', 'A|B', 'A']})
+
+    classdata.exam_keys_df = pd.DataFrame(
+        {'ques number': ['1', '2', '3'],
+         'keyA answer': ['A', 'B', 'C'],
+         'keyB answer': ['B', 'C', 'A']})
+
+    return classdata
+
+
+def test_encode_responses():
+    codes = encode_responses([['A', 'E', np.nan], ['', 'A|C', 'B']])
+
+    assert codes.dtype == np.uint8
+    assert codes.tolist() == [[1, 5, BLANK_CODE], [BLANK_CODE,
+                                                   MULTI_MARK_CODE, 2]]
+    assert decode_responses(codes).tolist() == [['A', 'E', ''],
+                                                ['', '*', 'B']]
+
+
+def test_response_matrix_round_trip(graded_class):
+    classdata = graded_class
+
+    classdata.load_responses_df()
+
+    assert classdata.response_codes.shape == (4, 3)
+    assert classdata.form_codes.tolist() == [1, 2, 1, 2]
+    assert classdata.get_num_of_ques() == 3
+    assert classdata.get_responses_df()['question003'].tolist() == \
+        ['C', 'A', 'A|B', 'A']
+
+
+def test_grade_exam_synthetic(graded_class):
+    classdata = graded_class
+
+    assert classdata.grade_exam()
+
+    assert classdata.scored_exam_df['number correct'].tolist() == [3, 3, 1, 2]
+
+
+def test_grade_exam_many_forms(graded_class):
+    """Three forms, with one student who forgot to bubble a form."""
+    classdata = graded_class
+
+    classdata.responses_df.loc[:, 'form'] = ['A', 'B', 'C', np.nan]
+    classdata.exam_keys_df['keyC answer'] = ['A', 'C', 'A|B']
+
+    assert classdata.grade_exam()
+
+    assert classdata.number_of_forms == 3
+    # blank form is graded against the key that fits best (form B)
+    assert classdata.key_index.tolist() == [0, 1, 2, 1]
+    assert classdata.scored_exam_df['number correct'].tolist() == [3, 3, 2, 2]
+
+
+def test_infer_forms(graded_class):
+    classdata = graded_class
+
+    # second student bubbled form A but answered form B perfectly
+    classdata.responses_df.loc[1, 'form'] = 'A'
+    classdata.load_responses_df()
+
+    form_inference_df = classdata.infer_forms()
+
+    assert form_inference_df['inferred form'].tolist() == ['A', 'B', 'A',
+                                                            'B']
+    assert form_inference_df['form mismatch'].tolist() == [False, True,
+                                                            False, False]
+    assert form_inference_df['margin'].tolist() == [3, 3, 0, 2]
+
+
+def test_score_responses_rules():
+    responses = encode_response_masks([['A', 'C', 'A|C', 'A|B', '']])
+    keys = encode_response_masks([['A, C'] * 5])
+
+    any_of = score_responses(responses, keys)
+    all_of = score_responses(responses, keys,
+                             np.array(['all'] * 5, dtype=object))
+    partial = score_responses(responses, keys,
+                              np.array(['partial'] * 5, dtype=object))
+
+    assert any_of.tolist() == [[1, 1, 0, 0, 0]]
+    assert all_of.tolist() == [[0, 0, 1, 0, 0]]
+    assert partial.tolist() == [[0.5, 0.5, 1, 0, 0]]
+
+
+def test_grade_exam_multi_answer_and_weights(graded_class):
+    classdata = graded_class
+
+    # accept either answer for question 3 and make question 1 worth 2 points
+    classdata.exam_keys_df['keyA answer'] = ['A', 'B', 'A, B, C']
+    classdata.scoring_rules = {3: 'partial'}
+    classdata.item_weights = {1: 2}
+
+    assert classdata.grade_exam()
+
+    assert classdata.scored_exam_df['number correct'].tolist() == \
+        [3.33, 4, 2.67, 2]
+    assert classdata.scored_exam_df['percent correct'].tolist() == \
+        [83, 100, 67, 50]
+
+
+@pytest.mark.parametrize('setting', ['scoring_rules', 'item_weights'])
+@pytest.mark.parametrize('ques_number', [0, 4])
+def test_grade_exam_rejects_unknown_question_numbers(graded_class, setting,
+                                                     ques_number):
+    classdata = graded_class
+    setattr(classdata, setting, {ques_number: 'all' if setting ==
+                                 'scoring_rules' else 2})
+
+    # question 0 used to overwrite the last question
+    with pytest.raises(ValueError, match='question {} is not on the '
+                                         'exam'.format(ques_number)):
+        classdata.grade_exam()
+
+
+@pytest.fixture()
+def formscanner_csv(tmp_path):
+    """Writes a tiny FormScanner export and returns the path to it."""
+    id_headings = ['OrgDefinedId.ID{}'.format(digit) for digit in range(1, 8)]
+    ques_headings = ['response.question00{}'.format(ques)
+                     for ques in range(1, 4)]
+
+    rows = [['File name'] + id_headings + ['form.form'] + ques_headings,
+            ['s1.png', '0', '0', '0', '0', '0', '0', '1', 'A', 'A', 'B', 'C'],
+            ['s2.png', '0', '0', '0', '0', '0', '0', '2', 'B', 'B', '', 'A|B'],
+            ['s3.png', '0', '0', '0', '0', '0', '0', '3', '', 'C', 'C', 'E']]
+
+    path = tmp_path / 'scanned bubblesheets.csv'
+    path.write_text('\n'.join(';'.join(row) for row in rows) + '\n')
+
+    return str(path)
+
+
+def test_stream_formscanner_data(create_class, formscanner_csv):
+    classdata = create_class
+
+    chunks = list(classdata.stream_formscanner_data(formscanner_csv,
+                                                    chunk_size=2))
+
+    assert [len(chunk[0]) for chunk in chunks] == [2, 1]
+
+    assert count_data_rows(formscanner_csv) == 3
+
+    classdata.ingest_formscanner_data(formscanner_csv, chunk_size=2)
+
+    # chunks past the expected size make the arrays grow
+    grown = ClassData()
+    grown.fill_response_chunks(
+        grown.stream_formscanner_data(formscanner_csv, chunk_size=1),
+        expected_rows=1)
+
+    assert classdata.student_ids.tolist() == ['#0000001', '#0000002',
+                                              '#0000003']
+    assert classdata.student_ids.tolist() == grown.student_ids.tolist()
+    assert classdata.ques_fieldnames == ['question001', 'question002',
+                                         'question003']
+    assert classdata.response_masks.tolist() == [[1, 2, 4], [2, 0, 3],
+                                                 [4, 4, 16]]
+    assert np.array_equal(classdata.response_masks, grown.response_masks)
+    assert np.array_equal(classdata.form_codes, grown.form_codes)
+
+
+def test_compile_formscanner_layout():
+    fieldnames = ['File name', 'form.form', 'OrgDefinedID.ID1',
+                  'OrgDefinedID.ID2', 'response.question001',
+                  'response.question002', 'seat.row']
+
+    layout = compile_formscanner_layout(fieldnames)
+
+    assert layout['id columns'] == [2, 3]
+    assert layout['form column'] == 1
+    assert layout['response columns'] == [4, 5]
+    assert layout['question names'] == ['question001', 'question002']
+    assert layout['bubble counts'] == [5, 5]
+    assert layout['extra groups'] == {'seat': [6]}
+
+
+@pytest.fixture()
+def roster_csv(tmp_path):
+    """Writes a tiny D2L roster and returns the path to it."""
+    path = tmp_path / 'roster.csv'
+    path.write_text('OrgDefinedId,Last Name,First Name,'
+                    'random ID number Text Grade <Text>\n'
+                    '#0000001,Doe,Jane,r1\n'
+                    '#0000003,Poe,Ed,r3\n'
+                    '#0000009,Loe,Lu,r9\n')
+
+    return str(path)
+
+
+def test_match_roster_batch_mode(create_class, formscanner_csv, roster_csv,
+                                 tmp_path):
+    classdata = create_class
+
+    classdata.ingest_roster(roster_csv)
+    classdata.ingest_formscanner_data(formscanner_csv, chunk_size=100)
+
+    roster_match = classdata.match_roster_to_responses(interactive=False,
+                                                       auto_correct=False)
+
+    assert roster_match['matched'].tolist() == [0, 2]
+    assert roster_match['unmatched responses'].tolist() == [1]
+    assert roster_match['absent students'].tolist() == ['#0000009']
+
+    # resolve the unmatched sheet from a file instead of a prompt
+    resolutions_path = str(tmp_path / 'id corrections.csv')
+    save_id_resolutions(resolutions_path, {'#0000002': '#0000009'})
+
+    roster_match = classdata.match_roster_to_responses(resolutions_path,
+                                                       interactive=False,
+                                                       auto_correct=False)
+
+    assert len(roster_match['unmatched responses']) == 0
+    assert classdata.student_names.tolist() == ['Doe, Jane', 'Loe, Lu',
+                                                'Poe, Ed']
+    assert classdata.student_random_ids.tolist() == ['r1', 'r9', 'r3']
+
+
+def test_student_id_index():
+    id_index = StudentIdIndex(['#1234567', '#1234576', '#7654321',
+                               '#1239999'])
+
+    # one digit off, and two neighbouring digits swapped
+    assert id_index.candidates('#1234560', max_distance=1) == \
+        [('#1234567', 1)]
+    assert id_index.candidates('#2134567') == [('#1234567', 1)]
+    assert id_index.candidates('#1234577') == [('#1234567', 1),
+                                               ('#1234576', 1)]
+    assert id_index.candidates('#0000000') == []
+
+
+def test_auto_correct_ids(create_class, formscanner_csv, roster_csv):
+    classdata = create_class
+
+    classdata.ingest_roster(roster_csv)
+    classdata.ingest_formscanner_data(formscanner_csv, chunk_size=100)
+
+    # '#0000002' is one digit off both '#0000001' and '#0000003' but they
+    # already turned in sheets, so '#0000009' is the only possibility
+    roster_match = classdata.match_roster_to_responses(interactive=False)
+
+    assert len(roster_match['unmatched responses']) == 0
+    assert classdata.student_ids.tolist() == ['#0000001', '#0000009',
+                                              '#0000003']
+
+
+def test_pdf_key_cache(monkeypatch, tmp_path):
+    """Parsed keys should come from the cache until the pdf changes."""
+    import key_functions
+
+    monkeypatch.setenv('GRADING_CODE_CACHE', str(tmp_path / 'cache'))
+
+    parsed = []
+
+    def fake_extract(path, expected_questions=None):
+        parsed.append(path)
+        return '1. A\n2. B, D\n'
+
+    monkeypatch.setattr(key_functions, 'extract_pdf_text', fake_extract)
+
+    pdf_path = tmp_path / 'keyA.pdf'
+    pdf_path.write_bytes(b'first version')
+
+    assert read_exam_key(str(pdf_path)) == [('1', 'A'), ('2', 'B, D')]
+    assert convert_pdf_to_txt(str(pdf_path)) == '1. A\n2. B, D\n'
+    assert len(parsed) == 1
+
+    # editing the key makes a new entry and evicts the old one
+    pdf_path.write_bytes(b'second version')
+    read_exam_key(str(pdf_path))
+
+    entries = [name for name in os.listdir(tmp_path / 'cache')
+               if name not in ('index.json', 'index.lock')]
+
+    assert len(parsed) == 2
+    assert entries == [key_functions.pdf_digest(str(pdf_path)) + '.json']
+
+
+def test_parse_key_text_sorts_columns():
+    """Right column of a two-column key laid out before the left one."""
+    from key_functions import parse_key_text
+
+    text = '4. D\n5. A, B\n6. E\n1. A\n2. B\n3. C\n'
+
+    assert parse_key_text(text) == [('1', 'A'), ('2', 'B'), ('3', 'C'),
+                                    ('4', 'D'), ('5', 'A, B'), ('6', 'E')]
+
+
+def store_fake_key(path):
+    """Stores a cache entry for a pdf from a worker process."""
+    import key_functions
+
+    digest, entry = key_functions.cache_lookup(path)
+    key_functions.cache_store(path, digest, '1. A\n')
+
+    return digest
+
+
+def test_pdf_key_cache_concurrent_writers(monkeypatch, tmp_path):
+    """Processes storing different keys at once keep each other's entries.
+    """
+    import json
+    from parallel_functions import parallel_map
+
+    monkeypatch.setenv('GRADING_CODE_CACHE', str(tmp_path / 'cache'))
+
+    paths = []
+    for number in range(12):
+        path = tmp_path / 'key{}.pdf'.format(number)
+        path.write_bytes(b'version %d' % number)
+        paths.append(str(path))
+
+    digests = parallel_map(store_fake_key, paths, processes=4)
+
+    with open(tmp_path / 'cache' / 'index.json') as fileobj:
+        index = json.load(fileobj)
+
+    assert sorted(index.values()) == sorted(digests)
+    for digest in digests:
+        assert (tmp_path / 'cache' / (digest + '.json')).exists()
+
+
+def test_parallel_map_keeps_order():
+    from parallel_functions import parallel_map
+
+    assert parallel_map(pow, [2, 3, 4], [2, 2, 2], processes=2) == [4, 9, 16]
+    assert parallel_map(abs, [-1]) == [1]
+    assert parallel_map(abs, []) == []
+
+
+def write_text_pdf(path, pages):
+    """Writes a bare bones pdf with one text line per list entry on each
+    page, enough for pdfminer to parse.
+    """
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', None,
+               b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    page_ids = []
+
+    for lines in pages:
+        stream = b'BT /F1 12 Tf 72 720 Td 14 TL ' + b''.join(
+            b'(' + line.encode() + b') Tj T* ' for line in lines) + b'ET'
+        objects.append(b'<< /Length %d >>\nstream\n' % len(stream) + stream +
+                       b'\nendstream')
+        objects.append(b'<< /Type /Page /Parent 2 0 R /MediaBox '
+                       b'[0 0 612 792] /Resources << /Font << /F1 3 0 R >> '
+                       b'>> /Contents %d 0 R >>' % len(objects))
+        page_ids.append(len(objects))
+
+    objects[1] = (b'<< /Type /Pages /Kids [' +
+                  b' '.join(b'%d 0 R' % page for page in page_ids) +
+                  b'] /Count %d >>' % len(page_ids))
+
+    pdf = b'%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b'%d 0 obj\n' % number + body + b'\nendobj\n'
+
+    xref = len(pdf)
+    pdf += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    pdf += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    pdf += (b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+            % (len(objects) + 1, xref))
+
+    path.write_bytes(pdf)
+
+
+def test_read_exam_keys_stops_after_answer_pages(monkeypatch, tmp_path):
+    monkeypatch.setenv('GRADING_CODE_CACHE', str(tmp_path / 'cache'))
+
+    key_a = tmp_path / 'keyA.pdf'
+    key_b = tmp_path / 'keyB.pdf'
+
+    # the last page of key A should never be read
+    write_text_pdf(key_a, [['1. A', '2. B, D'], ['3. C'], ['Notes'],
+                           ['4. E']])
+    write_text_pdf(key_b, [['1. C', '2. A', '3. B']])
+
+    keys = read_exam_keys([str(key_a), str(key_b)], processes=2)
+
+    assert keys == [[('1', 'A'), ('2', 'B, D'), ('3', 'C')],
+                    [('1', 'C'), ('2', 'A'), ('3', 'B')]]
+
+    # knowing the exam length stops at the first page
+    assert read_exam_key(str(key_a), use_cache=False,
+                         expected_questions=2) == [('1', 'A'), ('2', 'B, D')]
+
+    # a shortened parse is cached separately from the whole key
+    key_c = tmp_path / 'keyC.pdf'
+    write_text_pdf(key_c, [['1. A', '2. B'], ['3. C']])
+
+    assert read_exam_key(str(key_c), expected_questions=2) == \
+        [('1', 'A'), ('2', 'B')]
+    assert read_exam_key(str(key_c)) == [('1', 'A'), ('2', 'B'), ('3', 'C')]
+    assert convert_pdf_to_txt(str(key_c)).count('.') == 3
+    assert read_exam_key(str(key_c), expected_questions=2) == \
+        [('1', 'A'), ('2', 'B')]
+
+
+def test_sqlite_state_round_trip(graded_class, roster_csv, tmp_path):
+    classdata = graded_class
+    classdata.ingest_roster(roster_csv)
+    classdata.grade_exam()
+
+    db_path = str(tmp_path / 'saved state.sqlite')
+    classdata.save_state_to_db(db_path)
+
+    # count the response rows that actually get rewritten from here on
+    import sqlite3
+    with sqlite3.connect(db_path) as db:
+        db.executescript('''
+            CREATE TABLE updates (n INTEGER);
+            CREATE TRIGGER count_updates AFTER UPDATE ON responses
+            BEGIN INSERT INTO updates VALUES (1); END;''')
+
+    # a late correction to one sheet only rewrites that row
+    classdata.response_masks[0, 0] = OPTION_MASKS['E']
+    classdata.save_state_to_db(db_path)
+
+    with sqlite3.connect(db_path) as db:
+        assert db.execute('SELECT count(*) FROM updates').fetchone() == (1,)
+
+    reloaded = ClassData()
+    reloaded.get_state_from_db(db_path)
+
+    assert reloaded.id_to_name == classdata.id_to_name
+    assert reloaded.exam_keys_df.equals(classdata.exam_keys_df)
+    assert np.array_equal(reloaded.response_masks, classdata.response_masks)
+    assert np.array_equal(reloaded.scored_matrix, classdata.scored_matrix)
+    assert reloaded.scored_exam_df['number correct'].tolist() == \
+        classdata.scored_exam_df['number correct'].tolist()
+
+    # stages can load just the tables they need
+    keys_only = ClassData()
+    keys_only.get_state_from_db(db_path, tables=('exam_keys',))
+
+    assert keys_only.response_masks.size == 0
+    assert keys_only.exam_keys_df.equals(classdata.exam_keys_df)
+
+
+def test_sqlite_state_id_correction_and_stale_rows(graded_class, tmp_path):
+    classdata = graded_class
+    classdata.grade_exam()
+
+    db_path = str(tmp_path / 'saved state.sqlite')
+    classdata.save_state_to_db(db_path)
+
+    import sqlite3
+    with sqlite3.connect(db_path) as db:
+        db.executescript('''
+            CREATE TABLE deletes (n INTEGER);
+            CREATE TRIGGER count_deletes AFTER DELETE ON responses
+            BEGIN INSERT INTO deletes VALUES (1); END;''')
+
+    # the second sheet really belonged to student 3, that's an update
+    classdata.apply_id_resolutions({'#0000002': '#0000003'})
+    classdata.save_state_to_db(db_path)
+
+    with sqlite3.connect(db_path) as db:
+        assert db.execute('SELECT count(*) FROM deletes').fetchone() == (0,)
+
+    reloaded = ClassData()
+    reloaded.get_state_from_db(db_path)
+
+    # same sheets in the same order
+    assert reloaded.student_ids.tolist() == ['#0000001', '#0000003',
+                                             '#0000003', '#0000004']
+    assert np.array_equal(reloaded.response_masks, classdata.response_masks)
+    assert np.array_equal(reloaded.scored_matrix, classdata.scored_matrix)
+
+    # sheets that are gone are deleted
+    classdata.load_responses_df(classdata.get_responses_df().iloc[:3])
+    classdata.grade_exam()
+    classdata.save_state_to_db(db_path)
+    reloaded.get_state_from_db(db_path)
+
+    assert reloaded.student_ids.tolist() == ['#0000001', '#0000003',
+                                             '#0000003']
+    assert len(reloaded.scored_matrix) == 3
+
+
+def test_snapshot_memory_mapped_reload(graded_class, tmp_path):
+    classdata = graded_class
+    classdata.grade_exam()
+
+    snapshot_dir = str(tmp_path / 'exam 2 snapshot')
+    classdata.save_snapshot(snapshot_dir)
+
+    reloaded = ClassData()
+    reloaded.load_snapshot(snapshot_dir)
+
+    # the big matrices come back mapped, not copied
+    assert isinstance(reloaded.response_masks, np.memmap)
+    assert isinstance(reloaded.scored_matrix, np.memmap)
+    assert np.array_equal(reloaded.scored_matrix, classdata.scored_matrix)
+    assert reloaded.student_ids.tolist() == classdata.student_ids.tolist()
+    assert reloaded.exam_keys_df.equals(classdata.exam_keys_df)
+    assert reloaded.scored_exam_df.empty
+
+    reloaded.load_snapshot(snapshot_dir, frames=True)
+
+    assert reloaded.scored_exam_df.equals(classdata.scored_exam_df)
+
+
+def test_snapshot_rebuilds_roster_lookups(graded_class, roster_csv, tmp_path):
+    classdata = graded_class
+    classdata.ingest_roster(roster_csv)
+    classdata.grade_exam()
+
+    snapshot_dir = str(tmp_path / 'exam 2 snapshot')
+    classdata.save_snapshot(snapshot_dir)
+
+    reloaded = ClassData()
+    reloaded.load_snapshot(snapshot_dir)
+
+    assert reloaded.roster_order == classdata.roster_order
+    assert reloaded.roster_df['random ID'].tolist() == ['r1', 'r3', 'r9']
+    assert reloaded.id_index.candidates('#0000090', max_distance=1) == \
+        [('#0000009', 1)]
+
+
+def test_item_statistics_match_direct_formulas():
+    rng = np.random.default_rng(0)
+    scored = (rng.random((50, 6)) < np.linspace(0.2, 0.9, 6)).astype(float)
+    totals = scored.sum(axis=1)
+
+    statistics = item_statistics(scored)
+
+    upper = totals >= np.median(totals)
+    lower = ~upper
+
+    for item in range(scored.shape[1]):
+        rest = totals - scored[:, item]
+
+        assert np.isclose(statistics['item difficulty'][item],
+                          scored[:, item].mean() * 100)
+        assert np.isclose(statistics['item discrimination'][item],
+                          scored[upper, item].mean() -
+                          scored[lower, item].mean())
+        assert np.isclose(statistics['point biserial'][item],
+                          np.corrcoef(scored[:, item], totals)[0, 1])
+        assert np.isclose(statistics['corrected item-total'][item],
+                          np.corrcoef(scored[:, item], rest)[0, 1])
+
+    # a stack of matrices gives the same answer as one at a time
+    batched = item_statistics(np.stack([scored, scored[::-1]]))
+    assert np.allclose(batched['point biserial'][1],
+                       statistics['point biserial'])
+
+
+def test_grade_exam_populates_item_analysis(graded_class):
+    classdata = graded_class
+    classdata.grade_exam()
+
+    assert list(classdata.item_analysis_df.index) == [
+        'item difficulty', 'item discrimination', 'point biserial',
+        'corrected item-total', 'alpha if deleted']
+    assert list(classdata.item_analysis_df.columns) == \
+        classdata.ques_fieldnames
+    assert classdata.item_analysis_df.loc['item difficulty'].tolist() == \
+        [75, 75, 75]
+    assert set(classdata.test_statistics) == {
+        'alpha', 'standard error of measurement'}
+
+
+def test_option_count_tensor():
+    codes = np.array([[1, 2], [1, 0], [3, 6]], dtype=np.uint8)
+    counts = option_count_tensor(codes, [0, 1, 1], num_groups=2)
+
+    assert counts.shape == (2, len(CODE_LETTERS), 2)
+    assert counts[0, 1].tolist() == [1, 1]
+    assert counts[0, 3].tolist() == [0, 1]
+    assert counts[1, [0, 2, 6]].tolist() == [[0, 1], [1, 0], [0, 1]]
+    assert counts.sum() == codes.size
+
+
+def test_analyze_distractors(graded_class):
+    classdata = graded_class
+    classdata.grade_exam()
+
+    # scrambled forms get a table each, with their own keyed options
+    distractors = classdata.distractor_analysis_df
+    counts = distractors[['lower count', 'middle count', 'upper count']]
+    assert (counts.groupby(level=['form', 'question']).sum().sum(axis=1)
+            == 2).all()
+    assert distractors['keyed'].groupby(level='form').sum().tolist() == [3, 3]
+    assert distractors.loc[('B', 'question001', 'B'), 'keyed']
+    pd.testing.assert_frame_equal(distractors.loc['A'],
+                                  classdata.analyze_distractors(form='A'))
+
+    form_a = classdata.analyze_distractors(form='A')
+    assert form_a.loc[('question001', 'A'), 'selection rate'] == 1
+    assert form_a.loc[('question003', 'multi'), 'selection rate'] == 0.5
+    assert form_a.loc[('question003', 'C'), 'option discrimination'] == 1
+    assert form_a['keyed'].sum() == 3
+    assert form_a.loc[('question002', 'B'), 'keyed']
+
+
+def test_reliability_matches_direct_formulas():
+    rng = np.random.default_rng(3)
+    ability = rng.normal(size=(40, 1))
+    scored = (rng.normal(size=(40, 6)) < ability).astype(np.float32)
+
+    def alpha(matrix):
+        k = matrix.shape[1]
+        return k / (k - 1) * (1 - matrix.var(axis=0).sum() /
+                              matrix.sum(axis=1).var())
+
+    reliability = reliability_statistics(scored)
+
+    assert np.isclose(reliability['alpha'], alpha(scored))
+    assert np.isclose(reliability['standard error of measurement'],
+                      scored.sum(axis=1).std() *
+                      np.sqrt(1 - alpha(scored)))
+    assert np.allclose(reliability['alpha if deleted'],
+                       [alpha(np.delete(scored, item, axis=1))
+                        for item in range(6)])
+
+    batched = reliability_statistics(np.stack([scored, scored[::-1]]))
+    assert np.allclose(batched['alpha'], alpha(scored))
+
+
+def test_grade_exam_two_questions(graded_class):
+    """Too few items for alpha if deleted, grading still has to work."""
+    classdata = graded_class
+
+    classdata.responses_df = classdata.responses_df.drop(
+        columns='question003')
+    classdata.exam_keys_df = classdata.exam_keys_df.iloc[:2]
+
+    assert classdata.grade_exam()
+
+    assert classdata.scored_exam_df['number correct'].tolist() == [2, 2, 1, 1]
+    assert np.isnan(reliability_statistics(
+        np.ones((4, 2)))['alpha if deleted']).all()
+    assert np.isnan(reliability_statistics(np.ones((4, 1)))['alpha']).all()
+
+
+def test_fit_irt_model_recovers_parameters():
+    rng = np.random.default_rng(0)
+    ability = rng.normal(size=4000)
+    slopes = rng.uniform(0.7, 1.8, size=8)
+    difficulty = np.linspace(-1.5, 1.5, 8)
+    logits = slopes * (ability[:, np.newaxis] - difficulty)
+    scored = (rng.random(logits.shape) < 1 / (1 + np.exp(-logits)))
+
+    result = fit_irt_model(scored, '2pl')
+    items = result['items']
+
+    assert result['converged']
+    assert np.allclose(items['difficulty'], difficulty, atol=0.25)
+    assert np.allclose(items['discrimination'], slopes, atol=0.3)
+    assert (items['difficulty se'] > 0).all()
+    assert np.corrcoef(result['abilities']['ability'], ability)[0, 1] > 0.8
+
+    rasch = fit_irt_model(scored, 'rasch')
+    assert (rasch['items']['discrimination'] == 1).all()
+    assert np.corrcoef(rasch['items']['difficulty'], difficulty)[0, 1] > 0.95
+
+
+def test_calibrate_irt(graded_class):
+    classdata = graded_class
+    classdata.grade_exam()
+    classdata.calibrate_irt('rasch')
+
+    assert list(classdata.item_parameters_df.index) == \
+        classdata.ques_fieldnames
+    assert classdata.abilities_df['OrgDefinedId'].tolist() == \
+        classdata.student_ids.tolist()
+    assert np.isfinite(classdata.abilities_df['ability']).all()
+
+
+def test_bootstrap_intervals_deterministic():
+    rng = np.random.default_rng(5)
+    ability = rng.normal(size=(50, 1))
+    scored = (rng.normal(size=(50, 5)) < ability).astype(np.float32)
+
+    intervals = bootstrap_intervals(scored, replicates=250, seed=7,
+                                    batch_size=50)
+    serial = bootstrap_intervals(scored, replicates=250, seed=7,
+                                 batch_size=50, processes=1)
+
+    for name, bounds in intervals.items():
+        assert np.array_equal(bounds, serial[name], equal_nan=True)
+
+    estimates = item_statistics(scored)
+    difficulty = intervals['item difficulty']
+    assert difficulty.shape == (2, 5)
+    assert ((difficulty[0] <= estimates['item difficulty']) &
+            (estimates['item difficulty'] <= difficulty[1])).all()
+    lower, upper = intervals['alpha']
+    assert lower < reliability_statistics(scored)['alpha'] < upper
+
+
+def test_bootstrap_item_analysis(graded_class):
+    classdata = graded_class
+    classdata.grade_exam()
+    item_ci, test_ci = classdata.bootstrap_item_analysis(replicates=40,
+                                                         processes=1)
+
+    assert list(item_ci.columns) == classdata.ques_fieldnames
+    assert item_ci.loc[('item difficulty', 'lower')].le(
+        item_ci.loc[('item difficulty', 'upper')]).all()
+    assert list(test_ci.index) == ['alpha', 'standard error of measurement']
+
+
+def logged_extract_pdf_text(path, expected_questions=None):
+    """extract_pdf_text that logs each parse to a file, so parses in worker
+    processes are counted too.
+    """
+    import key_functions
+
+    with open(os.environ['PARSE_LOG'], 'a') as fileobj:
+        fileobj.write(os.path.basename(path) + '\n')
+
+    return key_functions.unlogged_extract_pdf_text(path, expected_questions)
+
+
+def test_grade_sections(formscanner_csv, roster_csv, monkeypatch, tmp_path):
+    import key_functions
+
+    monkeypatch.setenv('GRADING_CODE_CACHE', str(tmp_path / 'cache'))
+
+    parse_log = tmp_path / 'parsed.txt'
+    monkeypatch.setenv('PARSE_LOG', str(parse_log))
+    monkeypatch.setattr(key_functions, 'unlogged_extract_pdf_text',
+                        key_functions.extract_pdf_text, raising=False)
+    monkeypatch.setattr(key_functions, 'extract_pdf_text',
+                        logged_extract_pdf_text)
+
+    key_a = tmp_path / 'keyA.pdf'
+    key_b = tmp_path / 'keyB.pdf'
+    write_text_pdf(key_a, [['1. A', '2. B', '3. C']])
+    write_text_pdf(key_b, [['1. B', '2. C', '3. A']])
+
+    sections = [{'course number': course_number,
+                 'roster': roster_csv,
+                 'scan data': formscanner_csv,
+                 'keys': {'keyA': str(key_a), 'keyB': str(key_b)},
+                 'output dir': str(tmp_path)}
+                for course_number in ('1401_6303', '1410_6301')]
+
+    section_data, combined = grade_sections(sections, processes=2)
+
+    # each pdf is parsed once, not once per section
+    assert sorted(parse_log.read_text().split()) == ['keyA.pdf', 'keyB.pdf']
+
+    single = section_data['1401_6303']
+    assert list(section_data) == ['1401_6303', '1410_6301']
+    assert (tmp_path / '1410_6301 scored.csv').exists()
+
+    assert combined.group_names == ['1401_6303', '1410_6301']
+    assert combined.scored_matrix.shape == (6, 3)
+    assert combined.scored_exam_df['section'].tolist() == \
+        ['1401_6303'] * 3 + ['1410_6301'] * 3
+    # two copies of the same section give the same difficulty
+    assert np.allclose(combined.item_analysis_df.loc['item difficulty'],
+                       single.item_analysis_df.loc['item difficulty'])
+
+
+def test_grading_pipeline_skips_unchanged_stages(formscanner_csv, roster_csv,
+                                                 monkeypatch, tmp_path):
+    monkeypatch.setenv('GRADING_CODE_CACHE', str(tmp_path / 'cache'))
+
+    key_paths = {'keyA': str(tmp_path / 'keyA.pdf'),
+                 'keyB': str(tmp_path / 'keyB.pdf')}
+    write_text_pdf(tmp_path / 'keyA.pdf', [['1. A', '2. B', '3. C']])
+    write_text_pdf(tmp_path / 'keyB.pdf', [['1. B', '2. C', '3. A']])
+
+    def pipeline(**options):
+        return grading_pipeline(roster_csv, formscanner_csv, key_paths,
+                                str(tmp_path), 'exam 1', **options)
+
+    first = pipeline()
+    outputs = first.run()
+    assert set(first.status.values()) == {'ran'}
+    assert outputs['grade'].scored_matrix[:, 0].tolist() == [1, 1, 0]
+
+    second = pipeline()
+    second.run()
+    assert set(second.status.values()) == {'cached'}
+
+    # a key correction only reruns grading and the exports
+    corrected = pipeline(key_corrections={'keyA': {1: 'C'}})
+    outputs = corrected.run()
+    assert corrected.status == {'ingest': 'cached', 'keys': 'cached',
+                                'grade': 'ran', 'export': 'ran'}
+    assert outputs['grade'].scored_matrix[:, 0].tolist() == [0, 1, 1]
+    assert os.path.exists(tmp_path / 'exam 1 item analysis.csv')
+
+    # grading works on a copy of the ingested data
+    assert outputs['ingest'] is not outputs['grade']
+    assert outputs['ingest'].scored_matrix.size == 0
+
+    # deleted exports are written again even though nothing changed
+    os.remove(tmp_path / 'exam 1 item analysis.csv')
+    rerun = pipeline(key_corrections={'keyA': {1: 'C'}})
+    rerun.run()
+    assert rerun.status == {'ingest': 'cached', 'keys': 'cached',
+                            'grade': 'cached', 'export': 'ran'}
+    assert os.path.exists(tmp_path / 'exam 1 item analysis.csv')
+
+
+def test_regrade_matches_full_grade(graded_class):
+    classdata = graded_class
+    classdata.grade_exam()
+    analysis_before = classdata.item_analysis_df.copy()
+
+    changed = classdata.regrade(dropped_items=[2],
+                                key_corrections={'keyB': {3: 'B'}})
+    assert changed.tolist() == [2, 3]
+    assert 'items' in classdata._stale_analyses
+
+    regraded = classdata.scored_exam_df.copy()
+
+    # a full grade of the same corrected keys gives the same scores
+    full = ClassData()
+    full.responses_df = graded_class.responses_df
+    full.exam_keys_df = classdata.exam_keys_df.copy()
+    full.dropped_items = {2}
+    full.grade_exam()
+
+    pd.testing.assert_frame_equal(regraded, full.scored_exam_df)
+    assert regraded['percent correct'].tolist() == [100, 50, 50, 0]
+
+    # the item analysis is refreshed when it's next looked at
+    pd.testing.assert_frame_equal(classdata.item_analysis_df,
+                                  full.item_analysis_df)
+    assert not classdata.item_analysis_df.equals(analysis_before)
+    assert classdata._stale_analyses == {'distractors'}
+
+
+def test_dropped_items_left_out_of_analyses(graded_class):
+    classdata = graded_class
+    classdata.grade_exam()
+    classdata.regrade(dropped_items=[2])
+
+    kept = classdata.scored_matrix[:, [0, 2]]
+    analysis = classdata.item_analysis_df
+
+    assert analysis['question002'].isna().all()
+    assert np.allclose(analysis.loc['item difficulty', ['question001',
+                                                        'question003']],
+                       item_statistics(kept)['item difficulty'])
+    assert np.isclose(classdata.test_statistics['alpha'],
+                      reliability_statistics(kept)['alpha'], equal_nan=True)
+    assert 'question002' not in \
+        classdata.distractor_analysis_df.index.get_level_values('question')
+
+    # something has to be left to grade
+    with pytest.raises(ValueError):
+        classdata.regrade(dropped_items=[1, 3])
+    assert classdata.dropped_items == {2}
+
+
+def test_regrade_after_reload_keeps_dropped_items(graded_class, roster_csv,
+                                                  tmp_path):
+    classdata = graded_class
+    classdata.ingest_roster(roster_csv)
+    classdata.grade_exam()
+    classdata.regrade(dropped_items=[2])
+
+    snapshot_dir = str(tmp_path / 'snapshot')
+    db_path = str(tmp_path / 'saved state.sqlite')
+    classdata.save_snapshot(snapshot_dir)
+    classdata.save_state_to_db(db_path)
+
+    from_snapshot = ClassData()
+    from_snapshot.load_snapshot(snapshot_dir)
+    from_db = ClassData()
+    from_db.get_state_from_db(db_path)
+
+    for reloaded in (from_snapshot, from_db):
+        assert reloaded.dropped_items == {2}
+
+        reloaded.regrade(key_corrections={'keyA': {3: 'A'}})
+
+        # the student columns come back even without the frames
+        assert reloaded.scored_exam_df['OrgDefinedId'].tolist() == \
+            classdata.student_ids.tolist()
+        assert reloaded.scored_exam_df['percent correct'].tolist() == \
+            [50, 100, 50, 50]
+
+
+def test_to_d2l_single_pass(graded_class, tmp_path):
+    classdata = graded_class
+    classdata.grade_exam()
+
+    paths = classdata.to_d2l('exam 2', str(tmp_path))
+
+    gradebook = pd.read_csv(paths['gradebook'], dtype=str)
+    assert list(gradebook.columns) == ['OrgDefinedId', 'exam 2 Points Grade',
+                                       'End-of-Line Indicator']
+    assert gradebook['exam 2 Points Grade'].tolist() == \
+        ['100', '100', '33', '67']
+
+    responses = pd.read_csv(paths['responses'], dtype=str)
+    assert responses['exam 2 responses Text Grade'].tolist() == \
+        ['A, B, C', 'B, C, A', 'A, C, A|B', '-, C, A']
+
+    points = pd.read_csv(paths['points'], dtype=str)
+    assert points['exam 2 points Text Grade'].tolist()[2:] == \
+        ['1, 0, 0, 1, 33%', '0, 1, 1, 2, 67%']
+    assert (points['End-of-Line Indicator'] == '#').all()
+
+    only_feedback = classdata.to_d2l_feedback(
+        'exam 2', points_path=str(tmp_path / 'points.csv'),
+        responses_path=str(tmp_path / 'responses.csv'))
+    assert set(only_feedback) == {'responses', 'points'}
+
+
+def test_export_sinks_single_pass(graded_class, tmp_path):
+    classdata = graded_class
+    classdata.grade_exam()
+
+    paths = classdata.export(
+        [FormattedResponsesSink(str(tmp_path / 'formatted.csv')),
+         JMetrikImportSink(str(tmp_path / 'jmetrik.csv')),
+         D2LPointsSink(str(tmp_path / 'points.csv'), 'exam 2'),
+         ItemAnalysisSink(str(tmp_path / 'items.csv'))],
+        chunk_size=3)
+
+    assert set(paths) == {'formatted', 'jmetrik', 'points', 'item analysis'}
+
+    classdata.write_to_csv(str(tmp_path / 'reference.csv'))
+    assert (tmp_path / 'formatted.csv').read_text() == \
+        (tmp_path / 'reference.csv').read_text()
+
+    jmetrik = pd.read_csv(paths['jmetrik'], dtype=str)
+    assert jmetrik['name'].tolist()[-2:] == ['keyA', 'keyB']
+    assert jmetrik.iloc[-1, 4:].tolist() == ['B', 'C', 'A']
+
+    points = pd.read_csv(paths['points'], dtype=str)
+    assert len(points) == 4
+
+    items = pd.read_csv(paths['item analysis'], index_col=0)
+    assert list(items.columns) == classdata.ques_fieldnames
+
+    # sinks have to say what they write
+    with pytest.raises(TypeError):
+        D2LSink(str(tmp_path / 'd2l.csv'), 'exam 2')
+
+
+def test_failed_export_keeps_old_files(graded_class, tmp_path):
+    classdata = graded_class
+    classdata.grade_exam()
+
+    class BrokenSink(D2LPointsSink):
+        def rows(self, chunk):
+            raise RuntimeError('disk full')
+
+    jmetrik_path = tmp_path / 'jmetrik.csv'
+    jmetrik_path.write_text('scan data\n')
+
+    with pytest.raises(RuntimeError):
+        classdata.export([JMetrikImportSink(str(jmetrik_path)),
+                          BrokenSink(str(tmp_path / 'points.csv'),
+                                     'exam 2')])
+
+    # no key rows, no half written file, the old file is untouched
+    assert jmetrik_path.read_text() == 'scan data\n'
+    assert sorted(os.listdir(tmp_path)) == ['jmetrik.csv']
+
+
+def test_jmetrik_template_literal_single_pass(tmp_path):
+    template = tmp_path / 'template.txt'
+    template.write_text('file(«file path»);\ntable = «exam number»A;'
+                        ' «exam number»B; «scoring B»')
+
+    compiled = jmetrik_functions.compile_template(str(template))
+    assert compiled[1] == ['«file path»', '«exam number»', '«exam number»',
+                           '«scoring B»']
+    # compiled templates are reused until the file changes
+    assert jmetrik_functions.compile_template(str(template)) is compiled
+
+    script = jmetrik_functions.render_template(
+        compiled, {'«file path»': r'C:\data\exam \1 \g<0>.csv',
+                   '«exam number»': 'EXAM_1'})
+
+    assert script == ('file(C:\\data\\exam \\1 \\g<0>.csv);\n'
+                      'table = EXAM_1A; EXAM_1B; «scoring B»')
+
+
+def test_scoring_keys_generator_any_number_of_forms():
+    key_a = [('1', 'A'), ('2', 'B, C'), ('3', 'A'), ('4', 'D')]
+    key_b = [('1', 'B'), ('2', 'A'), ('3', 'B'), ('4', 'A')]
+    key_c = [('1', 'C'), ('2', 'C'), ('3', 'C'), ('4', 'C')]
+    options = [(number, answer, choices) for (number, answer), choices
+               in zip(key_a, [4, 4, 5, 4])]
+
+    all_keys_list = jmetrik_functions.combine_key_lists(options, key_b,
+                                                        key_c, [])
+    assert all_keys_list[1] == ('2', 'B, C', 'A', 'C', 4)
+
+    # an empty key in the middle would score form C as form B
+    with pytest.raises(ValueError, match='form B is empty'):
+        jmetrik_functions.combine_key_lists(options, [], key_c)
+
+    scoring_keys = jmetrik_functions.scoring_keys_generator(all_keys_list)
+
+    assert list(scoring_keys) == ['A', 'B', 'C']
+    # same key but a different number of options stays separate
+    assert scoring_keys['A'] == {(1, 0, 0, 0): ['question001'],
+                                 (0, 1, 1, 0): ['question002'],
+                                 (1, 0, 0, 0, 0): ['question003'],
+                                 (0, 0, 0, 1): ['question004']}
+    assert scoring_keys['C'] == {
+        (0, 0, 1, 0): ['question001', 'question002', 'question004'],
+        (0, 0, 1, 0, 0): ['question003']}
+    assert jmetrik_functions.scoring_key_generator('B', all_keys_list) == \
+        scoring_keys['B']
+
+    # form A question 4 is keyed D but only given 3 options
+    short_options = options[:3] + [('4', 'D', 3)]
+    with pytest.raises(ValueError, match='question004'):
+        jmetrik_functions.scoring_keys_generator(
+            jmetrik_functions.combine_key_lists(short_options, key_b))
+
+    with pytest.raises(ValueError, match='question004 has 7 options'):
+        jmetrik_functions.scoring_keys_generator(
+            jmetrik_functions.combine_key_lists(options[:3] + [('4', 'D', 7)],
+                                                key_b))
+
+
+def test_infer_options_list_prompts_only_exceptions(graded_class,
+                                                    monkeypatch):
+    classdata = graded_class
+
+    # form A students bubbled A, C and A|B; key A uses A, B and C
+    assert classdata.observed_option_counts() == {1: 2, 2: 3, 3: 3}
+    assert classdata.observed_option_counts('A') == {1: 1, 2: 3, 3: 3}
+
+    key_a = [('1', 'A'), ('2', 'B'), ('3', 'C'), ('4', 'A, D')]
+    observed = {1: 4, 2: 4, 3: 3, 4: 2}
+
+    prompts = []
+
+    def answer(prompt):
+        prompts.append(prompt)
+        return 'E'
+
+    monkeypatch.setattr('builtins.input', answer)
+    options = jmetrik_functions.infer_options_list(key_a, observed)
+
+    assert len(prompts) == 1 and 'question #3' in prompts[0]
+    assert options == [('1', 'A', 4), ('2', 'B', 4), ('3', 'C', 5),
+                       ('4', 'A, D', 4)]
+
+    # per question bubbles from the sheet, and F for a six option question
+    prompts.clear()
+    monkeypatch.setattr('builtins.input', lambda prompt: 'F')
+    options = jmetrik_functions.infer_options_list(
+        key_a, {1: 4, 2: 4, 3: 6, 4: 2},
+        sheet_options={1: 4, 2: 4, 3: 6, 4: 4})
+
+    assert options == [('1', 'A', 4), ('2', 'B', 4), ('3', 'C', 6),
+                       ('4', 'A, D', 4)]
+
+
+def test_observed_option_counts_key_length_mismatch(graded_class):
+    classdata = graded_class
+    classdata.exam_keys_df = classdata.exam_keys_df.iloc[:2]
+
+    with pytest.raises(ValueError, match='key A has 2 questions'):
+        classdata.observed_option_counts('A')